@@ -1,11 +1,15 @@
+import time
+
+START = time.perf_counter()  # before the imports, they are part of the startup time
+
 import argparse
 import json
 from socket import socket, AF_INET, SOCK_STREAM
 
 import numpy as np
 
+import pytablut.loggers as lg
 from pytablut.game import State
-# from pytablut.neuralnet import ResidualNN
 from pytablut.player import Player
 from pytablut.utils import setup_folders
 
@@ -97,6 +101,8 @@ def play(comm, player):
         else:
             print('other player\'s turn')
 
+    player.save_cache()
+
     if state.turn == 'DRAW':
         print("it\'s a draw")
     elif MAP[state.turn] == player.color:
@@ -118,18 +124,36 @@ if __name__ == '__main__':
                         help='name of the player')
     parser.add_argument('-m', '--model', type=int, default='-1',
                         help='version of the neural network to use (<0 means no network)')
+    parser.add_argument('-b', '--backend', type=str, default='numpy', choices=['numpy', 'keras', 'int8', 'float16'],
+                        help='how to evaluate the neural network: numpy needs an exported model, '
+                             'int8 and float16 a quantized one')
+    parser.add_argument('-e', '--engine', type=str, default='mcts', choices=['mcts', 'alphabeta'],
+                        help='search engine used to compute moves')
     args = parser.parse_args()
+    imported = time.perf_counter()
     setup_folders()
     if args.model < 0:
         p = Player(color=args.color.upper(),
                    name=args.name,
-                   timeout=args.timeout)
+                   timeout=args.timeout,
+                   engine=args.engine)
     else:
         p = Player(color=args.color.upper(),
                    name=args.name,
                    nnet_ver=args.model,
-                   timeout=args.timeout)
+                   timeout=args.timeout,
+                   engine=args.engine,
+                   backend=args.backend)
+    built = time.perf_counter()
+    # network and first move paths are run before connecting, the server starts the clock on connection
+    p.warmup()
+    warm = time.perf_counter()
 
     c = ServerCommunication(color=args.color.upper(),
                             ip_address=args.ip)
+    connected = time.perf_counter()
+    report = 'startup {:.3f} s: imports {:.3f} s, player {:.3f} s, warmup {:.3f} s, connection {:.3f} s'.format(
+        connected - START, imported - START, built - imported, warm - built, connected - warm)
+    print(report)
+    lg.logger_player.info(report.upper())
     play(c, p)
@@ -97,7 +97,8 @@ class MCTS:
             return None
 
     def select_leaf(self) -> (Node, list):
-        lg.logger_mcts.info('SELECTING LEAF')
+        if lg.TRACE:
+            lg.tracer_mcts.trace('SELECTING LEAF')
         node = self.root
         path = []
 
@@ -105,7 +106,8 @@ class MCTS:
             max_QU = -np.inf
             Np = np.sum([edge.N for edge in node.edges])
             simulation_edge = None
-            lg.logger_mcts.debug('PLAYER TURN {}'.format(node.state.turn))
+            if lg.TRACE:
+                lg.tracer_mcts.trace('PLAYER TURN %s', node.state.turn)
 
             if node == self.root:
                 nu = np.random.dirichlet([cfg.ALPHA] * len(node.edges))
@@ -122,7 +124,6 @@ class MCTS:
                 QU = edge.Q + U
                 # lg.logger_mcts.info('ACTION: {}, QU: {}'.format(edge.action, QU))
                 if QU > max_QU and edge not in path:
-                    lg.logger_mcts.debug('UPDATING SIMULATION EDGE')
                     max_QU = QU
                     simulation_edge = edge
 
@@ -133,7 +134,8 @@ class MCTS:
         return node, path
 
     def expand_leaf(self, leaf: Node) -> bool:
-        lg.logger_mcts.info('EXPANDING LEAF WITH ID {}'.format(leaf.id))
+        if lg.TRACE:
+            lg.tracer_mcts.trace('EXPANDING LEAF WITH ID %s', leaf.id)
         found_terminal = False
         for action in leaf.state.actions:
             next_state = leaf.state.transition_function(action)
@@ -145,7 +147,8 @@ class MCTS:
         return found_terminal
 
     def random_playout(self, leaf: Node, turn: int):
-        lg.logger_mcts.info('PERFORMING RANDOM PLAYOUT')
+        if lg.TRACE:
+            lg.tracer_mcts.trace('PERFORMING RANDOM PLAYOUT')
         processes = []
         results = []
         q = Queue()
@@ -196,14 +199,16 @@ class MCTS:
             return_queue.put((-v, path))
 
     def backpropagation(self, v, n, path: list):
-        lg.logger_mcts.info('PERFORMING BACKPROPAGATION')
+        if lg.TRACE:
+            lg.tracer_mcts.trace('PERFORMING BACKPROPAGATION')
         direction = 1
         for edge in path:
             edge.N += n
             edge.W += v * direction
             direction *= -1
             edge.Q = edge.W / edge.N
-            lg.logger_mcts.info('Act = {}, N = {}, W = {}, Q = {}'.format(edge.action, edge.N, edge.W, edge.Q))
+            if lg.TRACE:
+                lg.tracer_mcts.trace('Act = %s, N = %s, W = %s, Q = %s', edge.action, edge.N, edge.W, edge.Q)
 
     def swap_values(self):
         """ changes stats from white to black """
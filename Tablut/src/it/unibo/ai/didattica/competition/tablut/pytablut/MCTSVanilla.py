@@ -1,4 +1,5 @@
-from multiprocessing import Queue, Process, cpu_count
+import os
+import time
 import numpy as np
 
 import pytablut.config as cfg
@@ -16,6 +17,7 @@ class Node:
         self.state: State = state
         self.id: int = hash(state)
         self.edges: list = []
+        self.has_priors: bool = False  # whether the priors of the edges come from the network
 
     def __eq__(self, other):
         return self.id == other.id
@@ -35,12 +37,13 @@ class Node:
 
 class Edge:
 
-    def __init__(self, in_node: Node, out_node: Node, action):
+    def __init__(self, in_node: Node, out_node: Node, action, P: float = 0.):
         """
         each edge represents an action from a state to another
         :param in_node: node of the initial state
         :param out_node: node of the next state
         :param action: the action
+        :param P: prior probability of the action
         """
         self.in_node: Node = in_node
         self.out_node: Node = out_node
@@ -48,9 +51,10 @@ class Edge:
         self.N = 0  # number of times action has been taken from initial state
         self.W = 0.  # total value of next state
         self.Q = 0.  # mean value of next state
+        self.P = P  # prior probability of the action
 
     def __str__(self):
-        return f'{self.action}: N = {self.N:0>3d}, W = {self.W:>5.0f}, Q = {self.Q:>6.2f}'
+        return f'{self.action}: N = {self.N:0>3d}, W = {self.W:>5.0f}, Q = {self.Q:>6.2f}, P = {self.P:>5.3f}'
 
     def __format__(self, format_spec):
         return self.__str__()
@@ -58,10 +62,28 @@ class Edge:
 
 class MCTS:
 
-    def __init__(self, player, root: Node, c_puct: float = cfg.CPUCT):
+    def __init__(self, player, root: Node, c_puct: float = cfg.CPUCT, past_states: set = None,
+                 max_nodes: int = cfg.MAX_TREE_NODES, seed: int = None, workers: int = None, puct: bool = False):
+        """
+        :param player: color of the player searching the tree
+        :param root: node of the current state
+        :param past_states: ids of the states already occurred in the game, reaching one of them is a draw
+        :param max_nodes: maximum number of nodes of the tree, see prune
+        :param seed: seed of the random playouts, None for non reproducible playouts
+        :param workers: number of parallel playouts for each simulation, None to use all the cpus
+        :param puct: select the edges with PUCT, guided by the priors set by set_priors, instead of UCT
+        """
         self.player = player
         self.root: Node = root
         self.c_puct = c_puct
+        self.past_states: set = past_states if past_states is not None else set()
+        self.max_nodes: int = max_nodes
+        self.size: int = 1  # number of nodes in the tree
+        self.seed: int = seed
+        self.playouts: int = 0
+        self.workers: int = workers if workers is not None else os.cpu_count() or 1
+        self.puct: bool = puct
+        self.rng = np.random.default_rng(seed)
         self.new_root(self.root)
 
     def _delete_subtree(self, edge):
@@ -73,12 +95,23 @@ class MCTS:
             self._delete_subtree(out_edge)
         del node.edges
         del node
+        self.size -= 1
+
+    def _count_nodes(self) -> int:
+        count = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(edge.out_node for edge in node.edges)
+        return count
 
     def delete_tree(self):
         for edge in self.root.edges:
             self._delete_subtree(edge)
         del self.root.edges
         self.root = None
+        self.size = 0
 
     def new_root(self, node: Node):
         if self.root != node:
@@ -87,6 +120,7 @@ class MCTS:
             for edge in [edge for edge in tmp.edges if edge.out_node != self.root]:
                 self._delete_subtree(edge)
             del tmp.edges
+            self.size = self._count_nodes()
         if self.root.is_leaf():
             self.expand_leaf(self.root)
         any_terminal = np.argwhere([edge.out_node.state.is_terminal for edge in self.root.edges])
@@ -95,56 +129,97 @@ class MCTS:
         else:
             return None
 
-    def select_leaf(self) -> (Node, list):
-        lg.logger_mcts.info('SELECTING LEAF')
+    def select_leaf(self) -> (Node, list, bool):
+        """
+        :return: the selected node, the path of edges leading to it and
+        whether the node repeats a position of the game or of the path itself
+        """
+        if lg.TRACE:
+            lg.tracer_mcts.trace('SELECTING LEAF')
         node = self.root
         path = []
+        visited = {node.id}
 
         while not node.is_leaf():
             max_QU = -np.inf
             Np = np.sum([edge.N for edge in node.edges])
             simulation_edge = None
-            lg.logger_mcts.debug('PLAYER TURN {}'.format(node.state.turn))
+            if lg.TRACE:
+                lg.tracer_mcts.trace('PLAYER TURN %s', node.state.turn)
 
+            sqrt_Np = np.sqrt(max(Np, 1))
             for i, edge in enumerate(node.edges):
-                if edge.N == 0:
+                if self.puct:
+                    U = self.c_puct * edge.P * sqrt_Np / (1 + edge.N)
+                elif edge.N == 0:
                     U = np.inf
                 else:
                     U = self.c_puct * np.sqrt(np.log(Np) / edge.N)
 
                 QU = edge.Q + U
-                if QU > max_QU and edge not in path:
-                    lg.logger_mcts.debug('UPDATING SIMULATION EDGE')
+                if QU > max_QU:
                     max_QU = QU
                     simulation_edge = edge
 
             node = simulation_edge.out_node
             path.append(simulation_edge)
+            if node.id in visited or node.id in self.past_states:
+                return node, path, True
+            visited.add(node.id)
 
-        return node, path
+        return node, path, False
 
     def expand_leaf(self, leaf: Node) -> bool:
-        lg.logger_mcts.info('EXPANDING LEAF WITH ID {}'.format(leaf.id))
+        if lg.TRACE:
+            lg.tracer_mcts.trace('EXPANDING LEAF WITH ID %s', leaf.id)
         found_terminal = False
+        # uniform priors until the network evaluates the leaf
+        P = 1 / len(leaf.state.actions) if leaf.state.actions else 0.
         for action in leaf.state.actions:
             next_state = leaf.state.transition_function(action)
             new_leaf = Node(next_state)
-            new_edge = Edge(leaf, new_leaf, action)
+            new_edge = Edge(leaf, new_leaf, action, P)
             leaf.edges.append(new_edge)
             if next_state.is_terminal:
                 found_terminal = True
+        self.size += len(leaf.edges)
         return found_terminal
 
+    def set_priors(self, node: Node, priors):
+        """
+        :param node: expanded node
+        :param priors: probabilities of the actions of the node, in the order of its edges
+        """
+        for edge, P in zip(node.edges, priors):
+            edge.P = float(P)
+        node.has_priors = True
+
+    def add_dirichlet_noise(self, epsilon: float = cfg.EPSILON, alpha: float = cfg.ALPHA):
+        """
+        mixes the priors of the root with Dirichlet noise, so that self-play explores moves the network dislikes
+        """
+        if not self.root.edges:
+            return
+        nu = self.rng.dirichlet([alpha] * len(self.root.edges))
+        for edge, noise in zip(self.root.edges, nu):
+            edge.P = (1 - epsilon) * edge.P + epsilon * noise
+
     def random_playout(self, leaf: Node, turn: int):
-        lg.logger_mcts.info('PERFORMING RANDOM PLAYOUT')
+        if lg.TRACE:
+            lg.tracer_mcts.trace('PERFORMING RANDOM PLAYOUT')
+        # imported here, the alpha-beta engine and the network evaluations never need it
+        from multiprocessing import Queue, Process
+
         processes = []
         results = []
         q = Queue()
         current_state = leaf.state
-        for i in range(cpu_count()):
-            p = Process(target=self.__parallel_playout, args=(current_state, turn, q))
+        for i in range(self.workers):
+            seed = None if self.seed is None else [self.seed, self.playouts, i]
+            p = Process(target=self.__parallel_playout, args=(current_state, turn, q, seed))
             processes.append(p)
             p.start()
+        self.playouts += 1
         for _ in processes:
             r = q.get()
             results.append(r)
@@ -154,14 +229,17 @@ class MCTS:
         final_v = 0
         n = 0
         sum_len_paths = 0
-        for v, path in results:
+        playout_time = 0.
+        for v, path, elapsed in results:
             sum_len_paths += len(path)
             final_v += v
             n += np.abs(v)
-        return final_v, n, sum_len_paths/len(processes)
+            playout_time = max(playout_time, elapsed)
+        return final_v, n, sum_len_paths/len(processes), playout_time
 
-    def __parallel_playout(self, current_state, turn, return_queue):
-        rng = np.random.default_rng()
+    def __parallel_playout(self, current_state, turn, return_queue, seed=None):
+        start = time.perf_counter()
+        rng = np.random.default_rng(seed)
         path = []
         v = 1
         while not current_state.is_terminal:
@@ -180,20 +258,65 @@ class MCTS:
                 path.append(current_state.actions[act_idx])
                 current_state = current_state.transition_function(current_state.actions[act_idx])
 
+        elapsed = time.perf_counter() - start
         if current_state.turn != self.player:
-            return_queue.put((v, path))
+            return_queue.put((v, path, elapsed))
         else:
-            return_queue.put((-v, path))
+            return_queue.put((-v, path, elapsed))
 
     def backpropagation(self, v, n, path: list):
-        lg.logger_mcts.info('PERFORMING BACKPROPAGATION')
+        if lg.TRACE:
+            lg.tracer_mcts.trace('PERFORMING BACKPROPAGATION')
         direction = 1
         for edge in path:
             edge.N += n
             edge.W += v * direction
             direction *= -1
             edge.Q = edge.W / edge.N
-            lg.logger_mcts.info('Act = {}, N = {}, W = {}, Q = {}'.format(edge.action, edge.N, edge.W, edge.Q))
+            if lg.TRACE:
+                lg.tracer_mcts.trace('Act = %s, N = %s, W = %s, Q = %s', edge.action, edge.N, edge.W, edge.Q)
+
+    def prune(self):
+        """
+        if the tree exceeds max_nodes, collapses the least visited subtrees into leaves
+        until only PRUNE_RATIO * max_nodes nodes are left.
+        The statistics of the edges leading to the collapsed nodes are kept,
+        the nodes get expanded again if the search goes back to them
+        """
+        if self.size <= self.max_nodes:
+            return
+        lg.logger_mcts.info('PRUNING TREE OF {} NODES'.format(self.size))
+        internal = []
+        stack = [(edge, 1) for edge in self.root.edges]
+        while stack:
+            edge, depth = stack.pop()
+            if edge.out_node.edges:
+                internal.append((edge, depth))
+                stack.extend((out_edge, depth + 1) for out_edge in edge.out_node.edges)
+        # on ties the deepest nodes go first, so that no subtree is visited after its ancestor was collapsed
+        internal.sort(key=lambda x: (x[0].N, -x[1]))
+        target = int(self.max_nodes * cfg.PRUNE_RATIO)
+        for edge, _ in internal:
+            if self.size <= target:
+                break
+            node = edge.out_node
+            for out_edge in node.edges:
+                self._delete_subtree(out_edge)
+            node.edges = []
+        lg.logger_mcts.info('TREE PRUNED TO {} NODES'.format(self.size))
+
+    def add_virtual_loss(self, path: list, loss: int = cfg.VIRTUAL_LOSS):
+        """ counts a pending simulation along path as lost for every player, until its value is known """
+        for edge in path:
+            edge.N += loss
+            edge.W -= loss
+            edge.Q = edge.W / edge.N
+
+    def remove_virtual_loss(self, path: list, loss: int = cfg.VIRTUAL_LOSS):
+        for edge in path:
+            edge.N -= loss
+            edge.W += loss
+            edge.Q = edge.W / edge.N if edge.N > 0 else 0.
 
     def swap_values(self):
         """ changes stats from white to black """
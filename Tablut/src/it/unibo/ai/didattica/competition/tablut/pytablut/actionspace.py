@@ -0,0 +1,179 @@
+"""
+Mapping between actions and the 9x9x32 policy space of the neural network.
+
+The policy has 32 layers in 2 groups of 16, every group is one axis: rows, columns (with this order):
+    - the first layer of every group represents moving by -8 cells on that axis
+    - the last layer of every group represents moving by +8 cells on that axis
+the position on the 9x9 plane is the starting cell of the action.
+Both directions of the mapping, and the permutations of the policy under the 8 symmetries of the board,
+go through precomputed tables. They are built once and saved in actionspace.npy next to this module,
+so that later imports only read them (python -m pytablut.actionspace rebuilds the file).
+"""
+import os
+
+import numpy as np
+
+import pytablut.config as cfg
+
+SIZE = cfg.OUT_SHAPE[0]
+LAYERS = cfg.OUT_SHAPE[2]
+POLICY_SIZE = int(np.prod(cfg.OUT_SHAPE))
+TABLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'actionspace.npy')
+# the tables are saved one after the other in a single int16 array, a plain .npy loads without zipfile
+_TABLE_SIZES = (SIZE ** 4, POLICY_SIZE * 4, 8 * POLICY_SIZE)
+
+
+def _layer(distance_x: int, distance_y: int) -> int:
+    if distance_x != 0:
+        # up or down, there is no layer for moving by 0 cells
+        return distance_x + (7 if distance_x > 0 else 8)
+    else:
+        # left or right
+        return distance_y + (23 if distance_y > 0 else 24)
+
+
+def _build_tables():
+    # flat policy index of every (x_from, y_from, x_to, y_to), -1 if it is not a straight move
+    index = np.full((SIZE,) * 4, -1, dtype=np.int16)
+    # action of every flat policy index, -1 if it leaves the board
+    actions = np.full((POLICY_SIZE, 4), -1, dtype=np.int8)
+    for x in range(SIZE):
+        for y in range(SIZE):
+            targets = [(tx, y) for tx in range(SIZE) if tx != x] + [(x, ty) for ty in range(SIZE) if ty != y]
+            for tx, ty in targets:
+                flat = (x * SIZE + y) * LAYERS + _layer(tx - x, ty - y)
+                index[x, y, tx, ty] = flat
+                actions[flat] = (x, y, tx, ty)
+    return index, actions
+
+
+def action_indexes(actions) -> np.ndarray:
+    """
+    :param actions: list of actions ((x_from, y_from), (x_to, y_to))
+    :return: np.array with the flat policy index of each action
+    """
+    coords = np.asarray(actions, dtype=np.intp).reshape(-1, 4)
+    return INDEX_TABLE[coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3]]
+
+
+def index_to_actions(indexes) -> list:
+    """ :return: the actions corresponding to flat policy indexes """
+    return [((x, y), (tx, ty)) for x, y, tx, ty in ACTION_TABLE[np.asarray(indexes)].tolist()]
+
+
+def map_actions(logits: np.ndarray, actions) -> np.ndarray:
+    """
+    :param logits: policy of shape 9x9x32
+    :return: an array of the predicted values of the actions
+    """
+    return logits.reshape(-1)[action_indexes(actions)]
+
+
+def map_into_action_space(actions, pi, out: np.ndarray = None) -> np.ndarray:
+    """
+    :param pi: values of the actions
+    :param out: optional buffer of shape 9x9x32, reused to avoid allocations
+    :return: the values of the actions placed in the policy space, zero elsewhere
+    """
+    if out is None:
+        out = np.zeros(cfg.OUT_SHAPE, dtype=float)
+    else:
+        out[...] = 0
+    out.reshape(-1)[action_indexes(actions)] = pi
+    return out
+
+
+def transform_board(board: np.ndarray, symmetry: int) -> np.ndarray:
+    """
+    :param symmetry: index in [0, 8), the board is mirrored left-right if symmetry >= 4,
+                     then rotated by 90 degrees symmetry % 4 times as np.rot90 does
+    """
+    if symmetry >= 4:
+        board = np.fliplr(board)
+    return np.rot90(board, symmetry % 4)
+
+
+def _transform_cell(x: int, y: int, symmetry: int) -> tuple:
+    if symmetry >= 4:
+        y = SIZE - 1 - y
+    for _ in range(symmetry % 4):
+        x, y = SIZE - 1 - y, x
+    return x, y
+
+
+def _build_symmetries(index: np.ndarray, actions: np.ndarray) -> np.ndarray:
+    # permutation of the flat policy indexes for every symmetry of the board,
+    # the indexes outside the board are left in place
+    permutations = np.tile(np.arange(POLICY_SIZE, dtype=np.int16), (8, 1))
+    valid = np.flatnonzero(actions[:, 0] >= 0)
+    for symmetry in range(8):
+        for flat in valid:
+            x, y, tx, ty = actions[flat]
+            permutations[symmetry, flat] = index[_transform_cell(x, y, symmetry) + _transform_cell(tx, ty, symmetry)]
+    return permutations
+
+
+def build_tables(file: str = TABLES_FILE):
+    """ builds all the tables and saves them to file, if it can be written """
+    index, actions = _build_tables()
+    symmetries = _build_symmetries(index, actions)
+    try:
+        np.save(file, np.concatenate([index.ravel(), actions.ravel(), symmetries.ravel()]).astype(np.int16))
+    except OSError:
+        pass
+    return index, actions, symmetries
+
+
+def _load_tables(file: str = TABLES_FILE):
+    try:
+        tables = np.load(file)
+    except (OSError, ValueError):
+        return build_tables(file)
+    # a file built for another policy shape is rebuilt
+    if tables.shape != (sum(_TABLE_SIZES),):
+        return build_tables(file)
+    index, actions, symmetries = np.split(tables, np.cumsum(_TABLE_SIZES)[:-1])
+    return index.reshape((SIZE,) * 4), actions.reshape(POLICY_SIZE, 4).astype(np.int8), symmetries.reshape(8, -1)
+
+
+INDEX_TABLE, ACTION_TABLE, SYMMETRIES = _load_tables()
+INVERSE_SYMMETRIES = np.argsort(SYMMETRIES, axis=1).astype(np.int16)
+
+
+def transform_indexes(indexes, symmetry: int) -> np.ndarray:
+    """ :return: the flat policy indexes of the same actions on the board transformed by transform_board """
+    return SYMMETRIES[symmetry][np.asarray(indexes, dtype=np.intp)]
+
+
+def legal_priors(logits: np.ndarray, actions) -> np.ndarray:
+    """
+    softmax of the policy restricted to the legal actions, every other action gets probability 0
+    :param logits: policy of shape 9x9x32
+    :return: np.array with the probabilities of the actions
+    """
+    legal = map_actions(logits, actions).astype(np.float64)
+    legal = np.exp(legal - np.max(legal))
+    return legal / np.sum(legal)
+
+
+def dense_policies(indexes: np.ndarray, probabilities: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    :param indexes: array of shape (N, K) with flat policy indexes, -1 for the unused entries
+    :param probabilities: array of shape (N, K) with the probabilities of the indexes
+    :param out: optional buffer of shape (M, 9, 9, 32) with M >= N
+    :return: np.array of shape (N, 9, 9, 32), zero where there is no policy
+    """
+    n = len(indexes)
+    if out is None:
+        out = np.zeros((n,) + tuple(cfg.OUT_SHAPE), dtype=np.float32)
+    else:
+        out = out[:n]
+        out[...] = 0
+    rows, columns = np.nonzero(indexes >= 0)
+    out.reshape(n, -1)[rows, indexes[rows, columns]] = probabilities[rows, columns]
+    return out
+
+
+if __name__ == '__main__':
+    build_tables()
+    print('written', TABLES_FILE)
@@ -0,0 +1,236 @@
+import numpy as np
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.game import State
+from pytablut.heuristics import evaluate
+
+WIN = 1000.
+INF = np.inf
+
+EXACT, LOWERBOUND, UPPERBOUND = 0, 1, 2
+
+
+class SearchTimeout(Exception):
+    """ raised inside the search when the time for the current move is over """
+
+
+class Zobrist:
+
+    PIECES = (-1, 1, 2)
+    INDEX = {piece: i for i, piece in enumerate(PIECES)}
+
+    def __init__(self, seed=cfg.ZOBRIST_SEED):
+        """
+        random bitstrings used to hash boards
+        :param seed: seed of the generator, the same seed always gives the same keys
+        """
+        rng = np.random.default_rng(seed)
+        self.table = rng.integers(0, np.iinfo(np.uint64).max, size=(len(self.PIECES), 9, 9),
+                                  dtype=np.uint64, endpoint=True)
+        self.black_to_move = int(rng.integers(0, np.iinfo(np.uint64).max, dtype=np.uint64, endpoint=True))
+        # python ints are faster to xor one at a time
+        self.keys = self.table.tolist()
+
+    def hash(self, state: State) -> int:
+        """ :return: hash of the whole board, see update for the states reached during a search """
+        key = 0
+        for i, piece in enumerate(self.PIECES):
+            key ^= int(np.bitwise_xor.reduce(self.table[i][state.board == piece]))
+        if state.turn == -1:
+            key ^= self.black_to_move
+        return key
+
+    def update(self, key: int, state: State, action: tuple, child: State) -> int:
+        """
+        :param key: hash of state
+        :return: hash of child, the state reached from state through action,
+        from the moved checker and the captured ones
+        """
+        (x0, y0), (x1, y1) = action
+        x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+        keys = self.keys[self.INDEX[int(state.board[x0, y0])]]
+        key ^= keys[x0][y0] ^ keys[x1][y1] ^ self.black_to_move
+        # the captured checkers, the king included, are next to the arrival cell
+        for x, y in ((x1 - 1, y1), (x1 + 1, y1), (x1, y1 - 1), (x1, y1 + 1)):
+            if 0 <= x < 9 and 0 <= y < 9 and (x, y) != (x0, y0) and state.board[x, y] != 0 and child.board[x, y] == 0:
+                key ^= self.keys[self.INDEX[int(state.board[x, y])]][x][y]
+        return key
+
+
+class AlphaBeta:
+
+    def __init__(self, max_depth: int = cfg.AB_MAX_DEPTH, tt_size: int = cfg.TT_SIZE):
+        """
+        iterative deepening principal variation search
+        :param max_depth: maximum depth of the iterative deepening
+        :param tt_size: number of slots of the transposition table
+        """
+        self.max_depth = max_depth
+        self.tt_size = tt_size
+        self.zobrist = Zobrist()
+        # slots of (key, depth, score, flag, action, generation), indexed by the key
+        self.tt = [None] * tt_size
+        self.generation = 0
+        self.history = dict()
+        self.killers = [[None, None] for _ in range(max_depth + 1)]
+        self.nodes = 0
+        self.timeover = None
+        self.past_states = set()
+        self.path = set()
+
+    def reset(self):
+        self.tt = [None] * self.tt_size
+        self.history.clear()
+        self.killers = [[None, None] for _ in range(self.max_depth + 1)]
+
+    def search(self, state: State, timeover, past_states: set = None) -> tuple:
+        """
+        searches with increasing depth until time is over
+        :param state: state to search from
+        :param timeover: callable returning True when the time for this move is over
+        :param past_states: ids of the states already occurred in the game, reaching one of them is a draw
+        :return: the best action found by the last completed iteration
+        """
+        self.timeover = timeover
+        self.past_states = past_states if past_states is not None else set()
+        self.nodes = 0
+        self.generation += 1
+        self.killers = [[None, None] for _ in range(self.max_depth + 1)]
+        # old history scores are still useful for ordering, but should not dominate
+        for action in self.history:
+            self.history[action] //= 2
+
+        best_action = state.actions[0]
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, action = self._root_search(state, depth)
+            except SearchTimeout:
+                lg.logger_player.info('DEPTH {} INTERRUPTED AFTER {} NODES'.format(depth, self.nodes))
+                break
+            best_action = action
+            lg.logger_player.info('DEPTH {} COMPLETED, SCORE {:.3f}, ACTION {}'.format(depth, score, action))
+            if abs(score) >= WIN - depth:
+                # forced win or loss found, searching deeper can't change the outcome
+                break
+        return best_action
+
+    def _evaluate(self, state: State) -> float:
+        """ :return: value of the state from the point of view of the player to move """
+        return evaluate(state.board) * state.turn
+
+    def _order_actions(self, state: State, tt_action, ply: int) -> list:
+        """ transposition table move first, then killers, then the rest by history score """
+        killers = self.killers[ply]
+
+        def key(action):
+            if action == tt_action:
+                return INF
+            if action in killers:
+                return WIN
+            return self.history.get(action, 0)
+
+        return sorted(state.actions, key=key, reverse=True)
+
+    def _probe(self, key):
+        """ :return: the entry of the transposition table for key, None if there is none """
+        entry = self.tt[key % self.tt_size]
+        return entry if entry is not None and entry[0] == key else None
+
+    def _store(self, key, depth, score, flag, action):
+        slot = key % self.tt_size
+        entry = self.tt[slot]
+        # the deeper entry is kept, unless it was stored by the search of an older move
+        if entry is None or entry[5] != self.generation or depth >= entry[1]:
+            self.tt[slot] = (key, depth, score, flag, action, self.generation)
+
+    def _cutoff(self, action, depth, ply):
+        killers = self.killers[ply]
+        if action != killers[0]:
+            killers[1] = killers[0]
+            killers[0] = action
+        self.history[action] = self.history.get(action, 0) + depth * depth
+
+    def _root_search(self, state: State, depth: int) -> (float, tuple):
+        alpha, beta = -INF, INF
+        # ids of the states of the line being searched
+        self.path = {state.id}
+        key = self.zobrist.hash(state)
+        entry = self._probe(key)
+        tt_action = entry[4] if entry is not None else None
+        best_action = None
+        for i, action in enumerate(self._order_actions(state, tt_action, 0)):
+            child = state.transition_function(action)
+            child_key = self.zobrist.update(key, state, action, child)
+            if i == 0:
+                score = -self._pvs(child, child_key, depth - 1, -beta, -alpha, 1)
+            else:
+                score = -self._pvs(child, child_key, depth - 1, -alpha - 1e-6, -alpha, 1)
+                if score > alpha:
+                    score = -self._pvs(child, child_key, depth - 1, -beta, -score, 1)
+            if score > alpha:
+                alpha = score
+                best_action = action
+        self._store(key, depth, alpha, EXACT, best_action)
+        return alpha, best_action
+
+    def _pvs(self, state: State, key: int, depth: int, alpha: float, beta: float, ply: int) -> float:
+        """ :param key: zobrist hash of state """
+        self.nodes += 1
+        if self.nodes % 256 == 0 and self.timeover():
+            raise SearchTimeout()
+        if state.id in self.past_states or state.id in self.path:
+            # draw by repetition, as in Game.execute
+            return 0.
+        if state.is_terminal:
+            # value is -1 if the player to move has lost, 0 for a draw
+            return state.value * (WIN - ply)
+        if depth <= 0 or ply >= self.max_depth:
+            return self._evaluate(state)
+
+        alpha_orig = alpha
+        tt_action = None
+        entry = self._probe(key)
+        if entry is not None:
+            _, tt_depth, tt_score, tt_flag, tt_action, _ = entry
+            if tt_depth >= depth:
+                if tt_flag == EXACT:
+                    return tt_score
+                elif tt_flag == LOWERBOUND:
+                    alpha = max(alpha, tt_score)
+                else:
+                    beta = min(beta, tt_score)
+                if alpha >= beta:
+                    return tt_score
+
+        best_score = -INF
+        best_action = None
+        self.path.add(state.id)
+        for i, action in enumerate(self._order_actions(state, tt_action, ply)):
+            child = state.transition_function(action)
+            child_key = self.zobrist.update(key, state, action, child)
+            if i == 0:
+                score = -self._pvs(child, child_key, depth - 1, -beta, -alpha, ply + 1)
+            else:
+                # null window search, re-search only if the move may improve alpha
+                score = -self._pvs(child, child_key, depth - 1, -alpha - 1e-6, -alpha, ply + 1)
+                if alpha < score < beta:
+                    score = -self._pvs(child, child_key, depth - 1, -beta, -score, ply + 1)
+            if score > best_score:
+                best_score = score
+                best_action = action
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                self._cutoff(action, depth, ply)
+                break
+        self.path.discard(state.id)
+
+        if best_score <= alpha_orig:
+            flag = UPPERBOUND
+        elif best_score >= beta:
+            flag = LOWERBOUND
+        else:
+            flag = EXACT
+        self._store(key, depth, best_score, flag, best_action)
+        return best_score
@@ -0,0 +1,284 @@
+"""
+Gating of new versions of the network.
+The candidate plays the incumbent in parallel worker processes, in pairs of games that start from the same
+random opening with swapped colors. After every pair a sequential probability ratio test on the pair scores
+decides whether the candidate is GATING_ELO stronger or not stronger at all, so a clearly better or worse candidate
+is settled in a few games and only close ones take up to GATING_MAX_GAMES. The test only sees complete pairs,
+otherwise it could stop after the game of one color, bringing back the bias the pairs remove. An accepted candidate is published.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.arena 5 4 --workers 8 --backend numpy
+"""
+import argparse
+import json
+import os
+import queue
+import signal
+import time
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+import pytablut.checkpoints as checkpoints
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.game import Game
+from pytablut.inference import InferenceClient, InferenceServer
+from pytablut.scaling import elo_interval
+
+
+def expected_score(elo: float) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+class SPRT:
+
+    def __init__(self, elo0: float = 0., elo1: float = cfg.GATING_ELO,
+                 alpha: float = cfg.GATING_ALPHA, beta: float = cfg.GATING_BETA):
+        """
+        sequential test of H0: the candidate is elo0 stronger, against H1: it is elo1 stronger.
+        The log likelihood ratio uses the normal approximation of the scores, that accounts for the draws
+        :param alpha: probability of accepting H1 when H0 is true
+        :param beta: probability of accepting H0 when H1 is true
+        """
+        self.s0 = expected_score(elo0)
+        self.s1 = expected_score(elo1)
+        self.lower = np.log(beta / (1 - alpha))
+        self.upper = np.log((1 - beta) / alpha)
+        self.scores = []
+
+    def add(self, score: float):
+        """
+        :param score: score of the candidate, 1 for a win, 0.5 for a draw, 0 for a loss,
+                      or the mean score of a pair of games, as gate does
+        """
+        self.scores.append(score)
+
+    def llr(self) -> float:
+        """ :return: log likelihood ratio of H1 against H0 """
+        if not self.scores:
+            return 0.
+        # half a win and half a loss as a prior, so that a few equal results do not give a zero variance
+        scores = np.array(self.scores + [0., 1.])
+        weights = np.ones(len(scores))
+        weights[-2:] = 0.5
+        n = np.sum(weights)
+        mean = np.sum(weights * scores) / n
+        var = np.sum(weights * scores ** 2) / n - mean ** 2
+        return float(n * (self.s1 - self.s0) * (2 * mean - self.s0 - self.s1) / (2 * var))
+
+    def status(self):
+        """ :return: 'accept' if H1 is accepted, 'reject' if H0 is accepted, None to keep playing """
+        llr = self.llr()
+        if llr >= self.upper:
+            return 'accept'
+        if llr <= self.lower:
+            return 'reject'
+        return None
+
+
+def play_game(white, black, opening: list, max_moves: int = cfg.GATING_MAX_MOVES) -> int:
+    """
+    plays a game starting with the opening moves
+    :return: 1 if white won, -1 if black won, 0 for a draw
+    """
+    game = Game()
+    white.reset()
+    black.reset()
+    for action in opening:
+        game.execute(action)
+    moves = len(opening)
+    while not game.current_state.is_terminal and moves < max_moves:
+        player = white if game.current_player == 1 else black
+        game.execute(player.act(game.current_state))
+        moves += 1
+    if not game.current_state.is_terminal or game.current_state.value == 0:
+        return 0
+    # the player of this turn has lost
+    return -game.current_state.turn
+
+
+def random_opening(seed: int, moves: int = cfg.GATING_OPENING_MOVES) -> list:
+    """ :return: moves random actions from the initial state, fewer if the game ends before """
+    rng = np.random.default_rng(seed)
+    state = Game().current_state
+    opening = []
+    while len(opening) < moves and not state.is_terminal:
+        action = state.actions[rng.integers(len(state.actions))]
+        opening.append(action)
+        state = state.transition_function(action)
+    return opening
+
+
+def worker(index: int, versions: tuple, options: dict, seed: int, tasks, results, slots=None):
+    """
+    plays the games taken from tasks until it gets None.
+    Game 2k and 2k+1 share the opening, the candidate is white in the first one and black in the second
+    :param versions: candidate and incumbent
+    :param slots: slots of the inference server for the candidate and the incumbent, None to load the networks
+    """
+    from pytablut.player import Player, load_brain
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    lg.use_log_folder(os.path.join('logs', 'arena{}'.format(index)))
+    try:
+        options = dict(options)
+        backend = options.pop('backend', 'keras')
+        players = []  # (white, black) of the candidate and of the incumbent
+        for version, slot in zip(versions, slots if slots is not None else (None, None)):
+            if slot is not None:
+                client = InferenceClient(slot)
+                client.version = version
+                brain, cache_file = client, None
+            else:
+                brain, cache_file = load_brain(version, backend)
+            pair = []
+            for color in ('WHITE', 'BLACK'):
+                player = Player(color=color, name='v{}'.format(version), seed=seed + index, **options)
+                player.set_brain(brain, cache_file)
+                pair.append(player)
+            players.append(pair)
+        (candidate_white, candidate_black), (incumbent_white, incumbent_black) = players
+        while True:
+            game = tasks.get()
+            if game is None:
+                break
+            start = time.perf_counter()
+            opening = random_opening(seed + game // 2)
+            if game % 2 == 0:
+                winner = play_game(candidate_white, incumbent_black, opening)
+                score = 0.5 if winner == 0 else float(winner == 1)
+            else:
+                winner = play_game(incumbent_white, candidate_black, opening)
+                score = 0.5 if winner == 0 else float(winner == -1)
+            results.put(('game', index, (game, score), time.perf_counter() - start))
+    except Exception:
+        results.put(('error', index, traceback.format_exc(), None))
+        raise
+
+
+def gate(candidate: int, incumbent: int, workers: int = cfg.GATING_WORKERS, max_games: int = cfg.GATING_MAX_GAMES,
+         sprt: SPRT = None, seed: int = 0, server: bool = cfg.INFERENCE_SERVER, promote: bool = True,
+         **options) -> dict:
+    """
+    plays the candidate against the incumbent until the test decides, then publishes the candidate if it is stronger
+    :param sprt: test deciding the match, by default the one of the GATING parameters
+    :param server: evaluate both networks in a shared inference server
+    :param promote: publish an accepted candidate
+    :param options: arguments of the players, e.g. backend, timeout, max_simulations
+    :return: result of the match
+    """
+    options.setdefault('max_simulations', cfg.GATING_SIMULATIONS)
+    options.setdefault('workers', 1)
+    # whole pairs only
+    max_games += max_games % 2
+    sprt = sprt if sprt is not None else SPRT()
+    context = mp.get_context('spawn')
+    tasks = context.Queue()
+    results = context.Queue()
+    inference = None
+    if server:
+        # each worker has a slot for the candidate and one for the incumbent
+        inference = InferenceServer(incumbent, options.get('backend', 'keras'), clients=2 * workers).start()
+    processes = []
+    for index in range(workers):
+        slots = (inference.slots[2 * index], inference.slots[2 * index + 1]) if inference is not None else None
+        process = context.Process(target=worker, name='arena{}'.format(index),
+                                  args=(index, (candidate, incumbent), options, seed, tasks, results, slots))
+        process.start()
+        processes.append(process)
+
+    queued = 0
+    # two games in the queue for each worker, so that none waits for the next one
+    for _ in range(min(2 * workers, max_games)):
+        tasks.put(queued)
+        queued += 1
+    decision = None
+    scores = []  # scores of the single games
+    halves = {}  # score of the first finished game of each pair
+    begin = time.perf_counter()
+    lg.logger_train.info('GATING MODEL v{} AGAINST v{}'.format(candidate, incumbent))
+    try:
+        while decision is None and len(scores) < max_games:
+            try:
+                kind, index, payload, elapsed = results.get(timeout=1.)
+            except queue.Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError('an arena worker died')
+                continue
+            if kind == 'error':
+                raise RuntimeError('arena worker {} crashed:\n{}'.format(index, payload))
+            game, score = payload
+            scores.append(score)
+            if game // 2 in halves:
+                # the pair is complete, the test sees the mean score of its two colors
+                sprt.add((halves.pop(game // 2) + score) / 2)
+                decision = sprt.status()
+            else:
+                halves[game // 2] = score
+            lg.logger_train.info('ARENA GAME {} IN {:.1f} s, CANDIDATE SCORE {}, LLR {:.2f} [{:.2f}, {:.2f}]'.format(
+                game, elapsed, score, sprt.llr(), sprt.lower, sprt.upper))
+            if queued < max_games:
+                tasks.put(queued)
+                queued += 1
+    finally:
+        # the games still in progress are not needed
+        for process in processes:
+            process.terminate()
+            process.join()
+        if inference is not None:
+            inference.stop()
+
+    diff, low, high = elo_interval(scores) if scores else (0., 0., 0.)
+    scores = np.array(scores)
+    result = {'candidate': candidate, 'incumbent': incumbent, 'decision': decision or 'undecided',
+              'games': len(scores), 'wins': int(np.sum(scores == 1)), 'draws': int(np.sum(scores == 0.5)),
+              'losses': int(np.sum(scores == 0)), 'score': float(np.mean(scores)) if len(scores) else 0.5,
+              'elo': float(diff), 'low': float(low), 'high': float(high), 'llr': sprt.llr(),
+              'elapsed': time.perf_counter() - begin, 'time': time.time()}
+    result['promoted'] = promote and decision == 'accept'
+    if result['promoted']:
+        checkpoints.publish(candidate)
+    with open(cfg.ARENA_FILE, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    lg.logger_train.info('GATING RESULT: {}'.format(result))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gate a new version of the network against the current one.')
+    parser.add_argument('candidate', type=int,
+                        help='version of the new model')
+    parser.add_argument('incumbent', type=int, nargs='?', default=None,
+                        help='version it has to beat, the newest published one by default')
+    parser.add_argument('-w', '--workers', type=int, default=cfg.GATING_WORKERS,
+                        help='number of worker processes')
+    parser.add_argument('-b', '--backend', type=str, default='keras', choices=['numpy', 'keras', 'int8', 'float16'],
+                        help='how to evaluate the neural networks')
+    parser.add_argument('-t', '--timeout', type=float, default=cfg.TIMEOUT,
+                        help='seconds for each move')
+    parser.add_argument('-s', '--simulations', type=int, default=cfg.GATING_SIMULATIONS,
+                        help='simulations for each move, the timeout still applies')
+    parser.add_argument('-g', '--max-games', type=int, default=cfg.GATING_MAX_GAMES,
+                        help='games after which an undecided candidate is rejected')
+    parser.add_argument('-e', '--elo', type=float, default=cfg.GATING_ELO,
+                        help='Elo gain the test tries to detect')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the openings')
+    parser.add_argument('--no-server', dest='server', action='store_false',
+                        help='every worker loads its own copy of the networks instead of sharing an inference server')
+    parser.add_argument('--no-promote', dest='promote', action='store_false',
+                        help='only report the result, without publishing the candidate')
+    args = parser.parse_args()
+
+    incumbent = args.incumbent if args.incumbent is not None else checkpoints.latest_version()
+    if incumbent is None:
+        parser.error('no published version to compare with')
+    outcome = gate(args.candidate, incumbent, args.workers, args.max_games, SPRT(elo1=args.elo), args.seed,
+                   args.server, args.promote, backend=args.backend, timeout=args.timeout,
+                   max_simulations=args.simulations)
+    print('v{} vs v{}: {} after {} games (+{} ={} -{}), Elo {:+.0f} [{:+.0f}, {:+.0f}]{}'.format(
+        outcome['candidate'], outcome['incumbent'], outcome['decision'], outcome['games'], outcome['wins'],
+        outcome['draws'], outcome['losses'], outcome['elo'], outcome['low'], outcome['high'],
+        ', promoted' if outcome['promoted'] else ''))
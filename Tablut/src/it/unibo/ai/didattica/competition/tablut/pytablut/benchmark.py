@@ -0,0 +1,167 @@
+"""
+Reproducible benchmark of move generation and search speed on a fixed set of positions.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.benchmark --save baseline.json
+    python -m pytablut.benchmark --baseline baseline.json
+
+when a baseline is given the exit code is 1 if any metric got worse than the tolerance allows.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from pytablut.MCTSVanilla import MCTS, Node
+from pytablut.game import Game, State
+from pytablut.player import Player
+from pytablut.utils import setup_folders
+
+POSITIONS = {
+    'opening': (Game.s0, 1),
+    'middlegame': (np.array([[0, 0, 0, -1, -1, 0, 0, 0, 0],
+                             [0, 0, 0, 0, 0, 0, 0, 0, 0],
+                             [0, -1, 0, 0, 1, 0, 0, 0, 0],
+                             [-1, 0, 0, 1, 0, 0, -1, 0, -1],
+                             [-1, 0, 1, 0, 2, 1, 0, -1, -1],
+                             [0, 0, 0, 0, 1, 0, 0, 0, -1],
+                             [0, 0, -1, 0, 0, 1, 0, 0, 0],
+                             [0, 0, 0, 0, -1, 0, 0, -1, 0],
+                             [0, 0, 0, -1, -1, -1, 0, 0, 0]]), -1),
+    'endgame': (np.array([[0, 0, 0, -1, 0, 0, 0, 0, 0],
+                          [0, 0, -1, 0, 0, 0, 0, 0, 0],
+                          [0, 0, 0, 0, 0, 0, 1, 0, 0],
+                          [0, 0, 0, 0, 0, 0, 0, 0, 0],
+                          [0, 0, 0, 0, 0, 2, 0, 0, -1],
+                          [0, -1, 0, 0, 1, 0, 0, 0, 0],
+                          [0, 0, 0, 0, 0, 0, 0, 0, 0],
+                          [0, 0, 0, 0, 0, 0, -1, 0, 0],
+                          [0, 0, 0, -1, 0, 0, 0, 0, 0]]), 1),
+}
+
+# metrics where a higher value is better, all the others are better when lower
+HIGHER_IS_BETTER = ('movegen_per_s', 'simulations_per_s', 'playouts_per_s')
+LOWER_IS_BETTER = ('tree_bytes',)
+
+
+def movegen_rate(state: State, min_time: float) -> float:
+    """ :return: number of successor states generated per second, actions and captures included """
+    generated = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        for action in state.actions:
+            state.transition_function(action)
+        generated += len(state.actions)
+    return generated / (time.perf_counter() - start)
+
+
+def bytes_per_node(state: State) -> float:
+    """ :return: average memory taken by a tree node, measured on the children of state """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    mcts = MCTS(state.turn, Node(state))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / mcts.size
+
+
+def search(state: State, args) -> dict:
+    np.random.seed(args.seed)
+    color = 'WHITE' if state.turn == 1 else 'BLACK'
+    # without the opening book, whose moves are not searched
+    player = Player(color=color, name='bench', timeout=args.timeout, engine=args.engine,
+                    max_simulations=args.simulations, seed=args.seed, book=None)
+    action = player.act(state)
+    profile = player.profiler.summary()
+    search_time = profile['search_s']
+    return {'action': [[int(x) for x in cell] for cell in action],
+            'move_time_s': profile['elapsed_s'],
+            'simulations': profile['simulations'],
+            'simulations_per_s': profile['simulations_per_s'],
+            'playouts_per_s': profile['phases']['playout']['count'] / search_time if search_time > 0 else 0.,
+            'tree_nodes': profile['tree_nodes'],
+            'nodes_searched': player.alphabeta.nodes if player.alphabeta is not None else profile['tree_nodes']}
+
+
+def run(args) -> dict:
+    results = dict()
+    for name in args.positions:
+        board, turn = POSITIONS[name]
+        state = State(board=board.copy(), turn=turn)
+        print(f'{name}: measuring move generation')
+        result = {'movegen_per_s': movegen_rate(state, args.movegen_time)}
+        print(f'{name}: searching')
+        result.update(search(state, args))
+        result['tree_bytes'] = result['tree_nodes'] * bytes_per_node(state)
+        results[name] = result
+    return {'config': {'engine': args.engine, 'simulations': args.simulations,
+                       'timeout': args.timeout, 'seed': args.seed},
+            'positions': results}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    prints the ratio of every metric with respect to the baseline
+    :return: True if no metric got worse than the tolerance allows
+    """
+    ok = True
+    agreement = []
+    for name, result in results['positions'].items():
+        if name not in baseline['positions']:
+            continue
+        base = baseline['positions'][name]
+        agreement.append(result['action'] == base['action'])
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            if not base.get(metric):
+                continue
+            ratio = result[metric] / base[metric]
+            if metric in HIGHER_IS_BETTER:
+                worse = ratio < 1 - tolerance
+            else:
+                worse = ratio > 1 + tolerance
+            ok = ok and not worse
+            print(f'{name:<12s} {metric:<18s} {base[metric]:>14.1f} -> {result[metric]:>14.1f} '
+                  f'({ratio:.2f}x){"  REGRESSION" if worse else ""}')
+    if agreement:
+        print(f'chosen move agreement with baseline: {np.mean(agreement):.0%}')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark move generation and search speed.')
+    parser.add_argument('-e', '--engine', type=str, default='mcts', choices=['mcts', 'alphabeta'],
+                        help='search engine to benchmark')
+    parser.add_argument('-s', '--simulations', type=int, default=64,
+                        help='simulations per search, <= 0 means use the whole timeout')
+    parser.add_argument('-t', '--timeout', type=int, default=60,
+                        help='timeout in seconds for each search')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of all the random number generators')
+    parser.add_argument('-p', '--positions', type=str, nargs='+', default=list(POSITIONS),
+                        choices=list(POSITIONS), help='positions to benchmark')
+    parser.add_argument('--movegen-time', type=float, default=1.,
+                        help='seconds spent measuring move generation on each position')
+    parser.add_argument('--save', type=str, default=None,
+                        help='file where results are saved as JSON')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative worsening of a metric tolerated before reporting a regression')
+    args = parser.parse_args()
+    if args.simulations <= 0:
+        args.simulations = None
+    setup_folders()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
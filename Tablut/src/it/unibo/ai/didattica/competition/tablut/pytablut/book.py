@@ -0,0 +1,227 @@
+"""
+Opening book built from the statistics of the searches.
+For the first BOOK_TURNS moves of each player the visits N and the total values W of the actions of the root
+are added to the book, keyed by a hash of the canonical position (see evalcache.canonical_transform),
+so the 8 symmetric positions share their statistics. The file is an open addressing hash table of the positions
+followed by their moves sorted by action, read through np.memmap: a lookup reads a few records, whatever the size
+of the book. Parallel processes merge their games into the same book under a lock.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.book
+    python -m pytablut.book --merge node1/model/book.bin node2/model/book.bin
+"""
+import argparse
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+import pytablut.actionspace as actionspace
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.evalcache import canonical_transform
+
+MAGIC = b'TABLBOOK'
+HEADER = np.dtype([('magic', 'S8'), ('positions', '<u8'), ('slots', '<u8'), ('moves', '<u8')])
+# key 0 marks an empty slot, start and count locate the moves of the position
+SLOT = np.dtype([('key', '<u8'), ('start', '<u8'), ('count', '<u4'), ('visits', '<f4')])
+MOVE = np.dtype([('action', '<u2'), ('N', '<f4'), ('W', '<f4')])
+# statistics of one action of one position, the form in which books are merged
+ROW = np.dtype([('key', '<u8'), ('action', '<u2'), ('N', '<f8'), ('W', '<f8')])
+
+
+def position_key(state) -> (int, int):
+    """
+    :return: 64 bit hash of the canonical position, never 0,
+    and the symmetry mapping the board of the state to the canonical one
+    """
+    key, symmetry = canonical_transform(state.board, state.turn)
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1, symmetry
+
+
+def rows(state, actions, N, W) -> np.ndarray:
+    """
+    :param N: visits of the actions of the state
+    :param W: total values of the actions, for the player to move in the state
+    :return: ROW records of the visited actions, in the canonical orientation
+    """
+    key, symmetry = position_key(state)
+    records = np.zeros(len(actions), dtype=ROW)
+    records['key'] = key
+    records['action'] = actionspace.transform_indexes(actionspace.action_indexes(actions), symmetry)
+    records['N'] = N
+    records['W'] = W
+    return records[records['N'] > 0]
+
+
+class OpeningBook:
+
+    def __init__(self, file: str = cfg.BOOK_FILE):
+        """
+        read only view of a book, empty if the file does not exist.
+        The view stays valid when the file is replaced by a merge, a new one sees the merged statistics
+        """
+        self.file = file
+        self.positions = 0
+        self.slots = np.zeros(0, dtype=SLOT)
+        self.moves = np.zeros(0, dtype=MOVE)
+        if file is None or not os.path.exists(file):
+            return
+        header = np.fromfile(file, dtype=HEADER, count=1)
+        if len(header) == 0 or header[0]['magic'] != MAGIC:
+            raise ValueError('{} is not an opening book'.format(file))
+        self.positions, slots, moves = (int(header[0][field]) for field in ('positions', 'slots', 'moves'))
+        if slots > 0:
+            self.slots = np.memmap(file, dtype=SLOT, mode='r', offset=HEADER.itemsize, shape=(slots,))
+        if moves > 0:
+            self.moves = np.memmap(file, dtype=MOVE, mode='r', offset=HEADER.itemsize + slots * SLOT.itemsize,
+                                   shape=(moves,))
+
+    def __len__(self):
+        return self.positions
+
+    def _find(self, key: int):
+        """ :return: the slot of the position, None if it is not in the book """
+        if len(self.slots) == 0:
+            return None
+        mask = len(self.slots) - 1
+        i = key & mask
+        # the table is at most half full, so the probing ends on an empty slot
+        while True:
+            slot = self.slots[i]
+            if slot['key'] == 0:
+                return None
+            if slot['key'] == key:
+                return slot
+            i = (i + 1) & mask
+
+    def lookup(self, state) -> (np.ndarray, np.ndarray):
+        """
+        :return: np.array with the visits and one with the total values of the actions, in the order of state.actions,
+        0 for the actions not in the book. None if the position is not in the book
+        """
+        key, symmetry = position_key(state)
+        slot = self._find(key)
+        if slot is None:
+            return None
+        start, count = int(slot['start']), int(slot['count'])
+        moves = self.moves[start:start + count]
+        canonical = actionspace.transform_indexes(actionspace.action_indexes(state.actions), symmetry)
+        position = np.minimum(np.searchsorted(moves['action'], canonical), count - 1)
+        found = moves['action'][position] == canonical
+        return (np.where(found, moves['N'][position], 0.).astype(np.float64),
+                np.where(found, moves['W'][position], 0.).astype(np.float64))
+
+    def to_rows(self) -> np.ndarray:
+        """ :return: all the statistics of the book as ROW records """
+        used = self.slots[self.slots['key'] != 0]
+        used = used[np.argsort(used['start'])]
+        records = np.zeros(len(self.moves), dtype=ROW)
+        records['key'] = np.repeat(used['key'], used['count'])
+        records['action'] = self.moves['action']
+        records['N'] = self.moves['N']
+        records['W'] = self.moves['W']
+        return records
+
+    def summary(self) -> dict:
+        visits = self.slots['visits'][self.slots['key'] != 0]
+        return {'positions': self.positions, 'moves': len(self.moves),
+                'size_bytes': HEADER.itemsize + self.slots.nbytes + self.moves.nbytes,
+                'visits': float(np.sum(visits)), 'max_visits': float(np.max(visits)) if len(visits) else 0.}
+
+
+def write(records: np.ndarray, file: str, max_positions: int = cfg.BOOK_MAX_POSITIONS) -> int:
+    """
+    sums the statistics of the same action of the same position and writes them as a book, replacing file
+    :param max_positions: the least visited positions beyond this are dropped
+    :return: number of positions written
+    """
+    records = records[np.lexsort((records['action'], records['key']))]
+    if len(records):
+        first = np.ones(len(records), dtype=bool)
+        first[1:] = (records['key'][1:] != records['key'][:-1]) | (records['action'][1:] != records['action'][:-1])
+        starts = np.flatnonzero(first)
+        merged = records[starts]
+        merged['N'] = np.add.reduceat(records['N'], starts)
+        merged['W'] = np.add.reduceat(records['W'], starts)
+    else:
+        merged = records
+    keys, key_starts, counts = np.unique(merged['key'], return_index=True, return_counts=True)
+    visits = np.add.reduceat(merged['N'], key_starts) if len(keys) else np.zeros(0)
+    if len(keys) > max_positions:
+        kept = keys[np.argsort(-visits, kind='stable')[:max_positions]]
+        merged = merged[np.isin(merged['key'], kept)]
+        keys, key_starts, counts = np.unique(merged['key'], return_index=True, return_counts=True)
+        visits = np.add.reduceat(merged['N'], key_starts)
+
+    size = 1 << int(np.ceil(np.log2(2 * len(keys)))) if len(keys) else 0
+    table = np.zeros(size, dtype=SLOT)
+    mask = size - 1
+    for key, start, count, n in zip(keys.tolist(), key_starts.tolist(), counts.tolist(), visits.tolist()):
+        i = key & mask
+        while table['key'][i] != 0:
+            i = (i + 1) & mask
+        table[i] = (key, start, count, n)
+    moves = np.zeros(len(merged), dtype=MOVE)
+    moves['action'] = merged['action']
+    moves['N'] = merged['N']
+    moves['W'] = merged['W']
+
+    os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.array([(MAGIC, len(keys), size, len(moves))], dtype=HEADER).tofile(f)
+        table.tofile(f)
+        moves.tofile(f)
+    os.replace(tmp, file)
+    return len(keys)
+
+
+@contextmanager
+def _lock(file: str):
+    os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+    with open(file + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def merge(records: np.ndarray, file: str = cfg.BOOK_FILE, max_positions: int = cfg.BOOK_MAX_POSITIONS) -> int:
+    """
+    adds ROW records to the book, creating it if it does not exist
+    :return: number of positions of the book
+    """
+    with _lock(file):
+        positions = write(np.concatenate([OpeningBook(file).to_rows(), records]), file, max_positions)
+    lg.logger_player.info('MERGED {} MOVES INTO THE BOOK, {} POSITIONS'.format(len(records), positions))
+    return positions
+
+
+if __name__ == '__main__':
+    from pytablut.game import Game
+
+    parser = argparse.ArgumentParser(description='Inspect the opening book or merge other books into it.')
+    parser.add_argument('-b', '--book', type=str, default=cfg.BOOK_FILE,
+                        help='book file')
+    parser.add_argument('--merge', type=str, nargs='+', default=[],
+                        help='books to add to it, e.g. the ones of other hosts')
+    parser.add_argument('--top', type=int, default=5,
+                        help='moves of the initial position to show')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge(np.concatenate([OpeningBook(file).to_rows() for file in args.merge]), args.book)
+    book = OpeningBook(args.book)
+    print(', '.join('{} {}'.format(k, v) for k, v in book.summary().items()))
+    state = Game().current_state
+    stats = book.lookup(state)
+    if stats is not None:
+        N, W = stats
+        for i in np.argsort(-N)[:args.top]:
+            if N[i] > 0:
+                action = [[int(x) for x in cell] for cell in state.actions[i]]
+                print('{} N {:.0f} Q {:+.3f}'.format(action, N[i], W[i] / N[i]))
@@ -0,0 +1,48 @@
+"""
+Publication of the versions of the network.
+A version is published only after all its files are written, by replacing LATEST_MODEL_FILE,
+so the self-play workers reading it between two games never load a partially written model.
+"""
+import json
+import os
+import time
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+
+
+def latest_version(file: str = cfg.LATEST_MODEL_FILE):
+    """ :return: the newest published version, None if no version was published """
+    try:
+        with open(file) as f:
+            return json.load(f)['version']
+    except FileNotFoundError:
+        return None
+
+
+def publish(version: int, file: str = cfg.LATEST_MODEL_FILE):
+    """ makes version the newest one, the file is replaced atomically """
+    tmp = file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': version, 'time': time.time()}, f)
+    os.replace(tmp, file)
+    lg.logger_nnet.info('PUBLISHED MODEL v{}'.format(version))
+
+
+def save(brain, version: int, backends=cfg.EXPORT_BACKENDS, promote: bool = True):
+    """
+    saves a ResidualNN with the given version, exports it for the other backends and publishes it
+    :param backends: "numpy", "int8" or "float16", see Player
+    :param promote: publish the version, False when it has to pass the arena first
+    """
+    brain.save(version)
+    for backend in backends:
+        if backend == 'numpy':
+            brain.export_numpy(version)
+        elif backend in ('int8', 'float16'):
+            from pytablut.quantize import convert
+            convert(version, backend)
+        else:
+            raise ValueError(f'wrong backend: {backend}')
+    if promote:
+        publish(version)
@@ -6,6 +6,10 @@ Configuration parameters
 EPISODES = 100
 MCTS_SIMULATIONS = 500
 MEMORY_SIZE = 100000
+REPLAY_DIR = 'memories/replay/'
+POLICY_TARGET_SIZE = 128  # actions stored for each policy target in the replay buffer
+DATASET_DIR = 'memories/dataset/'
+SHARD_SIZE = 50000  # positions of a compacted shard of the dataset
 TURNS_BEFORE_TAU0 = 0
 CPUCT = 1.3
 EPSILON = 0.25
@@ -14,14 +18,43 @@ TIMEOUT = 60
 TAU = 5
 TAU_ALPHA = 0.5
 MAX_MOVES = 10
+MAX_TREE_NODES = 50000  # each node takes roughly 15 KB
+PRUNE_RATIO = 0.75  # fraction of MAX_TREE_NODES kept after pruning
+NN_BATCH_SIZE = 16  # leaves evaluated together by the network
+NN_BATCH_WAIT = 0.05  # maximum seconds a leaf waits for its batch to fill up
+VIRTUAL_LOSS = 1
+NN_CACHE_SIZE = 200000  # network values kept in the evaluation cache
+
+# PARALLEL SELF-PLAY
+SELF_PLAY_WORKERS = 4
+SELF_PLAY_RESTARTS = 10  # crashed workers restarted before giving up
+SELF_PLAY_JOIN_TIMEOUT = 30  # seconds given to the workers to stop before terminating them
+INFERENCE_SERVER = True  # the workers share one network, evaluated by an inference server process
+INFERENCE_MAX_BATCH = 256  # positions the server collects before evaluating them
+INFERENCE_MAX_WAIT = 0.002  # maximum seconds the first request of a batch waits for the others
+INFERENCE_TIMEOUT = 60  # seconds a worker waits for an answer before assuming the server is dead
+INFERENCE_VERSIONS = 2  # versions of the network kept by the server while the workers move to the newest
+LOCKSTEP_GAMES = 0  # games advanced together by a single process sharing the network calls, 0 uses the workers
+
+# ALPHA-BETA SEARCH
+AB_MAX_DEPTH = 32
+TT_SIZE = 1000000
+ZOBRIST_SEED = 42
+
+# PROOF NUMBER SEARCH
+PN_NODES = 3000
+PN_MAX_DEPTH = 5
+PN_ATTACKERS = 3
+PN_TIME_SHARE = 0.25  # fraction of the time of a move the solver may take, the rest is left to the search
 
 # NETWORK TRAINING AND HYPERPARAMETERS
 BATCH_SIZE = 128
+PREFETCH_BATCHES = 4  # batches prepared in background while the network trains
 EPOCHS = 5
 REG_CONST = 0.0001
 LEARNING_RATE = 0.01
 MOMENTUM = 0.9
-TRAINING_LOOPS = 50
+TRAINING_LOOPS = 50  # batches of each training epoch
 IN_SHAPE = (9, 9, 4)
 OUT_SHAPE = (9, 9, 32)
 
@@ -40,6 +73,44 @@ HIDDEN_LAYERS = [
 
 TOTAL_ITERATIONS = 1000
 
+# ASYNCHRONOUS TRAINING
+ASYNC_TRAINING = False  # train while the workers play, instead of alternating self-play and training
+LATEST_MODEL_FILE = 'model/brain/latest.json'  # version of the newest published model
+EXPORT_BACKENDS = ['numpy']  # formats written with every published model, besides the keras one
+TRAINING_MIN_POSITIONS = 10000  # positions in the dataset before the first training
+TRAINING_NEW_POSITIONS = 5000  # new positions between two trainings
+TRAINER_POLL = 10  # seconds between two checks of the dataset
+
+# GATING
+GATING = True  # a new version plays self-play only after beating the published one in the arena
+GATING_ELO = 35  # Elo gain the sequential test tries to detect, against no gain
+GATING_ALPHA = 0.05  # probability of promoting a version that is not stronger
+GATING_BETA = 0.05  # probability of rejecting a version GATING_ELO stronger
+GATING_MAX_GAMES = 400  # the candidate is rejected when the test is still undecided after these games
+GATING_WORKERS = 4
+GATING_SIMULATIONS = 200  # simulations of each move of the arena games
+GATING_OPENING_MOVES = 4  # random moves opening each pair of games, played once with each color
+GATING_MAX_MOVES = 200  # longer games are draws
+ARENA_FILE = 'model/brain/arena.jsonl'  # results of every gating
+
+# DISTRIBUTED SELF-PLAY
+COORDINATOR_ADDRESS = ('localhost', 6000)  # where the coordinator listens, next to the trainer
+COORDINATOR_AUTHKEY_ENV = 'PYTABLUT_AUTHKEY'  # environment variable with the secret shared by the coordinator and the nodes
+COORDINATOR_AUTHKEY = b'pytablut'  # public key used when the variable is not set, accepted only on localhost
+COORDINATOR_MAX_LAG = 1  # games of versions older than the newest one by more than this are rejected
+COORDINATOR_POLL = 10  # seconds between two checks for a new version on the nodes
+COORDINATOR_MAX_BACKOFF = 30  # maximum seconds between two attempts to reconnect to the coordinator
+
+# OPENING BOOK
+BOOK_FILE = 'model/book.bin'  # visits and values of the first moves, None to play without a book
+BOOK_RECORD = False  # add the statistics of the searches of the first BOOK_TURNS moves to the book
+BOOK_TURNS = 4  # moves of each player recorded and looked up in the book
+BOOK_MIN_VISITS = 1000  # visits of a position before its statistics seed the root of the search
+BOOK_INSTANT_VISITS = 20000  # visits of a position before its most visited move is played without searching
+BOOK_SEED_VISITS = 500  # visits the statistics of the book are scaled down to when seeding the root
+BOOK_MAX_POSITIONS = 20000  # the least visited positions are dropped beyond this
+
 # OTHER
 VERBOSE = 1
+PROFILE_FILE = 'logs/profile.jsonl'  # per move search statistics, None to disable
 CURRENT_VERSION = 0
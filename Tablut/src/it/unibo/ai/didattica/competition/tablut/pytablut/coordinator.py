@@ -0,0 +1,348 @@
+"""
+Coordinator of a self-play run spread over several hosts.
+It runs next to the trainer: it hands the published versions of the network to the self-play nodes
+and writes the games they send into the dataset. Every game carries a unique id, so a game sent again after
+a reconnection is stored once, and the version that played it, so games of models older than
+COORDINATOR_MAX_LAG versions are rejected. Connections use multiprocessing.connection over TCP,
+authenticated with the secret in the environment variable COORDINATOR_AUTHKEY_ENV. The messages are pickles,
+so whoever knows the key can run code on the other side: the public default key only works on localhost.
+Run it from the folder containing pytablut, and the nodes with train.py, e.g.
+
+    PYTABLUT_AUTHKEY=<secret> python -m pytablut.coordinator --host 0.0.0.0 --port 6000
+    PYTABLUT_AUTHKEY=<secret> python -m pytablut.train --coordinator trainhost:6000
+"""
+import argparse
+import ipaddress
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import pytablut.checkpoints as checkpoints
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.dataset import Dataset
+
+
+def parse_address(address: str) -> tuple:
+    """ :return: (host, port) from 'host:port' """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def get_authkey() -> bytes:
+    """ :return: the key in the environment variable COORDINATOR_AUTHKEY_ENV, the public default one if it is not set """
+    key = os.environ.get(cfg.COORDINATOR_AUTHKEY_ENV)
+    return key.encode() if key else cfg.COORDINATOR_AUTHKEY
+
+
+def is_loopback(host: str) -> bool:
+    """ :return: whether all the addresses of host are on the loopback interface """
+    if not host:
+        return False
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback for info in infos)
+
+
+def check_authkey(host: str, authkey: bytes):
+    """ the default key is in the repository, with it anybody reaching the port could run code on the other side """
+    if authkey == cfg.COORDINATOR_AUTHKEY and not is_loopback(host):
+        raise ValueError('the default authkey only works on localhost, set {} to a secret shared by the coordinator '
+                         'and its nodes to use {}'.format(cfg.COORDINATOR_AUTHKEY_ENV, host))
+
+
+def model_files(version: int, backend: str) -> list:
+    """ :return: the files a Player with the given backend loads """
+    if backend == 'numpy':
+        return ['model/brain/v{}.npz'.format(version)]
+    if backend in ('int8', 'float16'):
+        from pytablut.quantize import model_file
+        return [model_file(version, backend)]
+    return ['model/brain/v{}.h5'.format(version)]
+
+
+class Coordinator:
+
+    def __init__(self, address=cfg.COORDINATOR_ADDRESS, dataset_path: str = cfg.DATASET_DIR,
+                 authkey: bytes = None, max_lag: int = cfg.COORDINATOR_MAX_LAG):
+        """
+        :param address: (host, port) to listen on, port 0 picks a free one
+        :param authkey: secret shared with the nodes, by default the one of get_authkey
+        :param max_lag: games played by a version older than the newest one by more than this are rejected
+        """
+        self.address = address
+        self.authkey = authkey if authkey is not None else get_authkey()
+        self.max_lag = max_lag
+        self.dataset = Dataset(dataset_path)
+        # ids of the stored games, kept with the dataset so that duplicates are detected across restarts
+        self.games_file = os.path.join(dataset_path, 'games.txt')
+        self.seen = set()
+        if os.path.exists(self.games_file):
+            with open(self.games_file) as f:
+                self.seen = {line.strip() for line in f if line.strip()}
+        self.lock = threading.Lock()
+        self.listener = None
+        self.begin = None
+        self.stats = {'accepted': 0, 'duplicates': 0, 'stale': 0, 'positions': 0, 'nodes': {}}
+
+    def start(self):
+        """ starts listening, self.address is then the actual address """
+        check_authkey(self.address[0], self.authkey)
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.listener.address
+        self.begin = time.perf_counter()
+        lg.logger_train.info('COORDINATOR LISTENING ON {}:{}'.format(*self.address))
+        return self
+
+    def serve_forever(self):
+        """ accepts the nodes until close is called, each connection is served by its own thread """
+        if self.listener is None:
+            self.start()
+        listener = self.listener
+        while self.listener is not None:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                if self.listener is not None:
+                    # e.g. a wrong authkey, the other connections are not affected
+                    lg.logger_train.warning('REFUSED CONNECTION', exc_info=True)
+                continue
+            if self.listener is None:
+                conn.close()
+                break
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            # closing the listener does not wake up accept, a connection does
+            try:
+                socket.create_connection(self.address, timeout=1.).close()
+            except OSError:
+                pass
+            listener.close()
+
+    def _handle(self, conn):
+        node = None
+        try:
+            while True:
+                message = conn.recv()
+                try:
+                    answer = self._answer(node, message)
+                except Exception:
+                    # the node would send a malformed message again forever if it got no answer
+                    lg.logger_train.error('BAD MESSAGE FROM NODE {}'.format(node), exc_info=True)
+                    answer = 'error', traceback.format_exc()
+                if message[0] == 'hello':
+                    node = message[1]
+                    lg.logger_train.info('NODE {} CONNECTED'.format(node))
+                conn.send(answer)
+        except (EOFError, OSError):
+            lg.logger_train.info('NODE {} DISCONNECTED'.format(node))
+        finally:
+            conn.close()
+
+    def _answer(self, node: str, message: tuple) -> tuple:
+        kind = message[0]
+        if kind in ('hello', 'latest'):
+            return kind, checkpoints.latest_version()
+        if kind == 'model':
+            return self._model(*message[1:])
+        if kind == 'game':
+            return self._game(node, *message[1:])
+        if kind == 'stats':
+            return 'stats', self.summary()
+        return 'error', 'unknown message {}'.format(kind)
+
+    def _model(self, version: int, backend: str) -> tuple:
+        files = {}
+        for file in model_files(version, backend):
+            if not os.path.exists(file):
+                return 'missing', None
+            with open(file, 'rb') as f:
+                files[os.path.basename(file)] = f.read()
+        return 'model', files
+
+    def _game(self, node: str, game: str, version: int, positions: dict) -> tuple:
+        """ stores a game unless it is a duplicate or it was played by a stale version """
+        latest = checkpoints.latest_version()
+        with self.lock:
+            if game in self.seen:
+                status = 'duplicate'
+            elif version is None or (latest is not None and version < latest - self.max_lag):
+                status = 'stale'
+            else:
+                status = 'accepted'
+                self.dataset.append(positions, version=version)
+                with open(self.games_file, 'a') as f:
+                    f.write(game + '\n')
+                self.seen.add(game)
+                self.stats['positions'] += len(positions['values'])
+                self.stats['nodes'][node] = self.stats['nodes'].get(node, 0) + 1
+            self.stats['duplicates' if status == 'duplicate' else status] += 1
+            lg.logger_train.info('GAME {} OF NODE {} WITH MODEL v{}: {}, {} GAMES, {:.1f} GAMES PER HOUR'.format(
+                game, node, version, status.upper(), self.stats['accepted'],
+                self.stats['accepted'] / (time.perf_counter() - self.begin) * 3600))
+        return status, latest
+
+    def summary(self) -> dict:
+        with self.lock:
+            elapsed = time.perf_counter() - self.begin
+            return dict(self.stats, nodes=dict(self.stats['nodes']), elapsed=elapsed,
+                        games_per_hour=self.stats['accepted'] / elapsed * 3600)
+
+
+class CoordinatorClient:
+
+    def __init__(self, address=cfg.COORDINATOR_ADDRESS, authkey: bytes = None, node: str = None):
+        """
+        connection of a node to the coordinator, re-established whenever it drops
+        :param authkey: secret shared with the coordinator, by default the one of get_authkey
+        :param node: name of the node in the statistics of the coordinator
+        """
+        self.address = tuple(address)
+        self.authkey = authkey if authkey is not None else get_authkey()
+        # a fake coordinator could run code on the node and write its files
+        check_authkey(self.address[0], self.authkey)
+        self.node = node if node is not None else '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.conn = None
+
+    def _connect(self):
+        delay = 1.
+        while True:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                conn.send(('hello', self.node))
+                conn.recv()
+                return conn
+            except (OSError, EOFError):
+                lg.logger_train.warning('COORDINATOR {}:{} UNREACHABLE, RETRYING IN {:.0f} s'.format(
+                    *self.address, delay))
+                time.sleep(delay)
+                delay = min(2 * delay, cfg.COORDINATOR_MAX_BACKOFF)
+
+    def call(self, *message):
+        """ sends a message and waits for the answer, reconnecting and sending it again if the connection drops """
+        while True:
+            if self.conn is None:
+                self.conn = self._connect()
+            try:
+                self.conn.send(message)
+                answer = self.conn.recv()
+                break
+            except (OSError, EOFError):
+                lg.logger_train.warning('CONNECTION TO THE COORDINATOR LOST')
+                self.close()
+        if answer[0] == 'error':
+            raise RuntimeError('the coordinator could not handle {}:\n{}'.format(message[0], answer[1]))
+        return answer
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class RemoteDataset:
+
+    def __init__(self, address=cfg.COORDINATOR_ADDRESS, authkey: bytes = None):
+        """
+        takes the place of the Dataset on the nodes: the games are sent to the coordinator
+        """
+        self.client = CoordinatorClient(address, authkey)
+
+    def append(self, positions: dict, games: int = 1, version: int = None) -> str:
+        """
+        :return: 'accepted', 'duplicate' if the game was already stored or 'stale' if its version is too old
+        """
+        # the id stays the same if the game is sent again after a reconnection
+        game = uuid.uuid4().hex
+        status, latest = self.client.call('game', game, version, positions)
+        if status == 'stale':
+            lg.logger_memory.warning('GAME OF MODEL v{} REJECTED, THE NEWEST IS v{}'.format(version, latest))
+        else:
+            lg.logger_memory.info('GAME {} SENT TO THE COORDINATOR: {}'.format(game, status.upper()))
+        return status
+
+
+def sync(client: CoordinatorClient, backend: str = 'keras'):
+    """
+    downloads the newest version published on the coordinator, if it is newer than the local one,
+    and publishes it locally, where the self-play workers pick it up
+    :return: the newest version, None if the coordinator has none
+    """
+    _, latest = client.call('latest')
+    local = checkpoints.latest_version()
+    if latest is None or (local is not None and local >= latest):
+        return latest
+    status, files = client.call('model', latest, backend)
+    if status != 'model':
+        lg.logger_train.warning('MODEL v{} ({}) NOT AVAILABLE ON THE COORDINATOR'.format(latest, backend))
+        return local
+    expected = {os.path.basename(file) for file in model_files(latest, backend)}
+    if set(files) != expected:
+        raise RuntimeError('the coordinator sent {} instead of {}'.format(sorted(files), sorted(expected)))
+    os.makedirs('model/brain', exist_ok=True)
+    for name, data in files.items():
+        file = os.path.join('model/brain', name)
+        with open(file + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(file + '.tmp', file)
+    checkpoints.publish(latest)
+    lg.logger_train.info('DOWNLOADED MODEL v{} FROM THE COORDINATOR'.format(latest))
+    return latest
+
+
+def follow(address, backend: str, stop, authkey: bytes = None):
+    """
+    keeps the local models in sync with the coordinator until stop is set.
+    A failed sync is retried at the next poll, a rejected authkey sets stop: the node cannot get new models anymore
+    """
+    client = CoordinatorClient(address, authkey)
+    try:
+        while not stop.wait(cfg.COORDINATOR_POLL):
+            try:
+                sync(client, backend)
+            except AuthenticationError:
+                lg.logger_train.error('THE COORDINATOR REJECTED THE AUTHKEY, STOPPING THE NODE', exc_info=True)
+                stop.set()
+            except Exception:
+                lg.logger_train.error('MODEL SYNC FAILED, RETRYING IN {:.0f} s'.format(cfg.COORDINATOR_POLL),
+                                      exc_info=True)
+                client.close()
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect the self-play games of several hosts.')
+    parser.add_argument('-H', '--host', type=str, default=cfg.COORDINATOR_ADDRESS[0],
+                        help='interface to listen on, 0.0.0.0 for all of them')
+    parser.add_argument('-p', '--port', type=int, default=cfg.COORDINATOR_ADDRESS[1],
+                        help='port to listen on')
+    parser.add_argument('-d', '--dataset', type=str, default=cfg.DATASET_DIR,
+                        help='folder of the dataset the games are written to')
+    parser.add_argument('--max-lag', type=int, default=cfg.COORDINATOR_MAX_LAG,
+                        help='versions a game may be behind the newest one')
+    args = parser.parse_args()
+
+    coordinator = Coordinator((args.host, args.port), args.dataset, max_lag=args.max_lag)
+    try:
+        coordinator.start()
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        coordinator.serve_forever()
+    except KeyboardInterrupt:
+        coordinator.close()
+        result = coordinator.summary()
+        print('{} games accepted, {} duplicates, {} stale, {:.1f} games per hour'.format(
+            result['accepted'], result['duplicates'], result['stale'], result['games_per_hour']))
+        print(', '.join('{} {}'.format(node, games) for node, games in result['nodes'].items()))
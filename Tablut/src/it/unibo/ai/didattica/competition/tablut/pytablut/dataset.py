@@ -0,0 +1,206 @@
+"""
+Append-only sharded storage of all the positions played in self-play.
+Every finished game is written as a compressed .npz shard, with the same arrays as the ReplayBuffer,
+and a line with its name and size is appended to index.jsonl. Shards are never modified:
+compaction streams the small shards into bigger ones and then swaps the index. Only the last shard is left
+small, so its cost depends on the games written since the previous compaction, not on the size of the dataset.
+Readers go through the index and load only the shards they need.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.dataset --compact
+    python -m pytablut.dataset --import memories/dataset.pkl
+"""
+import argparse
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+
+FIELDS = ('boards', 'turns', 'values', 'policy_indexes', 'policy_probs')
+
+
+class Dataset:
+
+    def __init__(self, path: str = cfg.DATASET_DIR):
+        """
+        :param path: folder of the shards and of the index, created if it does not exist
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, 'index.jsonl')
+        self.lock_file = os.path.join(path, 'index.lock')
+
+    @contextmanager
+    def _lock(self):
+        """ the index is shared by the self-play processes appending to it and by the compaction """
+        with open(self.lock_file, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def entries(self) -> list:
+        """
+        :return: the index, one dict with the keys 'shard', 'positions' and 'games' for each shard, oldest first,
+        and 'versions', the lowest and highest version of the models that played its games, when they are known
+        """
+        if not os.path.exists(self.index_file):
+            return []
+        with open(self.index_file) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def __len__(self):
+        return sum(entry['positions'] for entry in self.entries())
+
+    def _write_shard(self, positions: dict, games: int, versions: list = None) -> dict:
+        # the name is unique among the processes writing at the same time
+        name = 'shard-{}-{}.npz'.format(time.time_ns(), os.getpid())
+        np.savez_compressed(os.path.join(self.path, name), **{field: positions[field] for field in FIELDS})
+        entry = {'shard': name, 'positions': len(positions['values']), 'games': games}
+        if versions is not None:
+            entry['versions'] = versions
+        return entry
+
+    def append(self, positions: dict, games: int = 1, version: int = None):
+        """
+        writes the positions as a new shard
+        :param positions: dict with the arrays of FIELDS, as returned by ReplayBuffer.get
+        :param games: number of games the positions come from
+        :param version: version of the model that played the games, None if unknown
+        """
+        if len(positions['values']) == 0:
+            return
+        entry = self._write_shard(positions, games, [version, version] if version is not None else None)
+        with self._lock():
+            with open(self.index_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        lg.logger_memory.info('WRITTEN SHARD {} WITH {} POSITIONS'.format(entry['shard'], entry['positions']))
+
+    def load(self, entry: dict) -> dict:
+        """ :return: the arrays of a shard """
+        with np.load(os.path.join(self.path, entry['shard'])) as shard:
+            return {field: shard[field] for field in FIELDS}
+
+    def _recent(self, positions: int = None) -> list:
+        """ :return: the newest entries holding at least the given number of positions, all if None """
+        entries = self.entries()
+        if positions is None:
+            return entries
+        total = 0
+        for i in range(len(entries) - 1, -1, -1):
+            total += entries[i]['positions']
+            if total >= positions:
+                return entries[i:]
+        return entries
+
+    def iterate(self, positions: int = None):
+        """
+        :param positions: only the newest shards holding at least this many positions are read, None reads all
+        :return: generator of the arrays of the shards, oldest first, one shard in memory at a time
+        """
+        for entry in self._recent(positions):
+            yield self.load(entry)
+
+    def sample(self, n: int, rng: np.random.Generator = None, positions: int = None) -> dict:
+        """
+        draws n positions uniformly with replacement, loading only the shards they fall into
+        :param positions: sample only among the newest shards holding at least this many positions
+        :return: dict with the arrays of FIELDS
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        entries = self._recent(positions)
+        sizes = np.array([entry['positions'] for entry in entries])
+        draws = rng.integers(0, np.sum(sizes), size=n)
+        shard_of = np.searchsorted(np.cumsum(sizes), draws, side='right')
+        rows = draws - (np.cumsum(sizes) - sizes)[shard_of]
+        parts = []
+        for shard in np.unique(shard_of):
+            data = self.load(entries[shard])
+            selected = rows[shard_of == shard]
+            parts.append({field: data[field][selected] for field in FIELDS})
+        return {field: np.concatenate([part[field] for part in parts]) for field in FIELDS}
+
+    def compact(self, shard_size: int = cfg.SHARD_SIZE) -> int:
+        """
+        merges all the shards smaller than shard_size, oldest first, streaming them into new shards of about
+        shard_size positions, so that at most one output shard and one input shard are in memory.
+        At most one small shard is left, the last one, that the next compaction fills up with the new games,
+        so each compaction only reads the shards written since the previous one and that partial shard
+        :return: number of shards removed
+        """
+        with self._lock():
+            entries = self.entries()
+            small = [i for i, entry in enumerate(entries) if entry['positions'] < shard_size]
+            if len(small) < 2:
+                return 0
+            # each merged shard takes the place of the newest of its inputs, the index stays in playing order
+            merged = {}
+            parts, count, games, versions = [], 0, 0, []
+            for i in small:
+                entry = entries[i]
+                parts.append(self.load(entry))
+                count += entry['positions']
+                games += entry['games']
+                versions.extend(entry.get('versions', []))
+                if count >= shard_size:
+                    merged[i] = self._merge(parts, games, versions)
+                    parts, count, games, versions = [], 0, 0, []
+            if parts:
+                merged[small[-1]] = self._merge(parts, games, versions)
+            removed = set(small)
+            index = [merged[i] if i in merged else entry for i, entry in enumerate(entries)
+                     if i not in removed or i in merged]
+            tmp = self.index_file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in index)
+            os.replace(tmp, self.index_file)
+            for i in small:
+                os.remove(os.path.join(self.path, entries[i]['shard']))
+        lg.logger_memory.info('COMPACTED {} SHARDS INTO {}'.format(len(small), len(merged)))
+        return len(small) - len(merged)
+
+    def _merge(self, parts: list, games: int, versions: list) -> dict:
+        return self._write_shard({field: np.concatenate([part[field] for part in parts]) for field in FIELDS}, games,
+                                 [min(versions), max(versions)] if versions else None)
+
+
+def import_pickle(file: str, dataset: Dataset, policy_size: int = cfg.POLICY_TARGET_SIZE):
+    """ converts a dataset of pickled memories, as written by the old Memory class, into a shard """
+    import pickle
+
+    with open(file, 'rb') as f:
+        memories = list(pickle.load(f))
+    positions = {'boards': np.array([memory['state'].board for memory in memories], dtype=np.int8),
+                 'turns': np.array([memory['turn'] for memory in memories], dtype=np.int8),
+                 'values': np.array([memory['value'] for memory in memories], dtype=np.float32),
+                 'policy_indexes': np.full((len(memories), policy_size), -1, dtype=np.int16),
+                 'policy_probs': np.zeros((len(memories), policy_size), dtype=np.float32)}
+    dataset.append(positions, games=0)
+    return len(memories)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the self-play dataset.')
+    parser.add_argument('-p', '--path', type=str, default=cfg.DATASET_DIR,
+                        help='folder of the dataset')
+    parser.add_argument('-c', '--compact', action='store_true',
+                        help='merge the small shards')
+    parser.add_argument('-i', '--import', dest='import_file', type=str, default=None,
+                        help='pickled memories to add to the dataset')
+    args = parser.parse_args()
+
+    dataset = Dataset(args.path)
+    if args.import_file is not None:
+        print('imported', import_pickle(args.import_file, dataset), 'positions')
+    if args.compact:
+        print('removed', dataset.compact(), 'shards')
+    entries = dataset.entries()
+    print('{} shards, {} positions, {} games'.format(len(entries), sum(entry['positions'] for entry in entries),
+                                                      sum(entry['games'] for entry in entries)))
@@ -0,0 +1,151 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import pytablut.actionspace as actionspace
+import pytablut.config as cfg
+import pytablut.loggers as lg
+
+
+def canonical_transform(board: np.ndarray, turn: int) -> (bytes, int):
+    """
+    :return: the key of the position, see canonical_key, and the symmetry of actionspace.transform_board
+    mapping the board to the one the key was computed from
+    """
+    board = board.astype(np.int8)
+    key, symmetry = min((actionspace.transform_board(board, symmetry).tobytes(), symmetry) for symmetry in range(8))
+    return key + (b'w' if turn == 1 else b'b'), symmetry
+
+
+def canonical_key(board: np.ndarray, turn: int) -> bytes:
+    """
+    the rules of the game are invariant to rotations and reflections of the board,
+    so all the 8 symmetric positions share the same key
+    :return: bytes identifying the position up to symmetries
+    """
+    return canonical_transform(board, turn)[0]
+
+
+class EvaluationCache:
+
+    def __init__(self, size: int = cfg.NN_CACHE_SIZE):
+        """
+        least recently used cache of the values computed by the network
+        :param size: maximum number of values stored
+        """
+        self.size = size
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key: bytes):
+        """ :return: the cached value, None if the key is not in the cache """
+        value = self.values.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.values.move_to_end(key)
+        return value
+
+    def put(self, key: bytes, value: float):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        if len(self.values) > self.size:
+            self.values.popitem(last=False)
+            self.evictions += 1
+
+    def evaluate(self, states: list, predict_batch) -> np.ndarray:
+        """
+        :param states: states to evaluate
+        :param predict_batch: function evaluating a list of states, called only on the cache misses
+        :return: np.array with the values of the states
+        """
+        values = np.empty(len(states))
+        missing = dict()  # key -> indexes of the states with that key
+        for i, state in enumerate(states):
+            key = canonical_key(state.board, state.turn)
+            value = self.get(key)
+            if value is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                values[i] = value
+        if missing:
+            predicted = predict_batch([states[indexes[0]] for indexes in missing.values()])
+            for (key, indexes), value in zip(missing.items(), predicted):
+                self.put(key, float(value))
+                values[indexes] = value
+        return values
+
+    def evaluate_policy(self, states: list, predict_policy_batch) -> (np.ndarray, list):
+        """
+        like evaluate, for networks with a policy head.
+        The priors are stored for the canonical orientation of the board, so symmetric positions share them too
+        :param predict_policy_batch: function returning the values and the 9x9x32 policies of a list of states
+        :return: np.array with the values of the states and, for each state,
+        the np.array with the probabilities of its legal actions, in the order of state.actions
+        """
+        values = np.empty(len(states))
+        priors = [None] * len(states)
+        missing = dict()  # key -> symmetry and indexes of the states with that key
+        for i, state in enumerate(states):
+            key, symmetry = canonical_transform(state.board, state.turn)
+            entry = self.get(key)
+            if entry is None:
+                missing.setdefault(key, (symmetry, []))[1].append(i)
+            else:
+                values[i], priors[i] = self._unpack(entry, symmetry, state.actions)
+        if missing:
+            predicted, logits = predict_policy_batch([states[indexes[0]] for _, indexes in missing.values()])
+            for (key, (symmetry, indexes)), value, policy in zip(missing.items(), predicted, logits):
+                actions = states[indexes[0]].actions
+                state_priors = actionspace.legal_priors(policy, actions)
+                canonical = actionspace.transform_indexes(actionspace.action_indexes(actions), symmetry)
+                order = np.argsort(canonical)
+                entry = (float(value), canonical[order], state_priors[order].astype(np.float32))
+                self.put(key, entry)
+                for i in indexes:
+                    values[i], priors[i] = self._unpack(entry, symmetry, states[i].actions)
+        return values, priors
+
+    @staticmethod
+    def _unpack(entry: tuple, symmetry: int, actions) -> (float, np.ndarray):
+        """ :return: the value and the priors of the actions of a state whose board maps to the cached one """
+        value, canonical, priors = entry
+        position = np.searchsorted(canonical, actionspace.transform_indexes(actionspace.action_indexes(actions),
+                                                                            symmetry))
+        return value, priors[position]
+
+    def clear(self):
+        self.values.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self.values), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.}
+
+    def save(self, file: str):
+        import pickle
+
+        lg.logger_nnet.info('SAVING {} CACHED VALUES TO {}'.format(len(self.values), file))
+        with open(file, 'wb') as f:
+            pickle.dump(self.values, f)
+
+    @classmethod
+    def load(cls, file: str, size: int = cfg.NN_CACHE_SIZE):
+        """ :return: a cache filled with the values saved in file, an empty one if the file does not exist """
+        import pickle
+
+        cache = cls(size)
+        if os.path.exists(file):
+            with open(file, 'rb') as f:
+                for key, value in pickle.load(f).items():
+                    cache.put(key, value)
+            cache.evictions = 0
+            lg.logger_nnet.info('LOADED {} CACHED VALUES FROM {}'.format(len(cache), file))
+        return cache
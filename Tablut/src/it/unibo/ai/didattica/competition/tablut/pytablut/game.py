@@ -198,11 +198,31 @@ class State:
         Converts this state as input for the neural network
         :return: np.array of shape (9x9x4)
         """
-        black = np.where(self.board == -1, 1, 0)
-        white = np.where(self.board == 1, 1, 0)
-        king = np.where(self.board == 2, 1, 0)
-        if self.turn == -1:
-            turn = np.zeros((9, 9), dtype=int)
-        else:
-            turn = np.ones((9, 9), dtype=int)
-        return np.stack([black, white, king, turn], axis=2)
+        return encode_boards(self.board[np.newaxis], np.array([self.turn]),
+                             out=np.empty((1, 9, 9, 4), dtype=int))[0]
+
+
+def encode_boards(boards: np.ndarray, turns: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Converts a stack of boards as input for the neural network with a single vectorized pass,
+    the planes are black checkers, white checkers, king and player to move (1 for white)
+    :param boards: array of shape (N, 9, 9)
+    :param turns: array of shape (N,) with the players to move
+    :param out: optional buffer of shape (M, 9, 9, 4) with M >= N, reused to avoid allocations
+    :return: np.array of shape (N, 9, 9, 4), a view of out if it was given
+    """
+    n = len(boards)
+    if out is None:
+        out = np.empty((n, 9, 9, 4), dtype=np.float32)
+    out = out[:n]
+    np.equal(boards, -1, out=out[..., 0], casting='unsafe')
+    np.equal(boards, 1, out=out[..., 1], casting='unsafe')
+    np.equal(boards, 2, out=out[..., 2], casting='unsafe')
+    out[..., 3] = (np.asarray(turns) == 1)[:, np.newaxis, np.newaxis]
+    return out
+
+
+def encode_states(states: list, out: np.ndarray = None) -> np.ndarray:
+    """ same as encode_boards, taking a list of State objects """
+    return encode_boards(np.array([state.board for state in states]),
+                         np.array([state.turn for state in states]), out)
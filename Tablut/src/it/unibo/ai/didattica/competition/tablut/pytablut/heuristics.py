@@ -0,0 +1,68 @@
+"""
+Static knowledge about Tablut positions, shared by the search engines
+"""
+import numpy as np
+
+from pytablut.game import Game
+
+DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+# weights of the evaluation features, from white's point of view
+W_MATERIAL_WHITE = 1 / 8
+W_MATERIAL_BLACK = 1 / 16
+W_ESCAPE_ROUTE = 0.5
+W_KING_ATTACKER = 0.2
+W_KING_DISTANCE = 0.02
+
+
+def king_position(board: np.ndarray):
+    """ :return: (row, col) of the king, None if it has been captured """
+    king = np.argwhere(board == 2)
+    if king.size == 0:
+        return None
+    return tuple(king[0])
+
+
+def escape_routes(board: np.ndarray, king: tuple) -> list:
+    """
+    :return: list of escape cells the king can reach with a single move
+    """
+    routes = []
+    for dx, dy in DIRECTIONS:
+        x, y = king[0] + dx, king[1] + dy
+        last = None
+        while 0 <= x <= 8 and 0 <= y <= 8 and board[x, y] == 0 and (x, y) not in Game.citadels:
+            last = (x, y)
+            x, y = x + dx, y + dy
+        if last in Game.escapes:
+            routes.append(last)
+    return routes
+
+
+def king_attackers(board: np.ndarray, king: tuple) -> int:
+    """
+    :return: number of cells adjacent to the king that are hostile to it,
+    i.e. occupied by a black checker or belonging to a citadel
+    """
+    attackers = 0
+    for dx, dy in DIRECTIONS:
+        x, y = king[0] + dx, king[1] + dy
+        if 0 <= x <= 8 and 0 <= y <= 8 and (board[x, y] == -1 or (x, y) in Game.citadels):
+            attackers += 1
+    return attackers
+
+
+def evaluate(board: np.ndarray) -> float:
+    """
+    heuristic value of a non terminal board from white's point of view
+    :return: float, positive when white is ahead
+    """
+    king = king_position(board)
+    if king is None:
+        return -1.
+    material = W_MATERIAL_WHITE * np.count_nonzero(board == 1) - W_MATERIAL_BLACK * np.count_nonzero(board == -1)
+    routes = len(escape_routes(board, king))
+    attackers = king_attackers(board, king)
+    distance = min(abs(king[0] - e[0]) + abs(king[1] - e[1]) for e in Game.escapes)
+    value = material + W_ESCAPE_ROUTE * routes - W_KING_ATTACKER * attackers - W_KING_DISTANCE * distance
+    return float(np.clip(value, -0.99, 0.99))
@@ -0,0 +1,287 @@
+"""
+Inference server shared by the self-play workers.
+A single process holds the network, so that it is loaded once and evaluates the leaves of all the workers
+in the same forward pass. Each worker has a slot: shared memory blocks for its inputs, values and policy logits,
+and a pipe for the requests. The server waits for the first request, collects the others arriving within
+INFERENCE_MAX_WAIT seconds (or until INFERENCE_MAX_BATCH positions) and answers all of them with one batch.
+InferenceClient has the interface of the networks, so a Player uses it as its brain.
+Each request names the version of the network to use, the server loads the versions asked by its clients
+and keeps the newest ones, so the workers can move to a new version between two games.
+"""
+import random
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.game import encode_states
+
+
+def _views(blocks: list, capacity: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """ :return: the arrays of the inputs, values and policy logits of a slot, backed by its shared memory """
+    inputs, values, logits = blocks
+    return (np.ndarray((capacity,) + tuple(cfg.IN_SHAPE), dtype=np.float32, buffer=inputs.buf),
+            np.ndarray((capacity,), dtype=np.float32, buffer=values.buf),
+            np.ndarray((capacity,) + tuple(cfg.OUT_SHAPE), dtype=np.float32, buffer=logits.buf))
+
+
+class InferenceClient:
+
+    def __init__(self, slot: dict):
+        """
+        :param slot: one of InferenceServer.slots, the client must be the only user of its slot
+        """
+        self.conn = slot['conn']
+        self.capacity = slot['capacity']
+        self.has_policy = slot['has_policy']
+        self.version = slot['version']  # version of the network evaluating the requests
+        self.input_shape = cfg.IN_SHAPE
+        self.output_shape = cfg.OUT_SHAPE
+        self.blocks = [shared_memory.SharedMemory(name=name) for name in slot['blocks']]
+        self.inputs, self.values, self.logits = _views(self.blocks, self.capacity)
+        # ids of a new client of the slot never match the pending ones of a crashed worker that had it before
+        self.request = random.getrandbits(48) << 16
+
+    def _evaluate(self, states, policy: bool):
+        values = np.empty(len(states), dtype=np.float32)
+        logits = np.empty((len(states),) + tuple(self.output_shape), dtype=np.float32) if policy else None
+        for start in range(0, len(states), self.capacity):
+            chunk = states[start:start + self.capacity]
+            encode_states(chunk, self.inputs)
+            self.request += 1
+            self.conn.send((self.request, len(chunk), policy, self.version))
+            # answers to the requests of a crashed worker that had this slot before are skipped
+            answer = None
+            while answer != self.request:
+                if not self.conn.poll(cfg.INFERENCE_TIMEOUT):
+                    raise RuntimeError('no answer from the inference server')
+                answer = self.conn.recv()
+            values[start:start + len(chunk)] = self.values[:len(chunk)]
+            if policy:
+                logits[start:start + len(chunk)] = self.logits[:len(chunk)]
+        return values, logits
+
+    def predict(self, state):
+        """
+            :return: the value of the state
+        """
+        return self.predict_batch([state])[0]
+
+    def predict_batch(self, states):
+        """
+            :return: np.array with the values of the states
+        """
+        return self._evaluate(states, False)[0]
+
+    def predict_policy_batch(self, states):
+        """
+            :return: np.array with the values of the states and one with their 9x9x32 policy logits
+        """
+        return self._evaluate(states, True)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+
+
+def serve(nnet_ver: int, backend: str, slots: list, control, max_batch: int, max_wait: float):
+    """ main loop of the server process, see InferenceServer """
+    from pytablut.player import load_brain
+
+    try:
+        brains = {nnet_ver: load_brain(nnet_ver, backend)[0]}
+        control.send(('ready', brains[nnet_ver].has_policy))
+    except Exception:
+        control.send(('error', traceback.format_exc()))
+        return
+
+    blocks = [[shared_memory.SharedMemory(name=name) for name in slot['blocks']] for slot in slots]
+    views = [_views(slot_blocks, slot['capacity']) for slot_blocks, slot in zip(blocks, slots)]
+    clients = {slot['server_conn']: i for i, slot in enumerate(slots)}
+    # a batch holds at most one request of each client
+    stats = {'requests': 0, 'positions': 0, 'batches': 0, 'busy': 0., 'loads': 0,
+             'batch_sizes': np.zeros(sum(slot['capacity'] for slot in slots) + 1, dtype=np.int64)}
+    start = time.perf_counter()
+
+    def receive(conn, pending):
+        try:
+            request, n, policy, version = conn.recv()
+        except EOFError:
+            del clients[conn]
+            return
+        pending.append((conn, request, n, policy, version))
+
+    while True:
+        pending = []
+        for conn in wait(list(clients) + [control]):
+            if conn is not control and sum(p[2] for p in pending) >= max_batch:
+                # the requests left in the pipes go in the next batch
+                continue
+            if conn is control:
+                message = control.recv()
+                if message == 'stop':
+                    return
+                control.send(dict(summary(stats, time.perf_counter() - start), versions=sorted(brains)))
+            else:
+                receive(conn, pending)
+        # each client waits for its answer, so it sends at most one request per batch
+        deadline = time.perf_counter() + max_wait
+        while sum(p[2] for p in pending) < max_batch:
+            idle = [conn for conn in clients if all(conn is not p[0] for p in pending)]
+            remaining = deadline - time.perf_counter()
+            if not idle or remaining <= 0:
+                break
+            ready = wait(idle, remaining)
+            if not ready:
+                break
+            for conn in ready:
+                if sum(p[2] for p in pending) >= max_batch:
+                    break
+                receive(conn, pending)
+        if not pending:
+            continue
+
+        for version in sorted({p[4] for p in pending}):
+            brain = brains.get(version)
+            if brain is None:
+                brain = brains[version] = load_brain(version, backend)[0]
+                stats['loads'] += 1
+                lg.logger_nnet.info('INFERENCE SERVER LOADED MODEL v{}'.format(version))
+            evaluate(brain, [p for p in pending if p[4] == version], views, clients, stats)
+        # the clients move to the newest versions, the oldest ones are dropped
+        for old in sorted(brains)[:-cfg.INFERENCE_VERSIONS]:
+            del brains[old]
+
+
+def evaluate(brain, pending: list, views: list, clients: dict, stats: dict):
+    """ evaluates the inputs of the pending requests with one forward pass and answers them """
+    begin = time.perf_counter()
+    X = np.concatenate([views[clients[conn]][0][:n] for conn, _, n, _, _ in pending])
+    if any(policy for _, _, _, policy, _ in pending):
+        values, logits = brain.forward_policy(X)
+    else:
+        values, logits = brain.forward(X), None
+    offset = 0
+    for conn, request, n, policy, _ in pending:
+        _, client_values, client_logits = views[clients[conn]]
+        client_values[:n] = values[offset:offset + n]
+        if policy:
+            client_logits[:n] = logits[offset:offset + n]
+        offset += n
+        conn.send(request)
+    stats['busy'] += time.perf_counter() - begin
+    stats['requests'] += len(pending)
+    stats['positions'] += len(X)
+    stats['batches'] += 1
+    stats['batch_sizes'][len(X)] += 1
+
+
+def summary(stats: dict, elapsed: float) -> dict:
+    """ :return: throughput and batch sizes of the server """
+    sizes = stats['batch_sizes']
+    batches = max(stats['batches'], 1)
+    return {'requests': stats['requests'],
+            'positions': stats['positions'],
+            'batches': stats['batches'],
+            'positions_per_s': stats['positions'] / elapsed if elapsed > 0 else 0.,
+            'mean_batch_size': stats['positions'] / batches,
+            'max_batch_size': int(np.flatnonzero(sizes)[-1]) if stats['batches'] else 0,
+            'requests_per_batch': stats['requests'] / batches,
+            'model_loads': stats['loads'],
+            'busy_fraction': stats['busy'] / elapsed if elapsed > 0 else 0.,
+            # batches by size, in powers of two: '1' counts size 1, '2' sizes 2-3, '4' sizes 4-7 and so on
+            'batch_size_histogram': {str(2 ** i): int(np.sum(sizes[2 ** i:2 ** (i + 1)]))
+                                     for i in range(int(np.log2(len(sizes) - 1)) + 1)}}
+
+
+class InferenceServer:
+
+    def __init__(self, nnet_ver: int, backend: str = 'keras', clients: int = cfg.SELF_PLAY_WORKERS,
+                 capacity: int = cfg.NN_BATCH_SIZE, max_batch: int = cfg.INFERENCE_MAX_BATCH,
+                 max_wait: float = cfg.INFERENCE_MAX_WAIT):
+        """
+        :param nnet_ver: version of the network, loaded by the server process as a Player would, see player.load_brain
+        :param clients: number of slots, one for each process evaluating through the server
+        :param capacity: positions a client sends at once, larger batches are split
+        :param max_batch: positions after which the server stops collecting requests
+        :param max_wait: seconds the first request of a batch waits for the others
+        """
+        self.nnet_ver = nnet_ver
+        self.backend = backend
+        self.clients = clients
+        self.capacity = capacity
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.blocks = []
+        self.slots = []
+        self.process = None
+        self.control = None
+
+    def start(self):
+        """ starts the server process and waits until the network is loaded """
+        context = mp.get_context('spawn')
+        sizes = [self.capacity * int(np.prod(cfg.IN_SHAPE)) * 4, self.capacity * 4,
+                 self.capacity * int(np.prod(cfg.OUT_SHAPE)) * 4]
+        server_slots = []
+        for _ in range(self.clients):
+            blocks = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+            self.blocks.extend(blocks)
+            client_conn, server_conn = context.Pipe()
+            names = [block.name for block in blocks]
+            self.slots.append({'conn': client_conn, 'blocks': names, 'capacity': self.capacity, 'has_policy': False,
+                               'version': self.nnet_ver})
+            server_slots.append({'server_conn': server_conn, 'blocks': names, 'capacity': self.capacity})
+        self.control, server_control = context.Pipe()
+        self.process = context.Process(target=serve, name='inference',
+                                       args=(self.nnet_ver, self.backend, server_slots, server_control,
+                                             self.max_batch, self.max_wait))
+        self.process.start()
+        status, payload = self.control.recv()
+        if status == 'error':
+            self.process.join()
+            self._release()
+            raise RuntimeError('the inference server could not load the network:\n' + payload)
+        for slot in self.slots:
+            slot['has_policy'] = payload
+        lg.logger_nnet.info('INFERENCE SERVER READY WITH MODEL v{} ({}), {} CLIENTS'.format(
+            self.nnet_ver, self.backend, self.clients))
+        return self
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def stats(self) -> dict:
+        """ :return: throughput and batch sizes since the start, see summary """
+        self.control.send('stats')
+        return self.control.recv()
+
+    def stop(self):
+        """ stops the server and frees the shared memory, the clients must not be used afterwards """
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.control.send('stop')
+            self.process.join(cfg.SELF_PLAY_JOIN_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.process = None
+        self._release()
+        lg.logger_nnet.info('INFERENCE SERVER STOPPED')
+
+    def _release(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
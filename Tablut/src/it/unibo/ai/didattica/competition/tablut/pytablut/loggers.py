@@ -1,4 +1,6 @@
 import logging
+import os
+from collections import deque
 
 disabled = {'player': False,
             'mcts': False,
@@ -6,10 +8,17 @@ disabled = {'player': False,
             'nnet': False,
             'mem': False}
 
+# tracing of the search hot path, every call site is guarded by `if lg.TRACE:`
+# so that nothing gets evaluated while tracing is off
+TRACE = False
+TRACE_SAMPLE_RATE = 1  # record one event every TRACE_SAMPLE_RATE
+TRACE_BUFFER_SIZE = 10000  # events kept in memory until flush, None writes them immediately
+
 
 def setup_logger(name, file, level=logging.INFO):
     formatter = logging.Formatter('{asctime} {levelname} {message}', style='{')
-    file_handler = logging.FileHandler(file, mode='w')
+    # the file is opened only when the first record is emitted
+    file_handler = logging.FileHandler(file, mode='w', delay=True)
     file_handler.setFormatter(formatter)
 
     logger = logging.getLogger(name)
@@ -20,6 +29,39 @@ def setup_logger(name, file, level=logging.INFO):
     return logger
 
 
+class Tracer:
+
+    def __init__(self, logger, sample_rate=TRACE_SAMPLE_RATE, buffer_size=TRACE_BUFFER_SIZE):
+        """
+        sampled trace of high frequency events, formatted only when written
+        :param logger: logger the events are written to
+        :param sample_rate: only one event every sample_rate is recorded
+        :param buffer_size: size of the ring buffer holding the latest events until flush,
+                            None to write the events immediately
+        """
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.buffer = deque(maxlen=buffer_size) if buffer_size is not None else None
+        self.events = 0
+
+    def trace(self, msg, *args):
+        self.events += 1
+        if self.events % self.sample_rate:
+            return
+        if self.buffer is not None:
+            self.buffer.append((msg, args))
+        else:
+            self.logger.info(msg, *args)
+
+    def flush(self):
+        """ writes the buffered events to the logger """
+        if self.buffer is None:
+            return
+        for msg, args in self.buffer:
+            self.logger.info(msg, *args)
+        self.buffer.clear()
+
+
 logger_mcts = setup_logger('MCTS', 'logs/MCTS.log')
 logger_mcts.disabled = disabled['mcts']
 logger_train = setup_logger('train', 'logs/main.log')
@@ -30,3 +72,21 @@ logger_memory = setup_logger('memory', 'logs/memory.log')
 logger_memory.disabled = disabled['mem']
 logger_player = setup_logger('player', 'logs/player.log')
 logger_player.disabled = disabled['player']
+
+tracer_mcts = Tracer(logger_mcts)
+
+
+def use_log_folder(folder):
+    """
+    moves the log files to folder, so that worker processes do not overwrite the ones of the main process
+    """
+    os.makedirs(folder, exist_ok=True)
+    for logger in (logger_mcts, logger_train, logger_nnet, logger_memory, logger_player):
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                logger.removeHandler(handler)
+                handler.close()
+                file_handler = logging.FileHandler(os.path.join(folder, os.path.basename(handler.baseFilename)),
+                                                   mode='w', delay=True)
+                file_handler.setFormatter(handler.formatter)
+                logger.addHandler(file_handler)
@@ -1,80 +1,205 @@
+import json
 import os
-from collections import deque
-import pickle
 import numpy as np
 
 import pytablut.config as cfg
 import pytablut.loggers as lg
-from pytablut import game # needed by pickle
 
 
-def load_memories(path='./memories/'):
-    lg.logger_memory.info("LOADING MEMORIES FROM STORAGE")
-    try:
-        with open(path + 'dataset.pkl', 'rb') as f:
-            memories = pickle.load(f)
-        lg.logger_memory.info("SIZE OF LOADED MEMORIES: {:0>5d}".format(len(memories)))
-        return memories
-    except FileNotFoundError:
-        return None
+def pad_policy(policy, policy_size: int = cfg.POLICY_TARGET_SIZE) -> (np.ndarray, np.ndarray):
+    """
+    :param policy: search policy as (flat policy indexes, probabilities), None if there is none
+    :return: the indexes and probabilities padded to policy_size entries with -1 and 0,
+    only the most probable actions are kept if there are more
+    """
+    indexes = np.full(policy_size, -1, dtype=np.int16)
+    probs = np.zeros(policy_size, dtype=np.float32)
+    if policy is not None:
+        policy_indexes, policy_probs = np.asarray(policy[0]), np.asarray(policy[1])
+        if len(policy_indexes) > policy_size:
+            kept = np.argsort(policy_probs)[-policy_size:]
+            policy_indexes, policy_probs = policy_indexes[kept], policy_probs[kept] / np.sum(policy_probs[kept])
+        indexes[:len(policy_indexes)] = policy_indexes
+        probs[:len(policy_probs)] = policy_probs
+    return indexes, probs
 
 
-def compact_memories(path='./memories/'):
-    memories = pickle.load(open(path + 'dataset.pkl', 'rb'))
-    for fname in os.listdir(path):
-        if fname.endswith('pkl') and not fname.startswith('dataset'):
-            with open(path + fname, 'rb') as f:
-                memories.extend(pickle.load(f))
-            os.remove(path + fname)
-    pickle.dump(memories, open(path + 'dataset.pkl', 'wb'))
+class ReplayBuffer:
+
+    def __init__(self, size: int = cfg.MEMORY_SIZE, path: str = cfg.REPLAY_DIR,
+                 policy_size: int = cfg.POLICY_TARGET_SIZE):
+        """
+        ring buffer of positions stored in fixed size arrays, memory mapped from .npy files in path
+        so that only the sampled pages are loaded in RAM and the buffer survives between runs.
+        Once full, every new position overwrites the oldest one
+        :param size: maximum number of positions
+        :param path: folder of the files, opened again if they exist, None keeps the arrays in RAM
+        :param policy_size: maximum number of actions stored for each policy target,
+                            the most probable ones are kept
+        """
+        self.size = size
+        self.path = path
+        self.policy_size = policy_size
+        self.head = 0  # next slot written
+        self.count = 0  # number of slots in use
+        shapes = {'boards': ((size, 9, 9), np.int8),
+                  'turns': ((size,), np.int8),
+                  'values': ((size,), np.float32),
+                  # flat policy indexes (see actionspace) and probabilities, -1 marks the unused entries
+                  'policy_indexes': ((size, policy_size), np.int16),
+                  'policy_probs': ((size, policy_size), np.float32)}
+        new = True
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            new = not os.path.exists(self._meta_file())
+            if not new:
+                with open(self._meta_file()) as f:
+                    meta = json.load(f)
+                if meta['size'] != size or meta['policy_size'] != policy_size:
+                    raise ValueError(f'replay buffer in {path} has size {meta["size"]}, '
+                                     f'policy size {meta["policy_size"]}')
+                self.head, self.count = meta['head'], meta['count']
+            self.arrays = {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'),
+                                                           mode='w+' if new else 'r+',
+                                                           dtype=dtype, shape=shape if new else None)
+                           for name, (shape, dtype) in shapes.items()}
+        else:
+            self.arrays = {name: np.zeros(shape, dtype=dtype) for name, (shape, dtype) in shapes.items()}
+        if new:
+            self.arrays['policy_indexes'][:] = -1
+        lg.logger_memory.info('REPLAY BUFFER WITH {} OF {} POSITIONS'.format(self.count, size))
+
+    def _meta_file(self) -> str:
+        return os.path.join(self.path, 'meta.json')
+
+    @staticmethod
+    def exists(path: str = cfg.REPLAY_DIR) -> bool:
+        """ :return: whether a replay buffer was saved in path """
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    def __len__(self):
+        return self.count
+
+    def append(self, board: np.ndarray, turn: int, value: float, policy=None):
+        """
+        :param policy: search policy as (flat policy indexes, probabilities), None if there is none
+        """
+        i = self.head
+        self.arrays['boards'][i] = board
+        self.arrays['turns'][i] = turn
+        self.arrays['values'][i] = value
+        self.arrays['policy_indexes'][i], self.arrays['policy_probs'][i] = pad_policy(policy, self.policy_size)
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def extend(self, positions: dict):
+        """
+        appends many positions at once, wrapping around the end of the ring
+        :param positions: dict with the arrays of the positions, as returned by get
+        """
+        n = len(positions['values'])
+        if n > self.size:
+            # only the newest ones would survive
+            positions = {name: array[-self.size:] for name, array in positions.items()}
+            n = self.size
+        slots = (self.head + np.arange(n)) % self.size
+        for name, array in self.arrays.items():
+            array[slots] = positions[name]
+        self.head = (self.head + n) % self.size
+        self.count = min(self.count + n, self.size)
+
+    def get(self, slots) -> dict:
+        """
+        :param slots: np.array of slots in [0, len(self))
+        :return: dict with the arrays 'boards', 'turns', 'values', 'policy_indexes' and 'policy_probs' of the slots
+        """
+        slots = np.sort(slots)  # sorted slots read the memory mapped files in order
+        return {name: array[slots] for name, array in self.arrays.items()}
+
+    def sample(self, n: int, rng: np.random.Generator = None) -> dict:
+        """ :return: n positions drawn uniformly with replacement, see get """
+        rng = rng if rng is not None else np.random.default_rng()
+        return self.get(rng.integers(0, self.count, size=n))
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def fill(self, dataset):
+        """ fills the buffer with the newest positions of a Dataset """
+        for positions in dataset.iterate(self.size):
+            self.extend(positions)
+        lg.logger_memory.info('REPLAY BUFFER FILLED WITH {} POSITIONS'.format(self.count))
+
+    def flush(self):
+        """ writes the arrays and the position of the ring to disk """
+        if self.path is None:
+            return
+        for array in self.arrays.values():
+            array.flush()
+        with open(self._meta_file(), 'w') as f:
+            json.dump({'size': self.size, 'policy_size': self.policy_size, 'head': self.head, 'count': self.count}, f)
 
 
 class Memory:
 
-    def __init__(self, size=cfg.MEMORY_SIZE, ltmemory=None):
+    def __init__(self, size=cfg.MEMORY_SIZE, ltmemory=None, dataset=None, version=None):
+        """
+        :param ltmemory: ReplayBuffer the finished games are committed to,
+                         None creates the default one unless a dataset is given
+        :param dataset: Dataset every finished game is also archived in, None to keep only the replay buffer
+        :param version: version of the model playing the games, recorded in the dataset
+        """
         self.MEMORY_SIZE = cfg.MEMORY_SIZE
-        if ltmemory is not None:
+        if ltmemory is not None or dataset is not None:
             self.ltmemory = ltmemory
         else:
-            self.ltmemory = deque(maxlen=size)
-        self.stmemory = deque(maxlen=size)
+            self.ltmemory = ReplayBuffer(size)
+        self.dataset = dataset
+        self.version = version
+        self.policy_size = self.ltmemory.policy_size if self.ltmemory is not None else cfg.POLICY_TARGET_SIZE
+        # positions of the game in progress, as (board, turn, policy), waiting for the result
+        self.stmemory = []
 
     def __len__(self):
-        return len(self.ltmemory)
+        return len(self.ltmemory) if self.ltmemory is not None else 0
 
-    def commit_stmemory(self, state):
+    def commit_stmemory(self, state, policy=None):
         """
         :param state: State object
+        :param policy: search policy of the move played in state, as (flat policy indexes, probabilities)
         """
-        # data augmentation exploiting symmetries
-        for rot in range(4):
-            rot_board = np.rot90(state.board, rot)
-            new_state = game.State(board=rot_board, turn=state.turn)
-            lg.logger_memory.info('ADDING STATE WITH ID {}'.format(new_state.id))
-            self.stmemory.append({'state': new_state,
-                                  'id': new_state.id,
-                                  'value': None,
-                                  'turn': new_state.turn})
+        lg.logger_memory.info('ADDING STATE WITH ID {}'.format(state.id))
+        # the symmetries of the board are applied when the training batches are built, see pipeline.augment
+        self.stmemory.append((state.board, state.turn, policy))
 
     def commit_ltmemory(self, winner):
         lg.logger_memory.info('COMMITTING WINNER OF THIS EPISODE: {}'.format(winner))
-        for mem in self.stmemory:
-            if winner == 0:
-                mem['value'] = 0
-            elif mem['turn'] == winner:
-                mem['value'] = 1
-            else:
-                mem['value'] = -1
-            self.ltmemory.append(mem)
+        if not self.stmemory:
+            return
+        turns = np.array([turn for _, turn, _ in self.stmemory], dtype=np.int8)
+        policies = [pad_policy(policy, self.policy_size) for _, _, policy in self.stmemory]
+        positions = {'boards': np.array([board for board, _, _ in self.stmemory], dtype=np.int8),
+                     'turns': turns,
+                     # 0 for a draw, otherwise 1 for the positions of the winner and -1 for the others
+                     'values': (turns * winner).astype(np.float32),
+                     'policy_indexes': np.array([indexes for indexes, _ in policies]),
+                     'policy_probs': np.array([probs for _, probs in policies])}
+        if self.ltmemory is not None:
+            self.ltmemory.extend(positions)
+        if self.dataset is not None:
+            self.dataset.append(positions, version=self.version)
         self.clear_stmemory()
 
     def clear_stmemory(self):
         lg.logger_memory.info('CLEANING SHORT TERM MEMORY')
         self.stmemory.clear()
 
-    def save(self, name):
-        pickle.dump(self.ltmemory, open('memories/mem{}.pkl'.format(name), 'wb'))
+    def save(self):
+        if self.ltmemory is not None:
+            self.ltmemory.flush()
 
     def clear_ltmemory(self):
         lg.logger_memory.info('CLEANING LONG TERM MEMORY')
-        self.ltmemory.clear()
+        if self.ltmemory is not None:
+            self.ltmemory.clear()
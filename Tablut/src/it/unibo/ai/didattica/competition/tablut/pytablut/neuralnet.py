@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import Input
@@ -8,15 +7,23 @@ from tensorflow.keras.optimizers import SGD
 from tensorflow.keras.regularizers import l2
 from tensorflow.nn import softmax_cross_entropy_with_logits
 
+import pytablut.actionspace as actionspace
 import pytablut.config as cfg
 import pytablut.loggers as lg
+from pytablut.game import encode_states
 
 logger = lg.logger_nnet
 
 
 def loss_with_action_masking(y_true, y_pred):
-    logits = y_true
-    labels = tf.where(y_true == 0., 1e-6, y_pred)
+    """
+    softmax cross entropy between the search policy and the predicted one, over the whole 9x9x32 space.
+    The actions with a zero target, illegal or never visited, are masked out of the softmax,
+    a target of all zeros (a memory without policy) gives no loss
+    """
+    labels = tf.reshape(y_true, (tf.shape(y_true)[0], -1))
+    logits = tf.reshape(y_pred, (tf.shape(y_pred)[0], -1))
+    logits = tf.where(labels == 0., tf.fill(tf.shape(logits), -100.), logits)
     return softmax_cross_entropy_with_logits(labels=labels, logits=logits)
 
 
@@ -30,6 +37,7 @@ class NeuralNetwork:
         self.input_shape = input_shape
         self.output_shape = output_shape
         self.model = None
+        self.has_policy = False
 
     def predict(self, X):
         return self.model.predict(X)
@@ -39,13 +47,23 @@ class NeuralNetwork:
         return self.model.fit(X, y, epochs=epochs, verbose=verbose,
                               validation_split=validation_split, batch_size=batch_size)
 
+    def fit_stream(self, dataset, epochs, steps_per_epoch, verbose):
+        """
+        :param dataset: endless tf.data.Dataset of batches, see pipeline.to_tf_dataset
+        """
+        lg.logger_nnet.info('FITTING MODEL ON STREAM, {} EPOCHS OF {} BATCHES'.format(epochs, steps_per_epoch))
+        return self.model.fit(dataset, epochs=epochs, steps_per_epoch=steps_per_epoch, verbose=verbose)
+
     def save(self, version):
         lg.logger_nnet.info('SAVING MODEL v{:2d}'.format(version))
         self.model.save('model/brain/v{}.h5'.format(version))
 
     def load_model(self, version):
         lg.logger_nnet.info('LOADING MODEL v{:2d}'.format(version))
-        self.model = load_model('model/brain/v{}.h5'.format(version))
+        self.model = load_model('model/brain/v{}.h5'.format(version),
+                                custom_objects={'loss_with_action_masking': loss_with_action_masking})
+        # models saved before the policy head was added only have the value output
+        self.has_policy = len(self.model.outputs) > 1
 
     def printWeightAverages(self):
         layers = self.model.layers
@@ -61,6 +79,8 @@ class NeuralNetwork:
         lg.logger_nnet.info('******************')
 
     def viewLayers(self):
+        import matplotlib.pyplot as plt
+
         layers = self.model.layers
         for i, l in enumerate(layers):
             x = l.get_weights()
@@ -111,6 +131,8 @@ class ResidualNN(NeuralNetwork):
                          reg_const=reg_const, learning_rate=learning_rate, momentum=momentum)
         self.hidden_layers = hidden_layers
         self.model = self._build_model()
+        self.has_policy = True
+        self.input_buffer = np.empty((cfg.NN_BATCH_SIZE,) + tuple(input_shape), dtype=np.float32)
 
     def _conv_layer(self, x, filters, kernel_size):
         x = Conv2D(filters=filters, kernel_size=kernel_size,
@@ -137,13 +159,13 @@ class ResidualNN(NeuralNetwork):
         x = Conv2D(filters=1, kernel_size=1,
                    data_format="channels_last", padding="same",
                    use_bias=False, activation="linear",
-                   kernel_regularizer=l2(self.reg_const))(x)
-        x = BatchNormalization(axis=1)(x)
+                   kernel_regularizer=l2(self.reg_const), name='value_conv')(x)
+        x = BatchNormalization(axis=1, name='value_bn')(x)
         x = LeakyReLU()(x)
 
         x = Flatten()(x)
         x = Dense(20, use_bias=False, activation='linear',
-                  kernel_regularizer=l2(self.reg_const))(x)
+                  kernel_regularizer=l2(self.reg_const), name='value_dense')(x)
         x = LeakyReLU()(x)
         x = Dense(1, use_bias=False, activation='tanh',
                   kernel_regularizer=l2(self.reg_const),
@@ -155,13 +177,13 @@ class ResidualNN(NeuralNetwork):
         x = Conv2D(filters=2, kernel_size=1,
                    data_format="channels_last", padding="same",
                    use_bias=False, activation="linear",
-                   kernel_regularizer=l2(self.reg_const))(x)
-        x = BatchNormalization(axis=1)(x)
+                   kernel_regularizer=l2(self.reg_const), name='policy_conv')(x)
+        x = BatchNormalization(axis=1, name='policy_bn')(x)
         x = LeakyReLU()(x)
 
         x = Flatten()(x)
         x = Dense(np.prod(self.output_shape), use_bias=False, activation='linear',
-                  kernel_regularizer=l2(self.reg_const))(x)
+                  kernel_regularizer=l2(self.reg_const), name='policy_dense')(x)
         x = Reshape(self.output_shape, name='policy_head')(x)
         return x
 
@@ -173,9 +195,11 @@ class ResidualNN(NeuralNetwork):
             x = self._residual_layer(x, hidden_layer['filters'], hidden_layer['kernel_size'])
 
         value_head = self._value_head(x)
+        policy_head = self._policy_head(x)
 
-        model = Model(inputs=[input_block], outputs=[value_head])
-        model.compile(loss={'value_head': 'mean_squared_error'},
+        model = Model(inputs=[input_block], outputs=[value_head, policy_head])
+        model.compile(loss={'value_head': 'mean_squared_error', 'policy_head': loss_with_action_masking},
+                      loss_weights={'value_head': 0.5, 'policy_head': 0.5},
                       optimizer=SGD(lr=self.learning_rate, momentum=self.momentum))
 
         return model
@@ -189,67 +213,119 @@ class ResidualNN(NeuralNetwork):
         """
             :return: the value of the state
         """
-        input_to_model = np.array([self.state_to_model_input(state)])
+        return self.predict_batch([state])[0]
+
+    def forward(self, X):
+        """
+        :param X: network inputs of shape (N, 9, 9, 4)
+        :return: np.array of shape (N,) with the values
+        """
+        preds = self.model.predict_on_batch(X)
+        if self.has_policy:
+            preds = preds[0]
+        return np.asarray(preds)[:, 0]
+
+    def forward_policy(self, X):
+        """
+        :param X: network inputs of shape (N, 9, 9, 4)
+        :return: np.array of shape (N,) with the values and one of shape (N, 9, 9, 32) with the policy logits
+        """
+        values, logits = self.model.predict_on_batch(X)
+        return np.asarray(values)[:, 0], np.asarray(logits)
 
-        preds = self.model.predict(input_to_model)
-        value = preds[0, 0]
-        return value
+    def predict_batch(self, states):
+        """
+            evaluates all the states with a single forward pass
+            :return: np.array with the values of the states
+        """
+        if len(states) > len(self.input_buffer):
+            self.input_buffer = np.empty((len(states),) + tuple(self.input_shape), dtype=np.float32)
+        return self.forward(encode_states(states, self.input_buffer))
+
+    def predict_policy_batch(self, states):
+        """
+            :return: np.array with the values of the states and one with their 9x9x32 policy logits
+        """
+        if len(states) > len(self.input_buffer):
+            self.input_buffer = np.empty((len(states),) + tuple(self.input_shape), dtype=np.float32)
+        return self.forward_policy(encode_states(states, self.input_buffer))
 
     def map_actions(self, logits, actions):
         """
-        :return: an array of the predicted values of the actions
-
-        Understanding the output mapping:
-        32 levels in 2 groups of 16,
-        every group is one axis: rows, columns (with this order):
-            - the first layer of every group represents moving by -8 cells on that axis
-            - the last layer of every group represents moving by +8 cells on that axis
-        """
-        pred = np.empty(len(actions), dtype=float)
-        for i, (a_from, a_to) in enumerate(actions):
-            distance_x, distance_y = np.subtract(a_to, a_from)
-            if distance_x != 0:
-                # up or down
-                offset = 8
-                if distance_x > 0:  # because when x=1 I want the 8th layer as x can't be 0
-                    offset = 7
-                # so distance_x + offset is my layer
-                layer = distance_x + offset
-            else:
-                # left or right
-                offset = 24
-                if distance_y > 0:  # because when x=1 I want the 8th layer as x can't be 0
-                    offset = 23
-                layer = distance_y + offset
-
-            idx = (a_from[0], a_from[1], layer)
-            pred[i] = logits[idx]
-        return pred
+        :return: an array of the predicted values of the actions, see actionspace for the mapping
+        """
+        return actionspace.map_actions(logits, actions)
 
     def map_into_action_space(self, actions, pi):
-        actions_space = np.zeros(self.output_shape, dtype=float)
-        for i, (a_from, a_to) in enumerate(actions):
-            distance_x, distance_y = np.subtract(a_to, a_from)
-            if distance_x != 0:
-                # up or down
-                offset = 8
-                if distance_x > 0:  # because when x=1 I want the 8th layer as x can't be 0
-                    offset = 7
-                # so distance_x + offset is my layer
-                layer = distance_x + offset
-            else:
-                # left or right
-                offset = 24
-                if distance_y > 0:  # because when x=1 I want the 8th layer as x can't be 0
-                    offset = 23
-                layer = distance_y + offset
-
-            idx = (a_from[0], a_from[1], layer)
-            actions_space[idx] = pi[i]
-        return actions_space
+        return actionspace.map_into_action_space(actions, pi)
+
+    def export_numpy(self, version, samples=32, atol=1e-4):
+        """
+        writes the weights needed for inference to model/brain/v{version}.npz,
+        the format read by npnet.NumpyValueNet, then checks that both give the same values and policies
+        :return: maximum absolute difference between the two implementations on random inputs
+        """
+        from pytablut.npnet import NumpyValueNet
+
+        def export_norm(prefix, norm):
+            gamma, beta, mean, var = norm.get_weights()
+            scale = gamma / np.sqrt(var + norm.epsilon)
+            weights[f'{prefix}_scale'] = scale
+            weights[f'{prefix}_shift'] = beta - mean * scale
+            weights[f'{prefix}_axis'] = norm.axis[0] if isinstance(norm.axis, (list, tuple)) else norm.axis
+
+        file = 'model/brain/v{}.npz'.format(version)
+        # the policy head is exported apart, the other layers are the trunk and the value head in order
+        layers = [layer for layer in self.model.layers if not layer.name.startswith('policy')]
+        convs = [layer for layer in layers if isinstance(layer, Conv2D)]
+        norms = [layer for layer in layers if isinstance(layer, BatchNormalization)]
+        denses = [layer for layer in layers if isinstance(layer, Dense)]
+        activation = [layer for layer in layers if isinstance(layer, LeakyReLU)][0]
+        weights = {'n_conv': len(convs), 'alpha': activation.get_config()['alpha']}
+        for i, (conv, norm) in enumerate(zip(convs, norms)):
+            weights[f'conv{i}_kernel'] = conv.get_weights()[0]
+            export_norm(f'bn{i}', norm)
+        for i, dense in enumerate(denses):
+            dense_weights = dense.get_weights()
+            weights[f'dense{i}_kernel'] = dense_weights[0]
+            if len(dense_weights) > 1:
+                weights[f'dense{i}_bias'] = dense_weights[1]
+        if self.has_policy:
+            weights['policy_conv_kernel'] = self.model.get_layer('policy_conv').get_weights()[0]
+            export_norm('policy_bn', self.model.get_layer('policy_bn'))
+            weights['policy_dense_kernel'] = self.model.get_layer('policy_dense').get_weights()[0]
+        np.savez(file, **weights)
+
+        X = np.random.randint(0, 2, size=(samples,) + tuple(self.input_shape)).astype(np.float32)
+        net = NumpyValueNet(file)
+        if self.has_policy:
+            expected, expected_logits = self.model.predict_on_batch(X)
+            values, logits = net.forward_policy(X)
+            error = float(max(np.max(np.abs(values - np.asarray(expected)[:, 0])),
+                              np.max(np.abs(logits - np.asarray(expected_logits)))))
+        else:
+            expected = np.asarray(self.model.predict_on_batch(X))[:, 0]
+            error = float(np.max(np.abs(net.forward(X) - expected)))
+        lg.logger_nnet.info('EXPORTED MODEL v{} TO NUMPY, MAX ERROR {:.2e}'.format(version, error))
+        if error > atol:
+            raise ValueError(f'numpy model differs from keras by {error}')
+        return error
 
     def set_weights(self, weights):
         self.model.set_weights(weights)
 
     def get_weights(self):
         return self.model.get_weights()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export trained models for numpy inference.')
+    parser.add_argument('versions', type=int, nargs='+',
+                        help='versions of the models in model/brain to export')
+    args = parser.parse_args()
+    for version in args.versions:
+        nn = ResidualNN()
+        nn.load_model(version)
+        print('v{}: max error {:.2e}'.format(version, nn.export_numpy(version)))
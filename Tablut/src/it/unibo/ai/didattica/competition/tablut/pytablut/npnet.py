@@ -0,0 +1,162 @@
+"""
+Network inference implemented with NumPy only, so that playing does not need to import TensorFlow.
+The weights are exported from a trained ResidualNN by ResidualNN.export_numpy,
+the policy is available only for models trained with the policy head
+"""
+import numpy as np
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.game import encode_states
+
+
+def _im2col_index(size: int = 9, kernel_size: int = 3) -> np.ndarray:
+    """
+    :return: (size*size, kernel_size*kernel_size) indexes, in the flattened zero padded board,
+    of the cells covered by the kernel centered in each cell
+    """
+    padded = size + kernel_size - 1
+    rows, cols = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    k_rows, k_cols = np.meshgrid(np.arange(kernel_size), np.arange(kernel_size), indexing='ij')
+    index = (rows.reshape(-1, 1) + k_rows.reshape(1, -1)) * padded + cols.reshape(-1, 1) + k_cols.reshape(1, -1)
+    return index
+
+
+class NumpyValueNet:
+
+    def __init__(self, file: str, input_shape=cfg.IN_SHAPE, dtype=np.float32):
+        """
+        :param file: .npz file written by ResidualNN.export_numpy
+        :param dtype: floating point type used for the computations
+        """
+        self.input_shape = input_shape
+        self.input_buffer = np.empty((cfg.NN_BATCH_SIZE,) + tuple(input_shape), dtype=np.float32)
+        self.dtype = dtype
+        self.size = input_shape[0]
+        self.index = _im2col_index(self.size)
+        weights = np.load(file)
+        self.alpha = float(weights['alpha'])
+        self.n_conv = int(weights['n_conv'])
+        self.convs = [self._fold(weights, f'conv{i}', f'bn{i}') for i in range(self.n_conv)]
+        self.dense = [weights['dense0_kernel'].astype(dtype), weights['dense1_kernel'].astype(dtype)]
+        self.dense_bias = [weights[f'dense{i}_bias'].astype(dtype) if f'dense{i}_bias' in weights else None
+                           for i in range(2)]
+        self.has_policy = 'policy_conv_kernel' in weights
+        if self.has_policy:
+            self.policy_conv = self._fold(weights, 'policy_conv', 'policy_bn')
+            self.policy_dense = weights['policy_dense_kernel'].astype(dtype)
+            self.output_shape = cfg.OUT_SHAPE
+        lg.logger_nnet.info('LOADED NUMPY MODEL FROM {}'.format(file))
+
+    def _fold(self, weights, conv_name: str, norm_name: str) -> dict:
+        """
+        folds the batch normalization following a convolution into its weights.
+        A normalization over the channels becomes a scaled kernel and a bias,
+        one over the rows (axis=1, as in ResidualNN) stays as an affine transformation of each row
+        """
+        kernel = weights[f'{conv_name}_kernel']
+        scale = weights[f'{norm_name}_scale']
+        shift = weights[f'{norm_name}_shift']
+        axis = int(weights[f'{norm_name}_axis'])
+        kernel_size = kernel.shape[0]
+        conv = {'kernel_size': kernel_size, 'row_scale': None, 'row_shift': None}
+        matrix = kernel.reshape(-1, kernel.shape[-1])
+        if axis in (-1, 3):
+            conv['matrix'] = (matrix * scale).astype(self.dtype)
+            conv['bias'] = shift.astype(self.dtype)
+        elif axis == 1:
+            conv['matrix'] = matrix.astype(self.dtype)
+            conv['bias'] = None
+            conv['row_scale'] = scale.reshape(1, -1, 1, 1).astype(self.dtype)
+            conv['row_shift'] = shift.reshape(1, -1, 1, 1).astype(self.dtype)
+        else:
+            raise ValueError(f'unsupported batch normalization axis: {axis}')
+        return conv
+
+    def _leaky_relu(self, x: np.ndarray) -> np.ndarray:
+        return np.maximum(x, self.alpha * x)
+
+    def _conv(self, x: np.ndarray, conv: dict) -> np.ndarray:
+        n, size, _, channels = x.shape
+        if conv['kernel_size'] == 1:
+            columns = x.reshape(n * size * size, channels)
+        else:
+            pad = conv['kernel_size'] // 2
+            padded = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)))
+            padded = padded.reshape(n, -1, channels)
+            columns = padded[:, self.index, :].reshape(n * size * size, -1)
+        y = columns @ conv['matrix']
+        if conv['bias'] is not None:
+            y += conv['bias']
+        y = y.reshape(n, size, size, -1)
+        if conv['row_scale'] is not None:
+            y = y * conv['row_scale'] + conv['row_shift']
+        return y
+
+    def _trunk(self, X: np.ndarray) -> np.ndarray:
+        x = self._leaky_relu(self._conv(X.astype(self.dtype), self.convs[0]))
+        # every residual block uses two convolutions, the last one belongs to the value head
+        for i in range(1, self.n_conv - 1, 2):
+            y = self._leaky_relu(self._conv(x, self.convs[i]))
+            y = self._conv(y, self.convs[i + 1])
+            x = self._leaky_relu(x + y)
+        return x
+
+    def _value(self, x: np.ndarray) -> np.ndarray:
+        x = self._leaky_relu(self._conv(x, self.convs[-1]))
+        x = x.reshape(x.shape[0], -1)
+        x = x @ self.dense[0]
+        if self.dense_bias[0] is not None:
+            x += self.dense_bias[0]
+        x = self._leaky_relu(x)
+        x = x @ self.dense[1]
+        if self.dense_bias[1] is not None:
+            x += self.dense_bias[1]
+        return np.tanh(x[:, 0])
+
+    def _policy(self, x: np.ndarray) -> np.ndarray:
+        x = self._leaky_relu(self._conv(x, self.policy_conv))
+        x = x.reshape(x.shape[0], -1) @ self.policy_dense
+        return x.reshape((x.shape[0],) + tuple(self.output_shape))
+
+    def forward(self, X: np.ndarray) -> np.ndarray:
+        """
+        :param X: network inputs of shape (N, 9, 9, 4)
+        :return: np.array of shape (N,) with the values
+        """
+        return self._value(self._trunk(X))
+
+    def forward_policy(self, X: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        :param X: network inputs of shape (N, 9, 9, 4)
+        :return: np.array of shape (N,) with the values and one of shape (N, 9, 9, 32) with the policy logits
+        """
+        x = self._trunk(X)
+        return self._value(x), self._policy(x)
+
+    def state_to_model_input(self, state):
+        converted = state.convert_into_cnn()
+        model_input = np.reshape(converted, self.input_shape)
+        return model_input
+
+    def predict(self, state):
+        """
+            :return: the value of the state
+        """
+        return self.predict_batch([state])[0]
+
+    def predict_batch(self, states):
+        """
+            :return: np.array with the values of the states
+        """
+        if len(states) > len(self.input_buffer):
+            self.input_buffer = np.empty((len(states),) + tuple(self.input_shape), dtype=np.float32)
+        return self.forward(encode_states(states, self.input_buffer))
+
+    def predict_policy_batch(self, states):
+        """
+            :return: np.array with the values of the states and one with their 9x9x32 policy logits
+        """
+        if len(states) > len(self.input_buffer):
+            self.input_buffer = np.empty((len(states),) + tuple(self.input_shape), dtype=np.float32)
+        return self.forward_policy(encode_states(states, self.input_buffer))
@@ -0,0 +1,131 @@
+"""
+Streaming input pipeline for training the network on the replay buffer.
+Batches are sampled in bulk from the buffer and every position gets a random symmetry of the board
+when its batch is built, so only one copy of each position is stored.
+The batches are prepared by a background thread while the network trains on the previous ones.
+"""
+import queue
+import threading
+
+import numpy as np
+
+import pytablut.actionspace as actionspace
+import pytablut.config as cfg
+from pytablut.game import encode_boards
+
+
+def augment(boards: np.ndarray, policy_indexes: np.ndarray, symmetries: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    :param boards: array of shape (N, 9, 9)
+    :param policy_indexes: array of shape (N, K) with flat policy indexes, -1 for the unused entries
+    :param symmetries: array of shape (N,) with the symmetry of actionspace.transform_board applied to each position
+    :return: the transformed boards and policy indexes, new arrays
+    """
+    boards = boards.copy()
+    policy_indexes = policy_indexes.copy()
+    for symmetry in np.unique(symmetries):
+        selected = symmetries == symmetry
+        transformed = boards[selected]
+        if symmetry >= 4:
+            transformed = np.flip(transformed, axis=2)
+        boards[selected] = np.rot90(transformed, symmetry % 4, axes=(1, 2))
+        indexes = policy_indexes[selected]
+        valid = indexes >= 0
+        indexes[valid] = actionspace.SYMMETRIES[symmetry][indexes[valid]]
+        policy_indexes[selected] = indexes
+    return boards, policy_indexes
+
+
+def batches(buffer, batch_size: int = cfg.BATCH_SIZE, policy: bool = True, symmetries: bool = True,
+            rng: np.random.Generator = None):
+    """
+    :param buffer: ReplayBuffer the positions are sampled from
+    :param policy: whether the targets include the policy
+    :param symmetries: whether to apply a random symmetry to every position
+    :return: endless generator of (inputs, targets), the targets are the values or,
+    with the policy, a dict with the targets of the two heads of ResidualNN
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    while True:
+        positions = buffer.sample(batch_size, rng)
+        boards, policy_indexes = positions['boards'], positions['policy_indexes']
+        if symmetries:
+            boards, policy_indexes = augment(boards, policy_indexes, rng.integers(0, 8, size=len(boards)))
+        X = encode_boards(boards, positions['turns'])
+        if policy:
+            yield X, {'value_head': positions['values'],
+                      'policy_head': actionspace.dense_policies(policy_indexes, positions['policy_probs'])}
+        else:
+            yield X, positions['values']
+
+
+class Prefetcher:
+
+    def __init__(self, generator, depth: int = cfg.PREFETCH_BATCHES):
+        """
+        runs generator on a background thread, keeping up to depth items ready
+        """
+        self.generator = generator
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        """ :return: False if the prefetcher was stopped before item could be queued """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for item in self.generator:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            # raised again by the consumer
+            self._put(e)
+        finally:
+            # nothing else will be queued, the consumer stops once the queue is empty
+            self.stopped.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.stopped.is_set() and self.queue.empty():
+                    raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def to_tf_dataset(generator, policy: bool = True, input_shape=cfg.IN_SHAPE, output_shape=cfg.OUT_SHAPE):
+    """
+    :param generator: iterable of batches, as produced by batches
+    :return: tf.data.Dataset reading from the generator
+    """
+    import tensorflow as tf
+
+    inputs = tf.TensorSpec(shape=(None,) + tuple(input_shape), dtype=tf.float32)
+    values = tf.TensorSpec(shape=(None,), dtype=tf.float32)
+    if policy:
+        targets = {'value_head': values,
+                   'policy_head': tf.TensorSpec(shape=(None,) + tuple(output_shape), dtype=tf.float32)}
+    else:
+        targets = values
+    dataset = tf.data.Dataset.from_generator(lambda: generator, output_signature=(inputs, targets))
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -1,47 +1,128 @@
-import multiprocessing
-import pickle
 import time
 
 import numpy as np
 
+import pytablut.actionspace as actionspace
+import pytablut.book as book
 import pytablut.config as cfg
 import pytablut.loggers as lg
+from pytablut.alphabeta import AlphaBeta
+from pytablut.book import OpeningBook
+from pytablut.evalcache import EvaluationCache
 from pytablut.MCTSVanilla import MCTS, Node
-from pytablut.game import MAP
-# from pytablut.neuralnet import ResidualNN
+from pytablut.pnsearch import ProofNumberSearch
+from pytablut.profiler import SearchProfiler
+from pytablut.game import MAP, Game
+from pytablut.heuristics import king_position, escape_routes, king_attackers
 from pytablut.utils import Timeit
 
 
+def load_brain(nnet_ver=None, backend="keras"):
+    """
+    :param nnet_ver: version of the network in model/brain, None for no network, 0 for a new random one (keras only)
+    :param backend: "keras", "numpy", "int8" or "float16", see Player
+    :return: the network and the file of its evaluation cache, None if the values cannot be reused
+    """
+    if nnet_ver is None:
+        return None, None
+    if backend == "numpy":
+        from pytablut.npnet import NumpyValueNet
+        return NumpyValueNet('model/brain/v{}.npz'.format(nnet_ver)), 'model/brain/v{}.cache.pkl'.format(nnet_ver)
+    if backend in ("int8", "float16"):
+        from pytablut.quantize import QuantizedValueNet, model_file
+        return (QuantizedValueNet(model_file(nnet_ver, backend)),
+                'model/brain/v{}.{}.cache.pkl'.format(nnet_ver, backend))
+    from pytablut.neuralnet import ResidualNN
+    brain = ResidualNN()
+    if nnet_ver == 0:
+        return brain, None
+    brain.load_model(nnet_ver)
+    # cached values are only valid for the network that computed them
+    return brain, 'model/brain/v{}.cache.pkl'.format(nnet_ver)
+
+
 class Player:
 
     def __init__(self, color, name, nnet_ver=None, timeout=cfg.TIMEOUT,
                  turns_before_tau0=cfg.TURNS_BEFORE_TAU0, tau=cfg.TAU, tau_alpha=cfg.TAU_ALPHA,
-                 simulations=cfg.MCTS_SIMULATIONS, c_puct=cfg.CPUCT, choice_strategy="robust_child"):
+                 simulations=cfg.MCTS_SIMULATIONS, c_puct=cfg.CPUCT, choice_strategy="robust_child", engine="mcts",
+                 max_simulations=None, seed=None, workers=None,
+                 batch_size=cfg.NN_BATCH_SIZE, batch_wait=cfg.NN_BATCH_WAIT, backend="keras", noise=False,
+                 brain=None, book=cfg.BOOK_FILE, record_book=cfg.BOOK_RECORD):
         """
         Parameters:
         :param color: color of the player, either BLACK or WHITE
         :param name: name of the player
         :param timeout: timeout in seconds for each move computation
         :param choice_strategy: "max_child", "robust_child", "max_robut_child" or "secure_child"
+        :param engine: search engine used to compute moves, either "mcts" or "alphabeta"
+        :param max_simulations: stop the search after this many simulations, None to use the whole timeout
+        :param seed: seed of the random playouts, None for non reproducible playouts
+        :param workers: number of parallel playouts for each simulation, None to use all the cpus
+        :param batch_size: maximum number of leaves evaluated together by the network
+        :param batch_wait: maximum time in seconds a leaf waits for its batch to fill up
+        :param backend: "keras", "numpy", "int8" or "float16". The others only evaluate states:
+                        "numpy" needs a model exported by ResidualNN.export_numpy,
+                        "int8" and "float16" a model converted by quantize.convert
+        :param noise: mix Dirichlet noise into the priors of the root, to explore during self-play
+        :param brain: network already loaded, e.g. an inference.InferenceClient, nnet_ver and backend are then ignored
+        :param book: file of the opening book, None to always search
+        :param record_book: add the statistics of the searches of the first moves to the book
         """
         self.name = name
         self.color: int = MAP[color]
         self.timeout: int = timeout
         self.mcts: MCTS = None
-        if nnet_ver is not None:
-            self.brain = ResidualNN()
-            if nnet_ver > 0:
-                self.brain.load_model(nnet_ver)
+        if brain is not None:
+            self.set_brain(brain)
         else:
-            self.brain = None
+            self.set_brain(*load_brain(nnet_ver, backend))
+        self.noise: bool = noise
+        self.search_policy = None  # (flat policy indexes, probabilities) of the last move, the training target
         self.simulations: int = simulations
+        self.max_simulations: int = max_simulations
+        self.seed: int = seed
+        self.workers: int = workers
+        self.batch_size: int = batch_size
+        self.batch_wait: float = batch_wait
         self.choice_strategy = choice_strategy
         self.c_puct: int = c_puct
         self.turns_before_tau0 = turns_before_tau0
         self.tau = tau
         self.tau_alpha = tau_alpha
         self.turn = 1
+        self.past_states = set()
         self.__start_time = None
+        if engine == "mcts":
+            self.alphabeta = None
+        elif engine == "alphabeta":
+            self.alphabeta = AlphaBeta()
+        else:
+            raise ValueError(f'wrong engine: {engine}')
+        self.engine = engine
+        self.solver = ProofNumberSearch(self.color)
+        self.profiler = SearchProfiler()
+        self.book_file = book
+        self.book = OpeningBook(book)
+        self.record_book: bool = record_book
+        self.book_rows = []  # statistics recorded for the book, merged into it by save_book
+        self.book_seed = None  # visits and values the book added to the edges of the root
+
+    def set_brain(self, brain, cache_file=None):
+        """
+        replaces the network, e.g. with a newer version between two games
+        :param cache_file: file of the evaluation cache of the network, None to start with an empty one
+        """
+        self.brain = brain
+        self.cache_file = cache_file
+        if brain is None:
+            self.cache = None
+        elif cache_file is not None:
+            self.cache = EvaluationCache.load(cache_file)
+        else:
+            self.cache = EvaluationCache()
+        # with a policy head the priors of the network guide the search (PUCT)
+        self.policy: bool = brain is not None and brain.has_policy
 
     def __start_timer(self):
         self.__start_time = time.perf_counter()
@@ -49,41 +130,197 @@ class Player:
     def __timeover(self):
         return time.perf_counter() - self.__start_time >= 0.9 * self.timeout
 
+    def warmup(self) -> float:
+        """
+        goes once through the code of the first move, so that one-off costs (first call of the network,
+        allocation of its buffers) are paid before the clock of the game starts
+        :return: seconds spent
+        """
+        start = time.perf_counter()
+        state = Game().current_state
+        if self.brain is not None:
+            # a full batch allocates the largest buffers of the search. The partial batches flushed after
+            # batch_wait, and the ones shrunk by the cache, still reach the network with other sizes
+            states = [state] * self.batch_size
+            if self.policy:
+                self.brain.predict_policy_batch(states)
+            else:
+                self.brain.predict_batch(states)
+        state.transition_function(state.actions[0])
+        elapsed = time.perf_counter() - start
+        lg.logger_player.info('WARMUP TOOK {:.3f} s'.format(elapsed))
+        return elapsed
+
     def reset(self):
+        self.save_book()
+        # the book merged by the other processes
+        self.book = OpeningBook(self.book_file)
         self.turn = 1
+        self.past_states.clear()
         if self.mcts is not None:
             self.mcts.delete_tree()
             self.mcts = None
+        if self.alphabeta is not None:
+            self.alphabeta.reset()
 
     def build_mcts(self, state):
-        """"""
+        """
+        moves the root of the tree to state, creating the tree on the first move
+        :return: the action to play without searching, a winning one or one of the opening book, None to search
+        """
         lg.logger_player.info("BUILDING MCTS")
-        """if self.mcts is None:
-            if self.turn == 1:
-                self.mcts = self.load_history(state)
-                if self.color == -1:
-                    self.mcts.new_root(Node(state))
-                    self.mcts.swap_values()"""
-        if self.mcts is None:  # may still be None if state does not exist in history
-            self.mcts = MCTS(self.color, Node(state), self.c_puct)
+        start = time.perf_counter()
+        if self.mcts is None:
+            self.mcts = MCTS(self.color, Node(state), self.c_puct, self.past_states, seed=self.seed,
+                             workers=self.workers, puct=self.policy)
             win_action = None
         else:
             win_action = self.mcts.new_root(Node(state))
+        self.profiler.record('root_change', time.perf_counter() - start)
+        if win_action is None:
+            win_action = self.use_book()
         return win_action
 
+    def use_book(self):
+        """
+        looks up the root in the opening book. Without noise, the most visited move of a position searched
+        BOOK_INSTANT_VISITS times is played at once, otherwise the statistics of the book, scaled down to
+        BOOK_SEED_VISITS, are added to the edges of a root that has none yet
+        :return: the action of the book, None to search
+        """
+        self.book_seed = None
+        if self.turn > cfg.BOOK_TURNS or len(self.book) == 0:
+            return None
+        root = self.mcts.root
+        stats = self.book.lookup(root.state)
+        if stats is None or np.sum(stats[0]) < cfg.BOOK_MIN_VISITS:
+            return None
+        N, W = stats
+        total = np.sum(N)
+        if root.is_leaf():
+            self.mcts.expand_leaf(root)
+        if not self.noise and total >= cfg.BOOK_INSTANT_VISITS:
+            visited = np.flatnonzero(N)
+            self.search_policy = (actionspace.action_indexes([root.state.actions[i] for i in visited]),
+                                  (N[visited] / total).astype(np.float32))
+            edge = root.edges[int(np.argmax(N))]
+            lg.logger_player.info('BOOK ACTION: {}, {:.0f} VISITS'.format(edge.action, total))
+            self.end_turn(edge.out_node)
+            return edge.action
+        if any(edge.N > 0 for edge in root.edges):
+            # the subtree kept from the previous move has statistics of its own
+            return None
+        scale = min(1., cfg.BOOK_SEED_VISITS / total)
+        for edge, n, w in zip(root.edges, N, W):
+            if n > 0:
+                edge.N += n * scale
+                edge.W += w * scale
+                edge.Q = edge.W / edge.N
+        self.book_seed = (N * scale, W * scale)
+        lg.logger_player.info('ROOT SEEDED FROM THE BOOK, {:.0f} VISITS'.format(total))
+        return None
+
+    def record_root(self):
+        """ keeps the statistics of the search of the root, without the ones of the book, until save_book """
+        root = self.mcts.root
+        N = np.array([edge.N for edge in root.edges], dtype=np.float64)
+        W = np.array([edge.W for edge in root.edges], dtype=np.float64)
+        if self.book_seed is not None:
+            N -= self.book_seed[0]
+            W -= self.book_seed[1]
+        self.book_rows.append(book.rows(root.state, root.state.actions, N, W))
+        if self.turn == cfg.BOOK_TURNS:
+            self.save_book()
+
+    def save_book(self):
+        """ merges the recorded statistics into the opening book """
+        if self.book_rows and self.book_file is not None:
+            book.merge(np.concatenate(self.book_rows), self.book_file)
+        self.book_rows = []
+
+    def _root_priors_steps(self):
+        """ generator evaluating the priors of the root, if it was never evaluated, and adding the noise """
+        root = self.mcts.root
+        if not root.has_priors:
+            # with an empty path there is nothing to backpropagate, only the priors are set
+            yield [(root, [])]
+        if self.noise:
+            self.mcts.add_dirichlet_noise()
+
+    def forced_action(self, state, deadline: float = None):
+        """
+        looks for a forced win when the king is either close to an escape or nearly surrounded
+        :param deadline: time.perf_counter() value at which the solver gives up, None for no limit
+        :return: winning action, None if no forced win was found
+        """
+        king = king_position(state.board)
+        if king is None:
+            return None
+        if not escape_routes(state.board, king) and king_attackers(state.board, king) < cfg.PN_ATTACKERS:
+            return None
+        return self.solver.solve(state, deadline)
+
     @Timeit(logger=lg.logger_player)
     def act(self, state):
         """
         computes best action based on given state
         :return action
         """
+        return self._drive(self.act_steps(state))
+
+    def _drive(self, steps):
+        """ runs a generator of search steps, evaluating its leaves with the network of the player """
+        while True:
+            try:
+                pending = next(steps)
+            except StopIteration as result:
+                return result.value
+            self._evaluate_pending(pending)
+
+    def act_steps(self, state):
+        """
+        the computation of act as a generator, so that the caller can evaluate the leaves of several searches together.
+        It yields the lists of (leaf, path) waiting for the network, the caller evaluates their states
+        and passes the results to backup before resuming it
+        :return: the action, as the value of the StopIteration
+        """
+        turn = self.turn
+        self.profiler.reset()
+        self.search_policy = None
+        action = yield from self._act_steps(state)
+        if self.search_policy is None:
+            # proven or immediately winning moves were not searched, they are the target themselves
+            self.search_policy = (actionspace.action_indexes([action]), np.ones(1, dtype=np.float32))
+        self.profiler.stop()
+        if cfg.PROFILE_FILE is not None:
+            self.profiler.dump(cfg.PROFILE_FILE, player=self.name, color=self.color, turn=turn)
+        if lg.TRACE:
+            lg.tracer_mcts.flush()
+        return action
+
+    def _act_steps(self, state):
         lg.logger_player.info("COMPUTING ACTION FOR STATE {}".format(state.id))
-        # v = self.brain.predict(state)
+        self.past_states.add(state.id)
+        # the clock of the move covers the solver too, that only gets a share of it
+        self.__start_timer()
+        forced_action = self.forced_action(state, self.__start_time + cfg.PN_TIME_SHARE * 0.9 * self.timeout)
+        if forced_action is not None:
+            lg.logger_player.info('PROVEN ACTION: {}'.format(forced_action))
+            self.turn += 1
+            return forced_action
+        if self.alphabeta is not None:
+            action = self.alphabeta.search(state, self.__timeover, self.past_states)
+            self.past_states.add(state.transition_function(action).id)
+            lg.logger_player.info('COMPUTED ACTION: {}'.format(action))
+            self.turn += 1
+            return action
         win_action = self.build_mcts(state)
         if win_action is not None:
             return win_action
         else:
-            self.simulate()
+            if self.policy:
+                yield from self._root_priors_steps()
+            yield from self.simulate_steps()
             action = self.choose_action()
             return action
 
@@ -122,6 +359,12 @@ class Player:
             lg.logger_player.info(f'ACTION: {edge.action}, N:{edge.N:0>6.0f}, W:{edge.W:0>5.0f}, Q:{edge.Q:0>2.2f}')
 
         lg.logger_player.info('COMPUTED ACTION: {}'.format(action))
+        visits = np.array([edge.N for edge in self.mcts.root.edges], dtype=np.float32)
+        if np.sum(visits) > 0:
+            self.search_policy = (actionspace.action_indexes([edge.action for edge in self.mcts.root.edges]),
+                                  visits / np.sum(visits))
+        if self.record_book and self.turn <= cfg.BOOK_TURNS:
+            self.record_root()
         self.end_turn(self.mcts.root.edges[act_idx].out_node)
         return action
 
@@ -130,89 +373,168 @@ class Player:
         Performs the monte carlo simulations
         """
         self.__start_timer()
+        self._drive(self.simulate_steps())
+
+    def simulate_steps(self):
+        """
+        generator performing the monte carlo simulations, it yields the leaves waiting for the network, see act_steps.
+        The simulations stop when the time of the move, started by act_steps or simulate, is over
+        """
+        search_start = time.perf_counter()
+        profiler = self.profiler
         simulations = 0
+        pending = []  # leaves waiting for the network, with their paths
+        pending_start = None
         segment = 6
         K = 1
         while not self.__timeover():
+            if self.max_simulations is not None and simulations >= self.max_simulations:
+                break
             if simulations >= np.exp2(segment):
                 segment += 1
                 K = np.exp2(segment - 6)
             # selection
-            leaf, path = self.mcts.select_leaf()
+            start = time.perf_counter()
+            leaf, path, repeated = self.mcts.select_leaf()
+            end = time.perf_counter()
+            profiler.record('select', end - start)
             # expansion
             n = 1
-            if leaf.state.is_terminal:
+            playout_length = None
+            if repeated:
+                # the position already occurred, the game ends in a draw
+                v = 0
+            elif leaf.state.is_terminal:
                 if leaf.state.turn == self.color:
                     v = -1
                 else:
                     v = 1
             else:
+                start = time.perf_counter()
                 found_terminal = self.mcts.expand_leaf(leaf)
+                end = time.perf_counter()
+                profiler.record('expand', end - start)
                 if found_terminal:
                     if leaf.state.turn == self.color:
                         v = 1
                     else:
                         v = -1
                 elif self.brain is not None:
-                    v = self.brain.predict(leaf.state)
+                    # evaluated later in a single batch with the other pending leaves,
+                    # meanwhile the virtual loss steers the next selections away from this path
+                    self.mcts.add_virtual_loss(path)
+                    if not pending:
+                        pending_start = time.perf_counter()
+                    pending.append((leaf, path))
+                    profiler.record_iteration(len(path))
+                    if len(pending) >= self.batch_size or time.perf_counter() - pending_start >= self.batch_wait:
+                        yield pending
+                        simulations += len(pending)
+                        pending.clear()
+                        # the caller has backed up the batch, the tree can be pruned
+                        self._prune()
+                    continue
                 else:
-                    v, n, _ = self.mcts.random_playout(leaf, self.turn)
+                    v, n, playout_length, playout_time = self.mcts.random_playout(leaf, self.turn)
+                    # whatever is not spent by the slowest playout goes in spawning and communication
+                    profiler.record('playout', playout_time)
+                    profiler.record('ipc', max(0., time.perf_counter() - end - playout_time))
             # backpropagation
+            start = time.perf_counter()
             self.mcts.backpropagation(v, n, path)
+            end = time.perf_counter()
+            profiler.record('backprop', end - start)
+            if not pending:
+                self._prune()
+            profiler.record_iteration(len(path), playout_length)
             if n > 1:
-                simulations += multiprocessing.cpu_count()
+                simulations += self.mcts.workers
             else:
                 simulations += n
+        if pending:
+            yield pending
+            simulations += len(pending)
+            pending.clear()
+            self._prune()
+        profiler.simulations = simulations
+        profiler.search_time = time.perf_counter() - search_start
+        profiler.tree_nodes = self.mcts.size
         lg.logger_player.info('{:3d} SIMULATIONS PERFORMED'.format(simulations))
 
+    def _prune(self):
+        """ keeps the tree within MAX_TREE_NODES, only when no leaf is waiting for the network """
+        start = time.perf_counter()
+        self.mcts.prune()
+        self.profiler.record('prune', time.perf_counter() - start)
+
+    def _evaluate_pending(self, pending: list):
+        """
+        evaluates the pending leaves with a single network call and backpropagates their values
+        """
+        start = time.perf_counter()
+        states = [leaf.state for leaf, _ in pending]
+        if self.policy:
+            values, priors = self.cache.evaluate_policy(states, self.brain.predict_policy_batch)
+        else:
+            values, priors = self.cache.evaluate(states, self.brain.predict_batch), None
+        self.profiler.record('playout', time.perf_counter() - start)
+        self.backup(pending, values, priors)
+
+    def backup(self, pending: list, values, priors=None):
+        """
+        :param pending: (leaf, path) yielded by a search, see act_steps
+        :param values: values of the states of the leaves, for their player to move
+        :param priors: probabilities of the actions of each leaf, in the order of its edges, None without a policy
+        """
+        for i, ((leaf, path), v) in enumerate(zip(pending, values)):
+            if priors is not None:
+                self.mcts.set_priors(leaf, priors[i])
+            self.mcts.remove_virtual_loss(path)
+            # the network evaluates the state for the player to move
+            if leaf.state.turn != self.color:
+                v = -v
+            self.mcts.backpropagation(v, 1, path)
+
     @Timeit(logger=lg.logger_player)
     def replay(self, memories) -> None:
         """
         Retrain the network using the given memories
-        :param memories: iterable of memories, i.e. objects with attributes 'state', ' value', 'turn'
+        :param memories: ReplayBuffer with the positions, their values and the search policies,
+                         used as targets of the policy head
         """
+        from pytablut import pipeline
+
         lg.logger_player.info('RETRAINING MODEL')
+        # the values computed by the old weights are no longer valid
+        self.cache.clear()
 
-        for i in range(cfg.TRAINING_LOOPS):
-            minibatch = np.random.choice(memories, min(cfg.BATCH_SIZE, len(memories)))
-            X = np.array([memory['state'].convert_into_cnn() for memory in minibatch])
-            y = np.array([memory['value'] for memory in minibatch])
+        # a single fit on fresh randomly transformed batches, prepared in background.
+        # Positions without a search policy get an all zero target, that gives no policy loss
+        stream = pipeline.Prefetcher(pipeline.batches(memories, min(cfg.BATCH_SIZE, len(memories)),
+                                                      policy=self.brain.has_policy))
+        try:
+            loss = self.brain.fit_stream(pipeline.to_tf_dataset(stream, policy=self.brain.has_policy),
+                                         epochs=cfg.EPOCHS, steps_per_epoch=cfg.TRAINING_LOOPS, verbose=cfg.VERBOSE)
+        finally:
+            stream.close()
+        lg.logger_nnet.info('LOSS {}'.format(loss.history))
 
-            loss = self.brain.fit(X, y, epochs=cfg.EPOCHS, verbose=cfg.VERBOSE,
-                                  validation_split=0, batch_size=minibatch.size)
-            lg.logger_nnet.info('ITERATION {:3d}/{:3d}, LOSS {}'.format(i, cfg.TRAINING_LOOPS, loss.history))
+    def save_cache(self):
+        """ saves the values computed by the network, so that the next games can reuse them """
+        if self.cache_file is not None:
+            lg.logger_player.info('CACHE STATS: {}'.format(self.cache.stats()))
+            self.cache.save(self.cache_file)
 
     def _update_tau(self):
         self.tau = self.tau * self.tau_alpha
 
-    def load_history(self, state):
-        try:
-            history = pickle.load(open('model/history/root.pkl', 'rb'))
-            lg.logger_player.info('LOADING HISTORY FROM MEMORY')
-            return history
-        except FileNotFoundError:
-            lg.logger_player.info('NO HISTORY FOUND FOR CURRENT STATE')
-            return None
-
-    def save_history(self):
-        if self.turn == 1:
-            self.mcts.cut_tree(2)
-            if self.color == 1:
-                pickle.dump(self.mcts, open('model/history/root.pkl', 'wb'))
-            else:
-                state = self.mcts.root.state
-                # TODO implement merging and save on same file
-                pickle.dump(self.mcts, open(f'model/history/{state.id}.pkl', 'wb'))
-        else:
-            raise Exception('Wrong level')
-
     def end_turn(self, node: Node):
         """
         :param node: node of the chosen action
         """
-
-        if self.turn == 1 and self.brain is None:
-            self.save_history()
+        self.past_states.add(node.id)
         self.turn += 1
+        start = time.perf_counter()
         self.mcts.new_root(node)
+        self.profiler.record('root_change', time.perf_counter() - start)
         self._update_tau()
@@ -0,0 +1,116 @@
+import time
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.game import State
+
+INF = float('inf')
+
+
+class PNNode:
+
+    __slots__ = ('state', 'action', 'parent', 'children', 'is_or', 'depth', 'proof', 'disproof')
+
+    def __init__(self, state: State, action, parent, is_or: bool, depth: int):
+        """
+        node of the proof number search tree
+        :param state: state of the node
+        :param action: action that led from the parent to this node
+        :param is_or: True if the player we are trying to prove a win for is to move
+        :param depth: distance from the root
+        """
+        self.state: State = state
+        self.action: tuple = action
+        self.parent: PNNode = parent
+        self.children: list = []
+        self.is_or: bool = is_or
+        self.depth: int = depth
+        self.proof = 1
+        self.disproof = 1
+
+
+class ProofNumberSearch:
+
+    def __init__(self, player: int, max_nodes: int = cfg.PN_NODES, max_depth: int = cfg.PN_MAX_DEPTH):
+        """
+        proof number search looking for forced wins of a player
+        :param player: player we are trying to prove a win for, 1 for white and -1 for black
+        :param max_nodes: maximum number of nodes generated by a single search
+        :param max_depth: maximum number of plies searched, deeper nodes count as not won
+        """
+        self.player = player
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.nodes = 0
+
+    def solve(self, state: State, deadline: float = None):
+        """
+        :param state: state in which self.player is to move
+        :param deadline: time.perf_counter() value at which the search gives up, None for no limit
+        :return: an action leading to a forced win, None if no win was proven within the budget
+        """
+        root = PNNode(state, None, None, True, 0)
+        self._evaluate(root)
+        self.nodes = 1
+        while root.proof != 0 and root.disproof != 0 and self.nodes < self.max_nodes:
+            if deadline is not None and time.perf_counter() >= deadline:
+                lg.logger_player.info('PN SEARCH OUT OF TIME')
+                break
+            node = self._select_most_proving(root)
+            self._expand(node)
+            self._update_ancestors(node)
+
+        lg.logger_player.info('PN SEARCH: PROOF {}, DISPROOF {}, {} NODES'.format(root.proof, root.disproof,
+                                                                                 self.nodes))
+        if root.proof == 0:
+            for child in root.children:
+                if child.proof == 0:
+                    return child.action
+        return None
+
+    def _evaluate(self, node: PNNode):
+        state = node.state
+        if state.is_terminal:
+            # state.value is -1 when the player to move has lost
+            if state.value == -1 and state.turn != self.player:
+                node.proof, node.disproof = 0, INF
+            else:
+                node.proof, node.disproof = INF, 0
+        elif node.depth >= self.max_depth:
+            node.proof, node.disproof = INF, 0
+
+    def _select_most_proving(self, node: PNNode) -> PNNode:
+        while node.children:
+            if node.is_or:
+                node = min(node.children, key=lambda child: child.proof)
+            else:
+                node = min(node.children, key=lambda child: child.disproof)
+        return node
+
+    def _expand(self, node: PNNode):
+        for action in node.state.actions:
+            child = PNNode(node.state.transition_function(action), action, node, not node.is_or, node.depth + 1)
+            self._evaluate(child)
+            node.children.append(child)
+            self.nodes += 1
+            if node.is_or and child.proof == 0 or not node.is_or and child.disproof == 0:
+                # the node is already solved, no need to generate the other children
+                break
+        self._set_numbers(node)
+
+    def _set_numbers(self, node: PNNode):
+        if node.is_or:
+            node.proof = min(child.proof for child in node.children)
+            node.disproof = sum(child.disproof for child in node.children)
+        else:
+            node.proof = sum(child.proof for child in node.children)
+            node.disproof = min(child.disproof for child in node.children)
+
+    def _update_ancestors(self, node: PNNode):
+        node = node.parent
+        while node is not None:
+            proof, disproof = node.proof, node.disproof
+            self._set_numbers(node)
+            if proof == node.proof and disproof == node.disproof:
+                break
+            node = node.parent
@@ -0,0 +1,87 @@
+import json
+import time
+
+
+class SearchProfiler:
+    """
+    Collects per phase timings and tree statistics of the search for a single move.
+    Latencies are stored in histograms with power of two buckets of microseconds:
+    bucket i counts durations in [2^(i-1), 2^i) us, bucket 0 durations below 1 us
+    """
+
+    PHASES = ('select', 'expand', 'playout', 'ipc', 'backprop', 'prune', 'root_change')
+    BUCKETS = 25  # the last bucket collects everything above ~8 s
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {phase: 0 for phase in self.PHASES}
+        self.totals = {phase: 0. for phase in self.PHASES}
+        self.maxima = {phase: 0. for phase in self.PHASES}
+        self.histograms = {phase: [0] * self.BUCKETS for phase in self.PHASES}
+        self.iterations = 0
+        self.simulations = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.playouts = 0
+        self.playout_length_sum = 0.
+        self.tree_nodes = 0
+        self.search_time = 0.
+        self.start_time = time.perf_counter()
+        self.elapsed = 0.
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.start_time
+
+    def record(self, phase: str, seconds: float):
+        """ records a single execution of a phase """
+        self.counts[phase] += 1
+        self.totals[phase] += seconds
+        if seconds > self.maxima[phase]:
+            self.maxima[phase] = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.histograms[phase][min(bucket, self.BUCKETS - 1)] += 1
+
+    def record_iteration(self, depth: int, playout_length: float = None):
+        """
+        records the end of a search iteration
+        :param depth: length of the selected path
+        :param playout_length: average length of the playouts, None if no playout was performed
+        """
+        self.iterations += 1
+        self.depth_sum += depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if playout_length is not None:
+            self.playouts += 1
+            self.playout_length_sum += float(playout_length)
+
+    def summary(self) -> dict:
+        phases = dict()
+        for phase in self.PHASES:
+            count = self.counts[phase]
+            phases[phase] = {'count': count,
+                             'total_s': self.totals[phase],
+                             'mean_us': self.totals[phase] / count * 1e6 if count else 0.,
+                             'max_us': self.maxima[phase] * 1e6,
+                             'histogram_us': {f'<{2 ** i}': n
+                                              for i, n in enumerate(self.histograms[phase]) if n > 0}}
+        return {'elapsed_s': self.elapsed,
+                'search_s': self.search_time,
+                'iterations': self.iterations,
+                'simulations': int(self.simulations),
+                'simulations_per_s': self.simulations / self.search_time if self.search_time > 0 else 0.,
+                'tree_nodes': self.tree_nodes,
+                'max_depth': self.max_depth,
+                'avg_depth': self.depth_sum / self.iterations if self.iterations else 0.,
+                'avg_playout_length': self.playout_length_sum / self.playouts if self.playouts else 0.,
+                'phases': phases}
+
+    def dump(self, file: str, **info):
+        """
+        appends the summary as a single JSON line to file
+        :param info: additional fields to store, e.g. player name and turn
+        """
+        with open(file, 'a') as f:
+            f.write(json.dumps({**info, **self.summary()}) + '\n')
@@ -0,0 +1,226 @@
+"""
+Post-training quantization of the value network for faster CPU inference.
+A saved model/brain/v{N}.h5 is converted with TensorFlow Lite either to int8 weights with
+per-channel scales (activations are quantized too when the replay buffer has positions to calibrate them)
+or to float16 weights, and written to model/brain/v{N}.{int8,float16}.tflite.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.quantize 3 --modes int8 float16 --report 2000
+
+TensorFlow is only needed for the conversion and the report,
+playing with a quantized model works with the lighter tflite_runtime package too.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.game import encode_boards, encode_states
+from pytablut.memory import ReplayBuffer
+
+MODES = ('int8', 'float16')
+
+
+def model_file(version: int, mode: str) -> str:
+    return 'model/brain/v{}.{}.tflite'.format(version, mode)
+
+
+def encode(positions: dict) -> np.ndarray:
+    """ :param positions: positions read from the replay buffer, see ReplayBuffer.get """
+    return encode_boards(positions['boards'], positions['turns'])
+
+
+def convert(version: int, mode: str, calibration: np.ndarray = None) -> str:
+    """
+    :param calibration: network inputs used to choose the scales of the int8 activations,
+                        if None only the weights are quantized
+    :return: name of the written file
+    """
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model('model/brain/v{}.h5'.format(version), compile=False)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        if calibration is not None:
+            def representative_dataset():
+                for x in calibration:
+                    yield [x[np.newaxis]]
+            converter.representative_dataset = representative_dataset
+    else:
+        raise ValueError(f'wrong quantization mode: {mode}')
+    file = model_file(version, mode)
+    with open(file, 'wb') as f:
+        f.write(converter.convert())
+    lg.logger_nnet.info('QUANTIZED MODEL v{} TO {}'.format(version, file))
+    return file
+
+
+class QuantizedValueNet:
+
+    def __init__(self, file: str, input_shape=cfg.IN_SHAPE, capacity: int = cfg.NN_BATCH_SIZE):
+        """
+        :param file: .tflite file written by convert
+        :param capacity: batch size the interpreter is allocated for, smaller batches are padded to it
+        """
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.input_shape = input_shape
+        self.input_buffer = np.empty((cfg.NN_BATCH_SIZE,) + tuple(input_shape), dtype=np.float32)
+        self.interpreter = Interpreter(model_path=file)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        outputs = self.interpreter.get_output_details()
+        # the value has shape (N, 1), the policy, if the model has the head, (N, 9, 9, 32)
+        self.output_index = [output['index'] for output in outputs if len(output['shape']) == 2][0]
+        policy = [output['index'] for output in outputs if len(output['shape']) == 4]
+        self.has_policy = len(policy) > 0
+        self.policy_index = policy[0] if self.has_policy else None
+        self._allocate(capacity)
+        lg.logger_nnet.info('LOADED QUANTIZED MODEL FROM {}'.format(file))
+
+    def _allocate(self, capacity: int):
+        self.interpreter.resize_tensor_input(self.input_index, (capacity,) + tuple(self.input_shape))
+        self.interpreter.allocate_tensors()
+        self.capacity = capacity
+        self.padded = np.zeros((capacity,) + tuple(self.input_shape), dtype=np.float32)
+
+    def _invoke(self, X: np.ndarray) -> int:
+        """ :return: number of positions in X, the outputs have capacity rows """
+        n = X.shape[0]
+        if n > self.capacity:
+            # allocating the tensors is slow, so the capacity only grows, to the next power of two
+            self._allocate(1 << (n - 1).bit_length())
+        # the rows after the batch keep old positions, their outputs are discarded
+        self.padded[:n] = X
+        self.interpreter.set_tensor(self.input_index, self.padded)
+        self.interpreter.invoke()
+        return n
+
+    def forward(self, X: np.ndarray) -> np.ndarray:
+        """
+        :param X: network inputs of shape (N, 9, 9, 4)
+        :return: np.array of shape (N,) with the values
+        """
+        n = self._invoke(X)
+        return self.interpreter.get_tensor(self.output_index)[:n, 0].copy()
+
+    def forward_policy(self, X: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        :param X: network inputs of shape (N, 9, 9, 4)
+        :return: np.array of shape (N,) with the values and one of shape (N, 9, 9, 32) with the policy logits
+        """
+        n = self._invoke(X)
+        return (self.interpreter.get_tensor(self.output_index)[:n, 0].copy(),
+                self.interpreter.get_tensor(self.policy_index)[:n].copy())
+
+    def state_to_model_input(self, state):
+        converted = state.convert_into_cnn()
+        model_input = np.reshape(converted, self.input_shape)
+        return model_input
+
+    def predict(self, state):
+        """
+            :return: the value of the state
+        """
+        return self.predict_batch([state])[0]
+
+    def predict_batch(self, states):
+        """
+            :return: np.array with the values of the states
+        """
+        if len(states) > len(self.input_buffer):
+            self.input_buffer = np.empty((len(states),) + tuple(self.input_shape), dtype=np.float32)
+        return self.forward(encode_states(states, self.input_buffer))
+
+    def predict_policy_batch(self, states):
+        """
+            :return: np.array with the values of the states and one with their 9x9x32 policy logits
+        """
+        if len(states) > len(self.input_buffer):
+            self.input_buffer = np.empty((len(states),) + tuple(self.input_shape), dtype=np.float32)
+        return self.forward_policy(encode_states(states, self.input_buffer))
+
+
+def throughput(forward, X: np.ndarray, batch_size: int, min_time: float = 1.) -> float:
+    """ :return: evaluations per second """
+    evaluated = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        for i in range(0, len(X), batch_size):
+            evaluated += len(forward(X[i:i + batch_size]))
+    return evaluated / (time.perf_counter() - start)
+
+
+def report(version: int, modes, X: np.ndarray, y: np.ndarray) -> dict:
+    """
+    compares the quantized models with the float32 one on held out positions
+    :param X: network inputs
+    :param y: values of the positions stored in the replay buffer
+    """
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model('model/brain/v{}.h5'.format(version), compile=False)
+
+    def reference(inputs):
+        preds = model.predict_on_batch(inputs)
+        if len(model.outputs) > 1:
+            # the value head comes first, see ResidualNN._build_model
+            preds = preds[0]
+        return np.asarray(preds)[:, 0]
+
+    expected = reference(X)
+    results = {'float32': {'mse_target': float(np.mean((expected - y) ** 2)),
+                           'evals_per_s_batch1': throughput(reference, X[:200], 1),
+                           'evals_per_s_batch16': throughput(reference, X, 16)}}
+    for mode in modes:
+        net = QuantizedValueNet(model_file(version, mode), capacity=256)
+        predicted = np.concatenate([net.forward(X[i:i + 256]) for i in range(0, len(X), 256)])
+        error = np.abs(predicted - expected)
+        # the batches are padded to the capacity of the interpreter, each size gets its own
+        single, batched = (QuantizedValueNet(model_file(version, mode), capacity=size) for size in (1, 16))
+        results[mode] = {'mean_abs_error': float(np.mean(error)),
+                         'max_abs_error': float(np.max(error)),
+                         'sign_agreement': float(np.mean(np.sign(predicted) == np.sign(expected))),
+                         'mse_target': float(np.mean((predicted - y) ** 2)),
+                         'evals_per_s_batch1': throughput(single.forward, X[:200], 1),
+                         'evals_per_s_batch16': throughput(batched.forward, X, 16)}
+    lg.logger_nnet.info('QUANTIZATION REPORT v{}: {}'.format(version, results))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a trained value network.')
+    parser.add_argument('version', type=int,
+                        help='version of the model in model/brain to quantize')
+    parser.add_argument('-m', '--modes', type=str, nargs='+', default=list(MODES), choices=MODES,
+                        help='quantized variants to produce')
+    parser.add_argument('-c', '--calibration', type=int, default=500,
+                        help='positions used to calibrate int8 activations, 0 quantizes only the weights')
+    parser.add_argument('-r', '--report', type=int, default=0,
+                        help='held out positions used to compare with the float32 model, 0 skips the report')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to split the positions')
+    args = parser.parse_args()
+
+    buffer = ReplayBuffer() if ReplayBuffer.exists() else None
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(buffer)) if buffer is not None else np.empty(0, dtype=int)
+    calibration_set = order[:args.calibration]
+    held_out = order[args.calibration:args.calibration + args.report]
+
+    for mode in args.modes:
+        print('written', convert(args.version, mode,
+                                 encode(buffer.get(calibration_set)) if len(calibration_set) else None))
+    if args.report > 0:
+        if not len(held_out):
+            parser.error('no positions left in the replay buffer for the report')
+        positions = buffer.get(held_out)
+        results = report(args.version, args.modes, encode(positions), positions['values'])
+        for name, result in results.items():
+            print(name, ', '.join(f'{k} {v:.4g}' for k, v in result.items()))
@@ -0,0 +1,159 @@
+"""
+Measures how playing strength scales with compute.
+Players differing only in one budget (timeout, simulations or workers) play each other
+in a local game loop; every pair of consecutive budgets gives an Elo difference and all of them
+are combined in an estimate of the Elo gained for each doubling of the budget.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.scaling --axis simulations --values 16 32 64 --games 20
+"""
+import argparse
+import json
+
+import numpy as np
+
+import pytablut.loggers as lg
+from pytablut.game import Game
+from pytablut.player import Player
+from pytablut.utils import setup_folders
+
+Z95 = 1.96
+
+
+def play_game(white: Player, black: Player, max_moves: int) -> int:
+    """
+    plays a single game
+    :return: 1 if white won, -1 if black won, 0 for a draw
+    """
+    game = Game()
+    white.reset()
+    black.reset()
+    moves = 0
+    while not game.current_state.is_terminal and moves < max_moves:
+        if game.current_player == 1:
+            act = white.act(game.current_state)
+        else:
+            act = black.act(game.current_state)
+        game.execute(act)
+        moves += 1
+    if not game.current_state.is_terminal or game.current_state.value == 0:
+        return 0
+    # the player of this turn has lost
+    return -game.current_state.turn
+
+
+def make_player(color: str, axis: str, value: int, args, seed: int) -> Player:
+    budget = {'timeout': args.timeout, 'max_simulations': args.simulations, 'workers': args.workers}
+    budget[{'timeout': 'timeout', 'simulations': 'max_simulations', 'workers': 'workers'}[axis]] = value
+    # without the opening book, its moves would be played the same at every budget
+    return Player(color=color, name=f'{axis}{value}', engine=args.engine, seed=seed, book=None, **budget)
+
+
+def match(axis: str, weak: int, strong: int, args) -> list:
+    """
+    plays args.games games between two budgets, alternating colors
+    :return: list of scores of the strong player, 1 for a win, 0.5 for a draw, 0 for a loss
+    """
+    scores = []
+    for game in range(args.games):
+        seed = args.seed + game
+        strong_color = 1 if game % 2 == 0 else -1
+        if strong_color == 1:
+            white = make_player('WHITE', axis, strong, args, seed)
+            black = make_player('BLACK', axis, weak, args, seed)
+        else:
+            white = make_player('WHITE', axis, weak, args, seed)
+            black = make_player('BLACK', axis, strong, args, seed)
+        winner = play_game(white, black, args.max_moves)
+        scores.append(0.5 if winner == 0 else float(winner == strong_color))
+        lg.logger_train.info('SCALING {} {} VS {}, GAME {:d}, SCORE {}'.format(axis, strong, weak, game, scores[-1]))
+        print(f'{axis} {strong} vs {weak}, game {game}: {scores[-1]}')
+    return scores
+
+
+def elo(score: float) -> float:
+    """ :return: Elo difference corresponding to an expected score """
+    score = np.clip(score, 1e-3, 1 - 1e-3)
+    return 400 * np.log10(score / (1 - score))
+
+
+def elo_interval(scores: list) -> (float, float, float):
+    """ :return: Elo difference and the bounds of its 95% confidence interval """
+    mean = np.mean(scores)
+    std = np.std(scores)
+    if std == 0:
+        # all games ended the same way, fall back to the largest possible deviation
+        std = 0.5
+    se = std / np.sqrt(len(scores))
+    return elo(mean), elo(mean - Z95 * se), elo(mean + Z95 * se)
+
+
+def fit_doubling(pairs: list) -> dict:
+    """
+    combines the matches in a single Elo per doubling estimate,
+    weighting each pair by the inverse variance of its estimate
+    :param pairs: list of dicts with keys 'doublings', 'elo', 'low', 'high'
+    """
+    gains = []
+    weights = []
+    for pair in pairs:
+        gain = pair['elo'] / pair['doublings']
+        # standard error derived from the width of the confidence interval
+        se = max((pair['high'] - pair['low']) / (2 * Z95 * pair['doublings']), 1.)
+        gains.append(gain)
+        weights.append(1 / se ** 2)
+    gains = np.array(gains)
+    weights = np.array(weights)
+    mean = np.sum(gains * weights) / np.sum(weights)
+    se = 1 / np.sqrt(np.sum(weights))
+    return {'elo_per_doubling': float(mean), 'low': float(mean - Z95 * se), 'high': float(mean + Z95 * se)}
+
+
+def run(args) -> dict:
+    values = sorted(args.values)
+    pairs = []
+    for weak, strong in zip(values[:-1], values[1:]):
+        scores = match(args.axis, weak, strong, args)
+        diff, low, high = elo_interval(scores)
+        pairs.append({'weak': weak, 'strong': strong, 'doublings': float(np.log2(strong / weak)),
+                      'games': len(scores), 'score': float(np.mean(scores)),
+                      'elo': float(diff), 'low': float(low), 'high': float(high)})
+    return {'axis': args.axis, 'engine': args.engine, 'pairs': pairs, 'fit': fit_doubling(pairs)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure playing strength as a function of compute.')
+    parser.add_argument('-a', '--axis', type=str, default='timeout', choices=['timeout', 'simulations', 'workers'],
+                        help='budget varied between the players')
+    parser.add_argument('-v', '--values', type=int, nargs='+', required=True,
+                        help='values of the budget, e.g. 1 2 4 8')
+    parser.add_argument('-g', '--games', type=int, default=20,
+                        help='games played between every pair of consecutive budgets')
+    parser.add_argument('-e', '--engine', type=str, default='mcts', choices=['mcts', 'alphabeta'],
+                        help='search engine of both players')
+    parser.add_argument('-t', '--timeout', type=int, default=10,
+                        help='timeout in seconds when it is not the varied budget')
+    parser.add_argument('-s', '--simulations', type=int, default=None,
+                        help='simulations per move when it is not the varied budget')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='parallel playouts when it is not the varied budget')
+    parser.add_argument('--max-moves', type=int, default=200,
+                        help='games longer than this are considered draws')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the first game, the following ones use the next seeds')
+    parser.add_argument('--save', type=str, default=None,
+                        help='file where results are saved as JSON')
+    args = parser.parse_args()
+    if len(args.values) < 2:
+        parser.error('at least two values are needed')
+    setup_folders()
+
+    results = run(args)
+    for pair in results['pairs']:
+        print(f'{pair["strong"]} vs {pair["weak"]}: score {pair["score"]:.2f}, '
+              f'Elo {pair["elo"]:+.0f} [{pair["low"]:+.0f}, {pair["high"]:+.0f}]')
+    fit = results['fit']
+    print(f'Elo per doubling of {args.axis}: {fit["elo_per_doubling"]:+.0f} [{fit["low"]:+.0f}, {fit["high"]:+.0f}]')
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,422 @@
+"""
+Parallel self-play: W worker processes, each with its own pair of players and random seed,
+play games and archive them in the Dataset, that several processes can append to at the same time.
+Crashed workers are restarted, Ctrl+C stops all of them between two moves.
+With a network, the workers evaluate their leaves through a shared inference.InferenceServer
+instead of loading a copy each, unless INFERENCE_SERVER is False.
+With follow, the workers move to the newest version published by the trainer between two games.
+Alternatively lockstep plays G games in a single process, interleaving their searches
+so that every network call evaluates the leaves of all the G trees.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.selfplay --workers 8 --games 200 --model 3 --simulations 400
+    python -m pytablut.selfplay --lockstep 64 --games 200 --model 3 --simulations 400
+    python -m pytablut.selfplay --follow --games 100000 --model 3 --simulations 400
+"""
+import argparse
+import os
+import queue
+import signal
+import time
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+import pytablut.checkpoints as checkpoints
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.dataset import Dataset
+from pytablut.evalcache import EvaluationCache
+from pytablut.game import Game
+from pytablut.inference import InferenceClient, InferenceServer
+from pytablut.memory import Memory
+from pytablut.utils import Timeit
+
+ENDGAME_MAP = {0: 'DRAW', 1: 'WHITE', -1: 'BLACK'}
+
+
+@Timeit(logger=lg.logger_train)
+def self_play(p1, p2, memory: Memory, stop=None):
+    """
+    play one match of self play, saving the results in memory
+    :param stop: event that interrupts the game between two moves, the positions are then discarded
+    :return: the winner, 0 for a draw, None if the game was interrupted
+    """
+    game = Game()
+    p1.reset()
+    p2.reset()
+
+    while not game.current_state.is_terminal:
+        if stop is not None and stop.is_set():
+            memory.clear_stmemory()
+            return None
+        if game.current_player == 1:
+            turn = 'WHITE'
+            player = p1
+        else:
+            turn = 'BLACK'
+            player = p2
+        act = player.act(game.current_state)
+        lg.logger_train.info('{} TURN, ACTION: {}'.format(turn, act))
+        memory.commit_stmemory(game.current_state, player.search_policy)
+        game.execute(act)
+    return commit_result(game, memory)
+
+
+def commit_result(game: Game, memory: Memory) -> int:
+    """ commits the positions of a finished game with its result :return: the winner, 0 for a draw """
+    if game.current_state.value == 0:  # it's a draw
+        winner = 0
+    else:  # the player of this turn has lost
+        winner = -game.current_state.turn
+    lg.logger_train.info('WINNER OF THIS EPISODE: {}'.format(ENDGAME_MAP[winner]))
+    memory.commit_ltmemory(winner)
+    return winner
+
+
+class LockstepGame:
+
+    def __init__(self, white, black, memory: Memory):
+        """
+        a game of lockstep self-play, with its own players and memory
+        """
+        self.white = white
+        self.black = black
+        self.memory = memory
+        self.game = None
+        self.player = None
+        self.steps = None  # search of the move in progress, see Player.act_steps
+        self.start = None
+
+    def new_game(self):
+        self.game = Game()
+        self.white.reset()
+        self.black.reset()
+        self.steps = None
+        self.start = time.perf_counter()
+
+    def step(self):
+        """
+        plays until the search of the player to move needs the network
+        :return: the (leaf, path) to evaluate, to pass to self.player.backup, None when the game is over
+        """
+        while self.steps is not None or not self.game.current_state.is_terminal:
+            if self.steps is None:
+                self.player = self.white if self.game.current_player == 1 else self.black
+                self.steps = self.player.act_steps(self.game.current_state)
+            try:
+                return next(self.steps)
+            except StopIteration as result:
+                act = result.value
+            lg.logger_train.info('{} TURN, ACTION: {}'.format(ENDGAME_MAP[self.game.current_player], act))
+            self.memory.commit_stmemory(self.game.current_state, self.player.search_policy)
+            self.game.execute(act)
+            self.steps = None
+        return None
+
+    def finish(self) -> int:
+        """ :return: the winner of the finished game, 0 for a draw """
+        return commit_result(self.game, self.memory)
+
+
+def lockstep(games: int = cfg.EPISODES, parallel: int = cfg.LOCKSTEP_GAMES, nnet_ver: int = None,
+             backend: str = 'keras', seed: int = None, dataset_path: str = cfg.DATASET_DIR, **options) -> dict:
+    """
+    plays games in a single process, advancing parallel of them at once: each search runs until its leaves
+    fill a batch, then the leaves of all the games are evaluated with one network call.
+    The clock keeps running while the other games search, so by default the moves are bounded
+    by MCTS_SIMULATIONS simulations instead of the timeout
+    :param nnet_ver: version of the network, shared by all the players
+    :param options: arguments of the players, e.g. max_simulations, batch_size
+    :return: statistics of the run, 'interrupted' is True if Ctrl+C stopped it
+    """
+    from pytablut.player import Player, load_brain
+
+    if nnet_ver is None:
+        raise ValueError('lockstep self-play needs a network')
+    options.setdefault('timeout', float('inf'))
+    options.setdefault('max_simulations', cfg.MCTS_SIMULATIONS)
+    brain, _ = load_brain(nnet_ver, backend)
+    cache = EvaluationCache()
+    dataset = Dataset(dataset_path)
+    seeds = np.random.SeedSequence(seed).generate_state(2 * parallel)
+    if seed is not None:
+        np.random.seed(seed)
+
+    slots = []
+    for i in range(min(parallel, games)):
+        white = Player(color='WHITE', name='white{}'.format(i), seed=int(seeds[2 * i]), noise=True,
+                       brain=brain, **options)
+        black = Player(color='BLACK', name='black{}'.format(i), seed=int(seeds[2 * i + 1]), noise=True,
+                       brain=brain, **options)
+        slots.append(LockstepGame(white, black, Memory(dataset=dataset, version=nnet_ver)))
+        slots[-1].new_game()
+    started = len(slots)
+    stats = {'games': 0, 'results': {name: 0 for name in ENDGAME_MAP.values()}, 'batches': 0, 'positions': 0,
+             'interrupted': False}
+
+    begin = time.perf_counter()
+    lg.logger_train.info('STARTING LOCKSTEP SELF-PLAY OF {} GAMES, {} AT ONCE'.format(games, len(slots)))
+    try:
+        while slots:
+            batch = []  # (game, leaves waiting for the network)
+            for slot in list(slots):
+                pending = slot.step()
+                while pending is None:
+                    winner = slot.finish()
+                    stats['games'] += 1
+                    stats['results'][ENDGAME_MAP[winner]] += 1
+                    lg.logger_train.info('GAME FINISHED IN {:.1f} s, {} GAMES, {:.1f} GAMES PER HOUR'.format(
+                        time.perf_counter() - slot.start, stats['games'],
+                        stats['games'] / (time.perf_counter() - begin) * 3600))
+                    if started >= games:
+                        slots.remove(slot)
+                        break
+                    slot.new_game()
+                    started += 1
+                    pending = slot.step()
+                if pending is not None:
+                    batch.append((slot, pending))
+            if not batch:
+                continue
+            states = [leaf.state for _, pending in batch for leaf, _ in pending]
+            if brain.has_policy:
+                values, priors = cache.evaluate_policy(states, brain.predict_policy_batch)
+            else:
+                values, priors = cache.evaluate(states, brain.predict_batch), None
+            offset = 0
+            for slot, pending in batch:
+                end = offset + len(pending)
+                slot.player.backup(pending, values[offset:end], priors[offset:end] if priors is not None else None)
+                offset = end
+            stats['batches'] += 1
+            stats['positions'] += len(states)
+    except KeyboardInterrupt:
+        # the unfinished games are discarded
+        lg.logger_train.info('SELF-PLAY INTERRUPTED')
+        stats['interrupted'] = True
+
+    stats['elapsed'] = time.perf_counter() - begin
+    stats['games_per_hour'] = stats['games'] / stats['elapsed'] * 3600
+    stats['mean_batch_size'] = stats['positions'] / max(stats['batches'], 1)
+    stats['cache'] = cache.stats()
+    lg.logger_train.info('SELF-PLAY FINISHED: {}'.format(stats))
+    return stats
+
+
+def worker(index: int, seed: int, options: dict, dataset_path: str, stop, results, slot=None, follow=False,
+           coordinator=None):
+    """
+    plays games until stop is set, reporting each one on the results queue
+    :param options: arguments of the two Player
+    :param slot: slot of the inference server the players evaluate through, None if they load their own network
+    :param follow: move to the newest published version of the network between two games
+    :param coordinator: (host, port) of the coordinator the games are sent to, instead of the dataset
+    """
+    from pytablut.player import Player, load_brain
+
+    # Ctrl+C is handled by the driver, that stops the workers through the event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    lg.use_log_folder(os.path.join('logs', 'selfplay{}'.format(index)))
+    try:
+        np.random.seed(seed)
+        options = dict(options)
+        backend = options.pop('backend', 'keras')
+        version = options.pop('nnet_ver', None)
+        client = InferenceClient(slot) if slot is not None else None
+        if client is not None:
+            version = client.version
+        white = Player(color='WHITE', name='white{}'.format(index), seed=seed, noise=True, **options)
+        black = Player(color='BLACK', name='black{}'.format(index), seed=seed + 1, noise=True, **options)
+        if coordinator is not None:
+            from pytablut.coordinator import RemoteDataset
+            dataset = RemoteDataset(coordinator)
+        else:
+            dataset = Dataset(dataset_path)
+        memory = Memory(dataset=dataset)
+        loaded = False
+        while not stop.is_set():
+            latest = checkpoints.latest_version() if follow and version is not None else None
+            if latest is not None and latest > version:
+                version, loaded = latest, False
+            if not loaded:
+                if client is not None:
+                    client.version = version
+                    brain, cache_file = client, None
+                else:
+                    brain, cache_file = load_brain(version, backend)
+                # the two players share the network
+                white.set_brain(brain, cache_file)
+                black.set_brain(brain, cache_file)
+                memory.version = version
+                loaded = True
+                lg.logger_train.info('PLAYING WITH MODEL v{}'.format(version))
+            start = time.perf_counter()
+            winner = self_play(white, black, memory, stop)
+            if winner is None:
+                break
+            results.put(('game', index, (winner, memory.version), time.perf_counter() - start))
+    except Exception:
+        results.put(('error', index, traceback.format_exc(), None))
+        raise
+
+
+def run(workers: int = cfg.SELF_PLAY_WORKERS, games: int = cfg.EPISODES, seed: int = None,
+        dataset_path: str = cfg.DATASET_DIR, max_restarts: int = cfg.SELF_PLAY_RESTARTS,
+        server: bool = cfg.INFERENCE_SERVER, follow: bool = False, coordinator=None, halt=None, **options) -> dict:
+    """
+    plays games with parallel workers until the requested number is reached or Ctrl+C is pressed
+    :param seed: seed the ones of the workers are derived from, None for non reproducible games
+    :param server: evaluate the network of options['nnet_ver'] in a shared inference server
+    :param follow: the workers move to the newest published version between two games, see checkpoints
+    :param coordinator: (host, port) of the coordinator the games are sent to, instead of the dataset
+    :param halt: event stopping the run as Ctrl+C does, e.g. set by a thread that cannot go on
+    :param options: arguments of the players, e.g. nnet_ver, timeout, max_simulations.
+                    Each one performs its random playouts in a single process unless workers is given
+    :return: statistics of the run, 'interrupted' is True if Ctrl+C stopped it
+    """
+    options.setdefault('workers', 1)
+    # spawned workers do not inherit the state of TensorFlow or of the parent's loggers
+    context = mp.get_context('spawn')
+    stop = context.Event()
+    results = context.Queue()
+    seeds = iter(np.random.SeedSequence(seed).generate_state(workers + max_restarts + 1))
+    processes = {}
+    inference = None
+    if follow and options.get('nnet_ver') is not None:
+        options['nnet_ver'] = max(options['nnet_ver'], checkpoints.latest_version() or 0)
+    if server and options.get('nnet_ver') is not None:
+        inference = InferenceServer(options.pop('nnet_ver'), options.pop('backend', 'keras'), clients=workers).start()
+
+    def start(index):
+        # the players of a worker use seed and seed + 1
+        process = context.Process(target=worker, name='selfplay{}'.format(index),
+                                  args=(index, int(next(seeds)) // 2 * 2, options, dataset_path, stop, results,
+                                        inference.slots[index] if inference is not None else None, follow,
+                                        coordinator))
+        process.start()
+        processes[index] = process
+
+    stats = {'games': 0, 'results': {name: 0 for name in ENDGAME_MAP.values()}, 'restarts': 0, 'errors': 0,
+             'versions': {}, 'interrupted': False}
+
+    def handle(message):
+        kind, index, payload, elapsed = message
+        if kind == 'game':
+            winner, version = payload
+            stats['games'] += 1
+            stats['results'][ENDGAME_MAP[winner]] += 1
+            # games played by each version of the network
+            stats['versions'][version] = stats['versions'].get(version, 0) + 1
+            rate = stats['games'] / (time.perf_counter() - begin) * 3600
+            lg.logger_train.info('WORKER {} FINISHED A GAME WITH MODEL v{} IN {:.1f} s, {} GAMES, '
+                                 '{:.1f} GAMES PER HOUR'.format(index, version, elapsed, stats['games'], rate))
+        else:
+            stats['errors'] += 1
+            lg.logger_train.error('WORKER {} CRASHED:\n{}'.format(index, payload))
+
+    begin = time.perf_counter()
+    lg.logger_train.info('STARTING {} SELF-PLAY WORKERS FOR {} GAMES'.format(workers, games))
+    for index in range(workers):
+        start(index)
+    try:
+        while stats['games'] < games:
+            if halt is not None and halt.is_set():
+                lg.logger_train.info('SELF-PLAY HALTED')
+                stats['interrupted'] = True
+                break
+            if inference is not None and not inference.is_alive():
+                raise RuntimeError('the inference server died')
+            try:
+                handle(results.get(timeout=1.))
+            except queue.Empty:
+                pass
+            for index, process in list(processes.items()):
+                if not process.is_alive() and process.exitcode != 0:
+                    stats['restarts'] += 1
+                    if stats['restarts'] > max_restarts:
+                        raise RuntimeError('self-play workers crashed {} times'.format(stats['restarts']))
+                    lg.logger_train.warning('RESTARTING WORKER {}, EXIT CODE {}'.format(index, process.exitcode))
+                    start(index)
+    except KeyboardInterrupt:
+        lg.logger_train.info('SELF-PLAY INTERRUPTED')
+        stats['interrupted'] = True
+    finally:
+        stop.set()
+        deadline = time.perf_counter() + cfg.SELF_PLAY_JOIN_TIMEOUT
+        # the queue is emptied while waiting, a worker does not exit until its messages are consumed
+        while any(process.is_alive() for process in processes.values()) and time.perf_counter() < deadline:
+            try:
+                handle(results.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        while True:
+            try:
+                handle(results.get_nowait())
+            except queue.Empty:
+                break
+        if inference is not None:
+            if inference.is_alive():
+                stats['inference'] = inference.stats()
+            inference.stop()
+
+    stats['elapsed'] = time.perf_counter() - begin
+    stats['games_per_hour'] = stats['games'] / stats['elapsed'] * 3600
+    lg.logger_train.info('SELF-PLAY FINISHED: {}'.format(stats))
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run self-play games in parallel.')
+    parser.add_argument('-w', '--workers', type=int, default=cfg.SELF_PLAY_WORKERS,
+                        help='number of worker processes')
+    parser.add_argument('-g', '--games', type=int, default=cfg.EPISODES,
+                        help='number of games to play')
+    parser.add_argument('-m', '--model', type=int, default=-1,
+                        help='version of the neural network to use (<0 means no network)')
+    parser.add_argument('-b', '--backend', type=str, default='keras', choices=['numpy', 'keras', 'int8', 'float16'],
+                        help='how to evaluate the neural network')
+    parser.add_argument('-t', '--timeout', type=float, default=cfg.TIMEOUT,
+                        help='seconds for each move')
+    parser.add_argument('-s', '--simulations', type=int, default=None,
+                        help='simulations for each move, the timeout still applies')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the workers')
+    parser.add_argument('-d', '--dataset', type=str, default=cfg.DATASET_DIR,
+                        help='folder of the dataset the games are written to')
+    parser.add_argument('--no-server', dest='server', action='store_false',
+                        help='every worker loads its own copy of the network instead of sharing an inference server')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='move to the newest model published by the trainer between two games')
+    parser.add_argument('-l', '--lockstep', type=int, default=cfg.LOCKSTEP_GAMES,
+                        help='games advanced together in this process instead of using workers, 0 uses the workers')
+    parser.add_argument('--record-book', action='store_true',
+                        help='add the searches of the first moves to the opening book')
+    args = parser.parse_args()
+
+    player_options = {'timeout': args.timeout, 'max_simulations': args.simulations, 'record_book': args.record_book}
+    if args.model >= 0:
+        player_options.update(nnet_ver=args.model, backend=args.backend)
+    if args.lockstep > 0:
+        if args.model < 0:
+            parser.error('lockstep self-play needs a model')
+        # the moves are bounded by the simulations, the clock of a game runs while the others search
+        del player_options['timeout']
+        if args.simulations is None:
+            del player_options['max_simulations']
+        result = lockstep(args.games, args.lockstep, seed=args.seed, dataset_path=args.dataset, **player_options)
+        print('{} games in {:.0f} s, {:.1f} games per hour, {:.1f} positions for each network call'.format(
+            result['games'], result['elapsed'], result['games_per_hour'], result['mean_batch_size']))
+    else:
+        result = run(args.workers, args.games, args.seed, args.dataset, server=args.server, follow=args.follow,
+                     **player_options)
+        print('{} games in {:.0f} s, {:.1f} games per hour, {} restarts'.format(
+            result['games'], result['elapsed'], result['games_per_hour'], result['restarts']))
+    print(', '.join('{} {}'.format(name, count) for name, count in result['results'].items()))
+    if 'inference' in result:
+        print('inference server:', ', '.join('{} {}'.format(k, v) for k, v in result['inference'].items()))
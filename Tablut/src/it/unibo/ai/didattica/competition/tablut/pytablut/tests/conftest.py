@@ -0,0 +1,10 @@
+import pytest
+
+import pytablut.loggers as lg
+
+
+@pytest.fixture(autouse=True, scope='session')
+def log_folder(tmp_path_factory):
+    """ the loggers write to logs/ in the working directory, the tests write to a temporary one """
+    lg.use_log_folder(str(tmp_path_factory.mktemp('logs')))
+
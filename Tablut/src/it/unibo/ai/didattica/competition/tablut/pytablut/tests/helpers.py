@@ -0,0 +1,16 @@
+import numpy as np
+
+
+def make_positions(n: int, start: int = 0, policy_size: int = 4) -> dict:
+    """
+    :return: n positions with the arrays of dataset.FIELDS, the value of the i-th one is start + i
+    and it is also written in a cell of its board, so that rows can be matched across the fields
+    """
+    values = np.arange(start, start + n)
+    boards = np.zeros((n, 9, 9), dtype=np.int8)
+    boards[:, 0, 0] = values % 100
+    return {'boards': boards,
+            'turns': np.where(values % 2 == 0, 1, -1).astype(np.int8),
+            'values': values.astype(np.float32),
+            'policy_indexes': np.tile(values[:, np.newaxis] % 1000, (1, policy_size)).astype(np.int16),
+            'policy_probs': np.full((n, policy_size), 1 / policy_size, dtype=np.float32)}
@@ -0,0 +1,60 @@
+import pytest
+
+from pytablut.arena import SPRT
+
+
+def run(scores, test: SPRT = None):
+    """ :return: the status of the test after each score """
+    test = test if test is not None else SPRT()
+    statuses = []
+    for score in scores:
+        test.add(score)
+        statuses.append(test.status())
+    return statuses
+
+
+def test_no_games():
+    test = SPRT()
+    assert test.llr() == 0
+    assert test.status() is None
+
+
+def test_wins_accept():
+    statuses = run([1.] * 50)
+    assert statuses[0] is None
+    assert statuses[-1] == 'accept'
+    assert 'reject' not in statuses
+
+
+@pytest.mark.parametrize('score', [0., 0.5])
+def test_losses_and_draws_reject(score):
+    statuses = run([score] * 200)
+    assert statuses[-1] == 'reject'
+    assert 'accept' not in statuses
+
+
+def test_even_match_rejects():
+    # as strong as the current version, the test is for a gain of elo1
+    assert run([1., 0.] * 400)[-1] == 'reject'
+
+
+def test_stronger_candidate_accepts():
+    # 3 wins every 4 games, well above elo1
+    assert run([1., 1., 1., 0.] * 100)[-1] == 'accept'
+
+
+def test_llr_grows_with_the_wins():
+    test = SPRT()
+    llrs = []
+    for _ in range(10):
+        test.add(1.)
+        llrs.append(test.llr())
+    assert all(later > earlier for earlier, later in zip(llrs, llrs[1:]))
+
+
+def test_pair_means_count_as_draws():
+    # pairs split between the colors are half points, like draws
+    pairs, draws = SPRT(), SPRT()
+    run([0.5] * 30, pairs)
+    run([0.5] * 30, draws)
+    assert pairs.llr() == draws.llr() < 0
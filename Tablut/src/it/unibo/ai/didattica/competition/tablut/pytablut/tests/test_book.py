@@ -0,0 +1,69 @@
+import numpy as np
+
+import pytablut.actionspace as actionspace
+from pytablut.book import OpeningBook, merge, rows
+from pytablut.game import Game, State
+
+
+def position(moves: int = 3) -> State:
+    """ :return: a state without symmetries, reached with the first legal moves """
+    game = Game()
+    for _ in range(moves):
+        game.execute(game.current_state.actions[0])
+    return game.current_state
+
+
+def statistics(state: State):
+    N = np.arange(len(state.actions), dtype=np.float64)
+    return N, N / 2 - 1
+
+
+def test_merge_and_lookup(tmp_path):
+    file = str(tmp_path / 'book.bin')
+    assert len(OpeningBook(file)) == 0
+    state = position()
+    N, W = statistics(state)
+    assert merge(rows(state, state.actions, N, W), file) == 1
+    book = OpeningBook(file)
+    assert len(book) == 1
+    found_N, found_W = book.lookup(state)
+    # the unvisited action is not stored, it is 0 in the lookup
+    np.testing.assert_allclose(found_N, N)
+    np.testing.assert_allclose(found_W, np.where(N > 0, W, 0))
+    assert book.lookup(Game().current_state) is None
+
+    # the statistics of the same position are summed
+    merge(rows(state, state.actions, N, W), file)
+    found_N, found_W = OpeningBook(file).lookup(state)
+    np.testing.assert_allclose(found_N, 2 * N)
+    np.testing.assert_allclose(found_W, np.where(N > 0, 2 * W, 0))
+
+
+def test_symmetric_positions_share_their_statistics(tmp_path):
+    file = str(tmp_path / 'book.bin')
+    state = position()
+    N, W = statistics(state)
+    merge(rows(state, state.actions, N, W), file)
+    book = OpeningBook(file)
+    for symmetry in range(8):
+        symmetric = State(actionspace.transform_board(state.board, symmetry).copy(), state.turn)
+        found_N, found_W = book.lookup(symmetric)
+        # the same action on the transformed board
+        moved = actionspace.transform_indexes(actionspace.action_indexes(state.actions), symmetry)
+        order = np.argsort(moved)
+        position_of = np.searchsorted(moved[order], actionspace.action_indexes(symmetric.actions))
+        np.testing.assert_allclose(found_N, N[order][position_of])
+        np.testing.assert_allclose(found_W, np.where(N > 0, W, 0)[order][position_of])
+
+
+def test_merge_keeps_the_most_visited_positions(tmp_path):
+    file = str(tmp_path / 'book.bin')
+    states = [position(moves) for moves in (1, 2, 3)]
+    records = np.concatenate([rows(state, state.actions[:2], [visits, 1], [0, 0])
+                              for state, visits in zip(states, (5, 50, 20))])
+    assert merge(records, file, max_positions=2) == 2
+    book = OpeningBook(file)
+    assert book.lookup(states[0]) is None
+    assert book.lookup(states[1])[0][0] == 50
+    assert book.lookup(states[2])[0][0] == 20
+    np.testing.assert_array_equal(np.sort(book.to_rows()['N']), [1, 1, 20, 50])
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+
+from pytablut.dataset import Dataset
+from pytablut.tests.helpers import make_positions
+
+
+def fill(dataset: Dataset, games: int, size: int = 10, first_version: int = 1):
+    """ appends games of size positions, the values continue from the ones already in the dataset """
+    start = len(dataset)
+    for i in range(games):
+        dataset.append(make_positions(size, start + i * size), version=first_version + i)
+
+
+def read_values(dataset: Dataset) -> np.ndarray:
+    return np.concatenate([positions['values'] for positions in dataset.iterate()])
+
+
+def test_append(tmp_path):
+    dataset = Dataset(str(tmp_path))
+    fill(dataset, 3)
+    dataset.append(make_positions(0))
+    entries = dataset.entries()
+    assert [entry['positions'] for entry in entries] == [10, 10, 10]
+    assert [entry['versions'] for entry in entries] == [[1, 1], [2, 2], [3, 3]]
+    assert len(dataset) == 30
+    np.testing.assert_array_equal(read_values(dataset), np.arange(30))
+
+
+def test_compact_merges_all_the_small_shards(tmp_path):
+    dataset = Dataset(str(tmp_path))
+    fill(dataset, 10)
+    assert dataset.compact(shard_size=25) == 6
+    entries = dataset.entries()
+    assert [entry['positions'] for entry in entries] == [30, 30, 30, 10]
+    assert [entry['games'] for entry in entries] == [3, 3, 3, 1]
+    assert [entry['versions'] for entry in entries] == [[1, 3], [4, 6], [7, 9], [10, 10]]
+    np.testing.assert_array_equal(read_values(dataset), np.arange(100))
+    # the inputs are deleted
+    assert sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.npz')) == \
+        sorted(entry['shard'] for entry in entries)
+
+
+def test_compact_fills_the_last_partial_shard(tmp_path):
+    dataset = Dataset(str(tmp_path))
+    fill(dataset, 10)
+    dataset.compact(shard_size=25)
+    full = [entry['shard'] for entry in dataset.entries()[:3]]
+    fill(dataset, 2, first_version=11)
+    assert dataset.compact(shard_size=25) == 2
+    entries = dataset.entries()
+    assert [entry['shard'] for entry in entries[:3]] == full
+    assert [entry['positions'] for entry in entries] == [30, 30, 30, 30]
+    assert entries[-1]['versions'] == [10, 12]
+    np.testing.assert_array_equal(read_values(dataset), np.arange(120))
+    # nothing left to merge
+    assert dataset.compact(shard_size=25) == 0
+
+
+def test_compact_moves_small_shards_to_their_newest_input(tmp_path):
+    dataset = Dataset(str(tmp_path))
+    fill(dataset, 1)
+    fill(dataset, 1, size=40, first_version=2)
+    fill(dataset, 2, first_version=3)
+    dataset.compact(shard_size=25)
+    entries = dataset.entries()
+    assert [entry['positions'] for entry in entries] == [40, 30]
+    assert [entry['versions'] for entry in entries] == [[2, 2], [1, 4]]
+    np.testing.assert_array_equal(read_values(dataset), np.r_[10:50, 0:10, 50:70])
+
+
+def test_compact_without_versions(tmp_path):
+    dataset = Dataset(str(tmp_path / 'mixed'))
+    dataset.append(make_positions(10))
+    dataset.append(make_positions(10, 10), version=5)
+    dataset.compact(shard_size=25)
+    assert dataset.entries()[0]['versions'] == [5, 5]
+    dataset = Dataset(str(tmp_path / 'unknown'))
+    dataset.append(make_positions(10))
+    dataset.append(make_positions(10, 10))
+    dataset.compact(shard_size=25)
+    assert 'versions' not in dataset.entries()[0]
+
+
+def test_sample(tmp_path):
+    dataset = Dataset(str(tmp_path))
+    fill(dataset, 10)
+    rng = np.random.default_rng(0)
+    sample = dataset.sample(1000, rng)
+    assert all(len(sample[field]) == 1000 for field in sample)
+    # the fields of a row come from the same position
+    np.testing.assert_array_equal(sample['boards'][:, 0, 0], sample['values'])
+    np.testing.assert_array_equal(sample['policy_indexes'][:, 0], sample['values'])
+    # uniform over the shards
+    assert len(np.unique(sample['values'])) == 100
+    recent = dataset.sample(500, rng, positions=15)
+    assert set(np.unique(recent['values'])) == set(range(80, 100))
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from pytablut.memory import ReplayBuffer
+from pytablut.tests.helpers import make_positions
+
+
+def test_extend_wraps_around(tmp_path):
+    buffer = ReplayBuffer(10, str(tmp_path), policy_size=4)
+    buffer.extend(make_positions(7))
+    assert (buffer.head, len(buffer)) == (7, 7)
+    buffer.extend(make_positions(6, 7))
+    assert (buffer.head, len(buffer)) == (3, 10)
+    # the oldest positions were overwritten
+    np.testing.assert_array_equal(buffer.arrays['values'], [10, 11, 12, 3, 4, 5, 6, 7, 8, 9])
+    np.testing.assert_array_equal(buffer.arrays['boards'][:, 0, 0], buffer.arrays['values'])
+
+
+def test_extend_larger_than_the_buffer(tmp_path):
+    buffer = ReplayBuffer(10, str(tmp_path), policy_size=4)
+    buffer.extend(make_positions(3))
+    buffer.extend(make_positions(25, 3))
+    assert (buffer.head, len(buffer)) == (3, 10)
+    np.testing.assert_array_equal(np.sort(buffer.arrays['values']), np.arange(18, 28))
+    np.testing.assert_array_equal(buffer.arrays['values'][[2, 3]], [27, 18])
+
+
+def test_append_wraps_around(tmp_path):
+    buffer = ReplayBuffer(3, str(tmp_path), policy_size=4)
+    for i in range(4):
+        buffer.append(np.full((9, 9), i), 1, float(i), ([i, 100 + i], [0.25, 0.75]))
+    assert (buffer.head, len(buffer)) == (1, 3)
+    np.testing.assert_array_equal(buffer.arrays['values'], [3, 1, 2])
+    np.testing.assert_array_equal(buffer.arrays['policy_indexes'][0], [3, 103, -1, -1])
+    np.testing.assert_array_equal(buffer.arrays['policy_probs'][0], [0.25, 0.75, 0, 0])
+
+
+def test_flush_and_reopen(tmp_path):
+    buffer = ReplayBuffer(10, str(tmp_path), policy_size=4)
+    assert not ReplayBuffer.exists(str(tmp_path))
+    buffer.extend(make_positions(7))
+    buffer.extend(make_positions(6, 7))
+    buffer.flush()
+    assert ReplayBuffer.exists(str(tmp_path))
+    reopened = ReplayBuffer(10, str(tmp_path), policy_size=4)
+    assert (reopened.head, len(reopened)) == (3, 10)
+    for field, array in buffer.arrays.items():
+        np.testing.assert_array_equal(reopened.arrays[field], array)
+    # the ring goes on from where it was
+    reopened.extend(make_positions(2, 13))
+    np.testing.assert_array_equal(reopened.arrays['values'][3:5], [13, 14])
+    with pytest.raises(ValueError):
+        ReplayBuffer(20, str(tmp_path), policy_size=4)
+
+
+def test_sample_only_the_used_slots():
+    buffer = ReplayBuffer(10, None, policy_size=4)
+    buffer.extend(make_positions(4))
+    sample = buffer.sample(200, np.random.default_rng(0))
+    assert set(np.unique(sample['values'])) == {0, 1, 2, 3}
+    np.testing.assert_array_equal(sample['boards'][:, 0, 0], sample['values'])
@@ -0,0 +1,50 @@
+import numpy as np
+
+import pytablut.actionspace as actionspace
+from pytablut.game import Game, State
+from pytablut.pipeline import augment
+
+
+def random_positions(n: int, rng: np.random.Generator):
+    """ :return: boards, turns and the policy indexes of up to 5 of their legal actions padded with -1 """
+    boards, turns, indexes = [], [], []
+    for _ in range(n):
+        game = Game()
+        for _ in range(rng.integers(0, 12)):
+            actions = game.current_state.actions
+            game.execute(actions[rng.integers(len(actions))])
+        state = game.current_state
+        chosen = rng.choice(len(state.actions), size=min(5, len(state.actions)), replace=False)
+        row = np.full(8, -1, dtype=np.int16)
+        row[:len(chosen)] = actionspace.action_indexes([state.actions[i] for i in chosen])
+        boards.append(state.board.astype(np.int8))
+        turns.append(state.turn)
+        indexes.append(row)
+    return np.array(boards), np.array(turns), np.array(indexes)
+
+
+def test_augment_matches_actionspace():
+    rng = np.random.default_rng(0)
+    boards, _, indexes = random_positions(24, rng)
+    symmetries = np.tile(np.arange(8), 3)
+    rng.shuffle(symmetries)
+    original = boards.copy(), indexes.copy()
+    augmented_boards, augmented_indexes = augment(boards, indexes, symmetries)
+    # the inputs are not modified
+    np.testing.assert_array_equal(boards, original[0])
+    np.testing.assert_array_equal(indexes, original[1])
+    for i, symmetry in enumerate(symmetries):
+        np.testing.assert_array_equal(augmented_boards[i], actionspace.transform_board(boards[i], symmetry))
+        valid = indexes[i] >= 0
+        np.testing.assert_array_equal(augmented_indexes[i][valid],
+                                      actionspace.transform_indexes(indexes[i][valid], symmetry))
+        np.testing.assert_array_equal(augmented_indexes[i][~valid], -1)
+
+
+def test_augmented_actions_are_legal():
+    rng = np.random.default_rng(1)
+    boards, turns, indexes = random_positions(16, rng)
+    augmented_boards, augmented_indexes = augment(boards, indexes, np.tile(np.arange(8), 2))
+    for board, turn, row in zip(augmented_boards, turns, augmented_indexes):
+        legal = set(actionspace.action_indexes(State(board, turn).actions).tolist())
+        assert set(row[row >= 0].tolist()) <= legal
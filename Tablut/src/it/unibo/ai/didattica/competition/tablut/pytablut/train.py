@@ -1,83 +1,158 @@
+"""
+Main training loop. With --coordinator it is instead a self-play node of a distributed run:
+its workers play with the versions downloaded from the coordinator and send it their games.
+Run it from the folder containing pytablut, e.g.
+
+    python -m pytablut.train
+    python -m pytablut.train --coordinator trainhost:6000 --workers 8
+"""
+import argparse
+import threading
+import time
+import multiprocessing as mp
+
+import pytablut.arena as arena
+import pytablut.checkpoints as checkpoints
 import pytablut.config as cfg
+import pytablut.coordinator as coordinator
 import pytablut.loggers as lg
-from pytablut.game import Game
-from pytablut.memory import Memory, load_memories, compact_memories
-from pytablut.neuralnet import ResidualNN
+import pytablut.selfplay as selfplay
+import pytablut.trainer as trainer
+from pytablut.dataset import Dataset
+from pytablut.memory import ReplayBuffer
 from pytablut.player import Player
-from pytablut.utils import Timeit
 
 lg.logger_train.info('=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*')
 lg.logger_train.info('=*=*=*=*=*=.      NEW LOG      =*=*=*=*=*')
 lg.logger_train.info('=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*=*')
 
 
-@Timeit(logger=lg.logger_train)
-def self_play(p1: Player, p2: Player, memory: Memory):
-    """ play one match of self play, saving the (partial) results in memory"""
-    game = Game()
-    p1.reset()
-    p2.reset()
-
-    while not game.current_state.is_terminal:
-        print(game.current_state.board)
-        if game.current_player == 1:
-            turn = 'WHITE'
-            act = p1.act(game.current_state)
-        else:
-            turn = 'BLACK'
-            act = p2.act(game.current_state)
-        lg.logger_train.info('{} TURN, ACTION: {}'.format(turn, act))
-        print('{} TURN, ACTION: {}\n'.format(turn, act))
-        memory.commit_stmemory(game.current_state)
-        game.execute(act)
-
-    if game.current_state.value == 0:  # it's a draw
-        lg.logger_train.info("IT'S A DRAW")
-        memory.commit_ltmemory(0)
-    else:  # the player of this turn has lost
-        memory.commit_ltmemory(-game.current_state.turn)
-        lg.logger_train.info('WINNER OF THIS EPISODE: {}'.format(endgame_map[-game.current_state.turn]))
-
-
-if __name__ == "__main__":
-    # SETUP GAME
-    endgame_map = {0: 'DRAW', 1: 'WHITE', -1: 'BLACK'}
-
-    # LOAD MEMORY STORAGE
-    ltmemory = None  # load_memories()
-    memory = Memory(cfg.MEMORY_SIZE, ltmemory)
-
-    # CREATE (AND EVENTUALLY LOAD) NETWORKS
-    general_nn = ResidualNN()
+def train_async():
+    """ the trainer process publishes new versions while the workers play, until Ctrl+C """
+    context = mp.get_context('spawn')
+    stop = context.Event()
+    process = context.Process(target=trainer.process, args=(cfg.CURRENT_VERSION, stop), name='trainer')
+    process.start()
+    try:
+        # the workers start from the first version published by the trainer
+        while checkpoints.latest_version() is None or checkpoints.latest_version() < cfg.CURRENT_VERSION:
+            if not process.is_alive():
+                raise RuntimeError('the trainer process died')
+            time.sleep(1.)
+        selfplay.run(workers=cfg.SELF_PLAY_WORKERS, games=cfg.EPISODES * cfg.TOTAL_ITERATIONS,
+                     nnet_ver=checkpoints.latest_version(), follow=True,
+                     timeout=cfg.TIMEOUT, simulations=cfg.MCTS_SIMULATIONS)
+    finally:
+        stop.set()
+        process.join(cfg.SELF_PLAY_JOIN_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        lg.logger_train.info('TRAINER STOPPED AT MODEL v{}'.format(checkpoints.latest_version()))
+
+
+def train_remote(address: tuple, workers: int = cfg.SELF_PLAY_WORKERS, backend: str = 'keras', **options):
+    """
+    self-play node of a distributed run, until Ctrl+C
+    :param address: (host, port) of the coordinator
+    :param options: arguments of the players, e.g. timeout, max_simulations
+    """
+    options.setdefault('timeout', cfg.TIMEOUT)
+    options.setdefault('simulations', cfg.MCTS_SIMULATIONS)
+    client = coordinator.CoordinatorClient(address)
+    version = coordinator.sync(client, backend)
+    while version is None:
+        lg.logger_train.info('WAITING FOR THE FIRST MODEL OF THE COORDINATOR')
+        time.sleep(cfg.COORDINATOR_POLL)
+        version = coordinator.sync(client, backend)
+    client.close()
+    # the new versions are downloaded and published locally, the workers follow them
+    stop = threading.Event()
+    thread = threading.Thread(target=coordinator.follow, args=(address, backend, stop), daemon=True)
+    thread.start()
+    try:
+        selfplay.run(workers=workers, games=cfg.EPISODES * cfg.TOTAL_ITERATIONS, nnet_ver=version, backend=backend,
+                     follow=True, coordinator=address, halt=stop, **options)
+        if stop.is_set():
+            # the node would go on playing an old model, whose games the coordinator rejects
+            raise RuntimeError('the node lost the models of the coordinator, see the log')
+    finally:
+        stop.set()
+
+
+def train_alternating():
+    """ self-play and training take turns """
+    # LOAD MEMORY STORAGE, the self-play workers archive their games in the dataset,
+    # the replay buffer is refilled with the newest ones before each training
+    dataset = Dataset()
+    buffer = ReplayBuffer(cfg.MEMORY_SIZE)
+
+    # THE NETWORK BEING TRAINED, the workers load the last saved version
+    player = Player(color='WHITE', name='trainer', nnet_ver=cfg.CURRENT_VERSION)
+    version = cfg.CURRENT_VERSION
+    if version == 0:
+        version = 1
+        checkpoints.save(player.brain, version)
+    elif checkpoints.latest_version() is None:
+        checkpoints.publish(version)
+    # the version playing self-play, the trained ones replace it only when they beat it
+    best = checkpoints.latest_version()
     lg.logger_train.info('LOADED NETWORK')
 
-    # CREATE PLAYERS
-    white = Player(color='WHITE', name='dc', nnet=general_nn,
-                   timeout=cfg.TIMEOUT, simulations=cfg.MCTS_SIMULATIONS)
-    black = Player(color='BLACK', name='pd', nnet=general_nn,
-                   timeout=cfg.TIMEOUT, simulations=cfg.MCTS_SIMULATIONS)
-
     # START!
     lg.logger_train.info('PLAYERS READY, STARTING MAIN LOOP')
-    for version in range(cfg.TOTAL_ITERATIONS):
-        lg.logger_train.info('ITERATION NUMBER {:0>3d}/{:0>3d}'.format(version, cfg.TOTAL_ITERATIONS))
+    for iteration in range(cfg.TOTAL_ITERATIONS):
+        lg.logger_train.info('ITERATION NUMBER {:0>3d}/{:0>3d}'.format(iteration, cfg.TOTAL_ITERATIONS))
         lg.logger_train.info('SELF PLAYING FOR {:d} EPISODES'.format(cfg.EPISODES))
+        if cfg.LOCKSTEP_GAMES > 0:
+            # a single process, the network evaluates the leaves of all the games together
+            stats = selfplay.lockstep(games=cfg.EPISODES, parallel=cfg.LOCKSTEP_GAMES, nnet_ver=best,
+                                      max_simulations=cfg.MCTS_SIMULATIONS)
+        else:
+            stats = selfplay.run(workers=cfg.SELF_PLAY_WORKERS, games=cfg.EPISODES, nnet_ver=best,
+                                 timeout=cfg.TIMEOUT, simulations=cfg.MCTS_SIMULATIONS)
+        if stats['interrupted']:
+            # Ctrl+C during the self-play, the games finished so far are already in the dataset
+            lg.logger_train.info('TRAINING INTERRUPTED AT ITERATION {:0>3d}'.format(iteration))
+            break
+        dataset.compact()
 
-        # make sure both players use the same network
-        black.brain.set_weights(white.brain.get_weights())
-
-        for episode in range(cfg.EPISODES):
-            lg.logger_train.info('EPISODE {:0>3d}/{:0>3d}'.format(episode, cfg.EPISODES))
-            self_play(white, black, memory)
-            memory.save('ep{:0>4d}'.format(episode))
-            memory.clear_ltmemory()
+        lg.logger_train.info('RETRAINING NETWORK')
+        buffer.clear()
+        buffer.fill(dataset)
+        player.replay(buffer)
+        version = max(version, best) + 1
+        checkpoints.save(player.brain, version, promote=not cfg.GATING)
 
-        compact_memories()
-        ltmemory = load_memories()
-        # memory = Memory(cfg.MEMORY_SIZE, ltmemory)
+        if cfg.GATING:
+            lg.logger_train.info('EVALUATING NETWORK')
+            arena.gate(version, best)
+            best = checkpoints.latest_version()
 
-        lg.logger_train.info('RETRAINING NETWORK')
-        white.replay(ltmemory)
-        white.brain.save('general', version)
 
-        # TODO evaluate network
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the network, or play self-play games for a coordinator.')
+    parser.add_argument('-c', '--coordinator', type=str, default=None,
+                        help='host:port of the coordinator, run as a self-play node of a distributed run')
+    parser.add_argument('-w', '--workers', type=int, default=cfg.SELF_PLAY_WORKERS,
+                        help='number of worker processes of the node')
+    parser.add_argument('-b', '--backend', type=str, default='keras', choices=['numpy', 'keras', 'int8', 'float16'],
+                        help='how the node evaluates the neural network')
+    parser.add_argument('-t', '--timeout', type=float, default=cfg.TIMEOUT,
+                        help='seconds for each move of the node')
+    parser.add_argument('-s', '--simulations', type=int, default=None,
+                        help='simulations for each move of the node, the timeout still applies')
+    args = parser.parse_args()
+
+    if args.coordinator is not None:
+        address = coordinator.parse_address(args.coordinator)
+        try:
+            coordinator.check_authkey(address[0], coordinator.get_authkey())
+        except ValueError as e:
+            parser.error(str(e))
+        train_remote(address, args.workers, args.backend,
+                     timeout=args.timeout, max_simulations=args.simulations)
+    elif cfg.ASYNC_TRAINING:
+        train_async()
+    else:
+        train_alternating()
@@ -0,0 +1,86 @@
+"""
+Asynchronous trainer: trains the network on the newest positions of the dataset while the self-play workers
+keep playing, and publishes every new version, that the workers pick up between two games.
+A training starts when TRAINING_NEW_POSITIONS positions were added since the previous one,
+with GATING the new version is published only if it beats the published one in the arena.
+Run it from the folder containing pytablut, together with self-play following the published versions, e.g.
+
+    python -m pytablut.trainer 3
+    python -m pytablut.selfplay --follow --model 3 --games 100000
+"""
+import argparse
+import signal
+import threading
+
+import pytablut.checkpoints as checkpoints
+import pytablut.config as cfg
+import pytablut.loggers as lg
+from pytablut.dataset import Dataset
+from pytablut.memory import ReplayBuffer
+
+
+def train(version: int, stop=None, dataset_path: str = cfg.DATASET_DIR,
+          min_positions: int = cfg.TRAINING_MIN_POSITIONS, new_positions: int = cfg.TRAINING_NEW_POSITIONS,
+          backends=cfg.EXPORT_BACKENDS, gating: bool = cfg.GATING) -> int:
+    """
+    trains until stop is set
+    :param version: version of the network to start from, 0 for a new one
+    :param stop: event ending the training, checked between two trainings
+    :param gating: publish a version only if it beats the published one, see arena.gate
+    :return: the last trained version
+    """
+    from pytablut.player import Player
+
+    stop = stop if stop is not None else threading.Event()
+    trainer = Player(color='WHITE', name='trainer', nnet_ver=version)
+    latest = checkpoints.latest_version()
+    if version == 0:
+        # a new network, after the versions already published
+        version = (latest or 0) + 1
+        checkpoints.save(trainer.brain, version, backends)
+    elif latest is None or latest < version:
+        # the workers start from the newest published model
+        checkpoints.save(trainer.brain, version, backends)
+    dataset = Dataset(dataset_path)
+    buffer = ReplayBuffer(cfg.MEMORY_SIZE)
+    trained = 0  # positions in the dataset at the previous training
+    lg.logger_train.info('TRAINER STARTED FROM MODEL v{}'.format(version))
+    while not stop.is_set():
+        positions = len(dataset)
+        if positions < min_positions or positions - trained < new_positions:
+            stop.wait(cfg.TRAINER_POLL)
+            continue
+        lg.logger_train.info('TRAINING ON {} POSITIONS, {} NEW'.format(positions, positions - trained))
+        dataset.compact()
+        buffer.clear()
+        buffer.fill(dataset)
+        trainer.replay(buffer)
+        version = max(version, checkpoints.latest_version()) + 1
+        checkpoints.save(trainer.brain, version, backends, promote=not gating)
+        if gating:
+            from pytablut.arena import gate
+
+            gate(version, checkpoints.latest_version())
+        trained = positions
+    return version
+
+
+def process(version: int, stop, dataset_path: str = cfg.DATASET_DIR):
+    """ entry point of the trainer process started by train.py, stopped through the event """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    lg.use_log_folder('logs/trainer')
+    train(version, stop, dataset_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the network while self-play runs.')
+    parser.add_argument('version', type=int, nargs='?', default=cfg.CURRENT_VERSION,
+                        help='version of the model in model/brain to start from, 0 for a new one')
+    parser.add_argument('-d', '--dataset', type=str, default=cfg.DATASET_DIR,
+                        help='folder of the dataset written by self-play')
+    args = parser.parse_args()
+
+    try:
+        train(args.version, dataset_path=args.dataset)
+    except KeyboardInterrupt:
+        print('stopped at version', checkpoints.latest_version())
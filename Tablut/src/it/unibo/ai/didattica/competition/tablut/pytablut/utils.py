@@ -54,5 +54,4 @@ def setup_folders():
         os.mkdir('logs')
     if 'model' not in os.listdir():
         os.mkdir('model')
-        os.mkdir('model/history')
         os.mkdir('model/brain')